@@ -111,13 +111,30 @@ resource "aws_sqs_queue" "fifo_backup_automation_queue" {
   name                        = var.sqs_queue_name
   content_based_deduplication = true
   deduplication_scope         = "messageGroup"
+  fifo_throughput_limit       = "perMessageGroupId"
   delay_seconds               = 10
   fifo_queue                  = true
   kms_master_key_id           = aws_kms_alias.backup_automation_kms_key_alias.id
   message_retention_seconds   = 10800
-  visibility_timeout_seconds  = 7200
+  # six times the function timeout, as Lambda recommends for queues it polls, so a failed record is retried within minutes
+  visibility_timeout_seconds  = 6 * var.org_policy_lambda_timeout
   receive_wait_time_seconds   = 10
   tags                        = var.tags
+
+  # a record that keeps failing is moved aside instead of holding up the later changes to its policy
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.fifo_backup_automation_dlq.arn
+    maxReceiveCount     = var.sqs_max_receive_count
+  })
+}
+
+# dead-letter queue for the records OrgBackupPolicyManager could not process after sqs_max_receive_count attempts
+resource "aws_sqs_queue" "fifo_backup_automation_dlq" {
+  name                      = "${trimsuffix(var.sqs_queue_name, ".fifo")}-dlq.fifo"
+  fifo_queue                = true
+  kms_master_key_id         = aws_kms_alias.backup_automation_kms_key_alias.id
+  message_retention_seconds = 1209600
+  tags                      = var.tags
 }
 
 resource "aws_sqs_queue_policy" "fifo_queue_policy" {
@@ -130,7 +147,10 @@ resource "aws_sqs_queue_policy" "fifo_queue_policy" {
         "Sid" : "___Sender_Statement___",
         "Effect" : "Allow",
         "Principal" : {
-          "AWS" : "arn:aws:iam::${var.backup_account_id}:role/${aws_iam_role.s3_policy_mapper_role.id}"
+          "AWS" : [
+            "arn:aws:iam::${var.backup_account_id}:role/${aws_iam_role.s3_policy_mapper_role.id}",
+            "arn:aws:iam::${var.backup_account_id}:role/${aws_iam_role.org_policy_manager_role.id}"
+          ]
         },
         "Action" : "SQS:SendMessage",
         "Resource" : "${aws_sqs_queue.fifo_backup_automation_queue.arn}"
@@ -187,6 +207,33 @@ resource "aws_s3_bucket_versioning" "backup_policy_repository" {
   }
 }
 
+# expire the old versions of policy ledgers, which are rewritten on every applied change and have no history worth keeping
+resource "aws_s3_bucket_lifecycle_configuration" "backup_policy_repository" {
+  bucket = aws_s3_bucket.backup_policy_repository.id
+
+  rule {
+    id     = "expire-noncurrent-ledgers"
+    status = "Enabled"
+
+    filter {
+      prefix = "_ledger/"
+    }
+
+    noncurrent_version_expiration {
+      noncurrent_days = var.ledger_noncurrent_version_days
+    }
+
+    # a ledger whose versions have all expired leaves only its delete marker behind
+    expiration {
+      expired_object_delete_marker = true
+    }
+  }
+
+  depends_on = [
+    aws_s3_bucket_versioning.backup_policy_repository
+  ]
+}
+
 # enable encryption with a KMS Customer Managed Key (CMK)
 resource "aws_s3_bucket_server_side_encryption_configuration" "bucket_encryption" {
   bucket = aws_s3_bucket.backup_policy_repository.bucket
@@ -267,10 +314,18 @@ resource "aws_s3_bucket_notification" "create_object" {
     filter_suffix       = ".zip"
   }
 
-  # creates the Lambda trigger for file deletion
+  # creates the Lambda triggers for policy file deletion; S3 filters cannot exclude a prefix, so only the two policy files are
+  # matched, which leaves out the ledgers the OrgBackupPolicyManager function writes and removes in the _ledger/ folder
   lambda_function {
     lambda_function_arn = aws_lambda_function.s3_policy_mapper.arn
     events              = ["s3:ObjectRemoved:*"]
+    filter_suffix       = "/${var.policy_definition_file_name}"
+  }
+
+  lambda_function {
+    lambda_function_arn = aws_lambda_function.s3_policy_mapper.arn
+    events              = ["s3:ObjectRemoved:*"]
+    filter_suffix       = "/${var.target_list_file_name}"
   }
 }
 
@@ -306,9 +361,14 @@ resource "aws_lambda_function" "s3_policy_mapper" {
   # set environmental variable defaults for the function
   environment {
     variables = {
-      SQS_QUEUE_URL      = aws_sqs_queue.fifo_backup_automation_queue.url
-      RETRY_COUNT        = var.s3_lambda_retry_count
-      SLEEP_TIME_SECONDS = var.s3_lambda_sleep_time
+      SQS_QUEUE_URL               = aws_sqs_queue.fifo_backup_automation_queue.url
+      RETRY_COUNT                 = var.s3_lambda_retry_count
+      SLEEP_TIME_SECONDS          = var.s3_lambda_sleep_time
+      SPOOL_SIZE_BYTES            = var.s3_lambda_spool_size_bytes
+      UPLOAD_CONCURRENCY          = var.s3_lambda_upload_concurrency
+      POLICY_DEFINITION_FILE_NAME = var.policy_definition_file_name
+      TARGET_LIST_FILE_NAME       = var.target_list_file_name
+      MAX_POLICY_SIZE             = var.max_policy_size
     }
   }
 }
@@ -333,6 +393,16 @@ resource "aws_lambda_function" "org_policy_manager" {
       SQS_QUEUE_URL               = aws_sqs_queue.fifo_backup_automation_queue.url
       RETRY_COUNT                 = var.org_policy_lambda_retry_count
       SLEEP_TIME_SECONDS          = var.org_policy_lambda_sleep_time
+      ORG_API_REQUESTS_PER_SECOND = var.org_api_requests_per_second
+      ORG_API_BURST               = var.org_api_burst
+      POLICY_CATALOG_TTL_SECONDS  = var.policy_catalog_ttl_seconds
+      ATTACHMENT_CONCURRENCY      = var.attachment_concurrency
+      PRUNE_REDUNDANT_TARGETS     = var.prune_redundant_targets
+      ORG_TREE_TTL_SECONDS        = var.org_tree_ttl_seconds
+      MAX_POLICY_SIZE             = var.max_policy_size
+      CHECKPOINT_MARGIN_SECONDS   = var.checkpoint_margin_seconds
+      LEDGER_VERIFY_SECONDS       = var.ledger_verify_seconds
+      ORG_RATE_TABLE_NAME         = var.org_rate_table_name
     }
   }
 }
@@ -341,7 +411,78 @@ resource "aws_lambda_event_source_mapping" "sqs_message_event" {
   event_source_arn = aws_sqs_queue.fifo_backup_automation_queue.arn
   function_name    = aws_lambda_function.org_policy_manager.arn
   enabled          = true
-  batch_size       = 1
+  batch_size       = var.org_policy_lambda_batch_size
+
+  # only the records reported back by the function are retried
+  function_response_types = ["ReportBatchItemFailures"]
+}
+
+# scheduled full sync of the policy bucket against AWS Organizations, only created when a schedule is set
+resource "aws_cloudwatch_event_rule" "full_sync_schedule" {
+  count               = var.full_sync_schedule == "" ? 0 : 1
+  name                = "${var.org_policy_lambda_name}FullSync"
+  description         = "Reconciles every backup policy in the policy bucket against AWS Organizations"
+  schedule_expression = var.full_sync_schedule
+  tags                = var.tags
+}
+
+resource "aws_cloudwatch_event_target" "full_sync_target" {
+  count = var.full_sync_schedule == "" ? 0 : 1
+  rule  = aws_cloudwatch_event_rule.full_sync_schedule[0].name
+  arn   = aws_lambda_function.org_policy_manager.arn
+  input = jsonencode({
+    "Action" : "FullSync",
+    "Bucket" : aws_s3_bucket.backup_policy_repository.id
+  })
+}
+
+resource "aws_lambda_permission" "allow_full_sync_schedule" {
+  count          = var.full_sync_schedule == "" ? 0 : 1
+  statement_id   = "AllowExecutionFromEventBridge"
+  action         = "lambda:InvokeFunction"
+  function_name  = aws_lambda_function.org_policy_manager.arn
+  principal      = "events.amazonaws.com"
+  source_arn     = aws_cloudwatch_event_rule.full_sync_schedule[0].arn
+  source_account = var.backup_account_id
+}
+
+# DynamoDB table holding the AWS Organizations call rate shared by concurrent OrgBackupPolicyManager invocations, only created when a table name is set
+resource "aws_dynamodb_table" "org_rate_table" {
+  count        = var.org_rate_table_name == "" ? 0 : 1
+  name         = var.org_rate_table_name
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "BucketId"
+
+  attribute {
+    name = "BucketId"
+    type = "S"
+  }
+
+  server_side_encryption {
+    enabled     = true
+    kms_key_arn = aws_kms_key.backup_automation_key.arn
+  }
+
+  tags = var.tags
+}
+
+resource "aws_iam_role_policy" "org_policy_manager_rate_table_policy" {
+  count = var.org_rate_table_name == "" ? 0 : 1
+  name  = "${var.org_policy_lambda_name}RateTablePolicy"
+  role  = aws_iam_role.org_policy_manager_role.id
+  policy = jsonencode({
+    "Version" : "2012-10-17",
+    "Statement" : [
+      {
+        "Action" : [
+          "dynamodb:GetItem",
+          "dynamodb:UpdateItem"
+        ],
+        "Resource" : "${aws_dynamodb_table.org_rate_table[0].arn}",
+        "Effect" : "Allow"
+      }
+    ]
+  })
 }
 
 # CloudWatch Log group for S3PolicyMapper Lambda function
@@ -450,7 +591,8 @@ resource "aws_iam_policy" "org_policy_manager_policy" {
           "sqs:DeleteMessage",
           "sqs:GetQueueUrl",
           "sqs:ReceiveMessage",
-          "sqs:GetQueueAttributes"
+          "sqs:GetQueueAttributes",
+          "sqs:SendMessage"
         ],
         "Resource" : "${aws_sqs_queue.fifo_backup_automation_queue.arn}",
         "Effect" : "Allow"
@@ -471,7 +613,10 @@ resource "aws_iam_policy" "org_policy_manager_policy" {
           "organizations:DeletePolicy",
           "organizations:ListPolicies",
           "organizations:DescribePolicy",
-          "organizations:DescribeEffectivePolicy"
+          "organizations:DescribeEffectivePolicy",
+          "organizations:ListRoots",
+          "organizations:ListChildren",
+          "organizations:ListParents"
         ],
         "Resource" : "*",
         "Effect" : "Allow"
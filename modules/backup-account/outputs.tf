@@ -14,4 +14,9 @@ output "backup_automation_kms_key" {
 output "sqs_queue" {
   description = "The name of the SQS queue used to trigger OrgBackupPolicyManager Lambda"
   value       = aws_sqs_queue.fifo_backup_automation_queue.arn
-}
\ No newline at end of file
+}
+# ARN of the SQS dead-letter queue
+output "sqs_dead_letter_queue" {
+  description = "The SQS queue that holds the records OrgBackupPolicyManager Lambda could not process"
+  value       = aws_sqs_queue.fifo_backup_automation_dlq.arn
+}
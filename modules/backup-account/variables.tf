@@ -82,6 +82,18 @@ variable "s3_lambda_sleep_time" {
   default     = "5"
 }
 
+variable "s3_lambda_spool_size_bytes" {
+  description = "The number of bytes of an uploaded .zip archive the S3PolicyMapper Lambda Function keeps in memory. Larger archives spill to the function's /tmp storage. It must be in string format"
+  type        = string
+  default     = "8388608"
+}
+
+variable "s3_lambda_upload_concurrency" {
+  description = "The number of files from an uploaded .zip archive the S3PolicyMapper Lambda Function uploads at once. It must be in string format"
+  type        = string
+  default     = "4"
+}
+
 variable "org_policy_lambda_timeout" {
   description = "The amount of time (in seconds) your Lambda Function has to run"
   type        = number
@@ -119,11 +131,89 @@ variable "org_policy_lambda_retry_count" {
 }
 
 variable "org_policy_lambda_sleep_time" {
-  description = "The amount of time that the function should sleep between retry operations. It is a value in seconds but must be in string format"
+  description = "The longest amount of time that the function should sleep between retries of a throttled operation. It is a value in seconds but must be in string format"
   type        = string
   default     = "10"
 }
 
+variable "org_api_requests_per_second" {
+  description = "The sustained number of AWS Organizations API calls per second the OrgBackupPolicyManager Lambda Function allows itself. It must be in string format"
+  type        = string
+  default     = "2"
+}
+
+variable "org_api_burst" {
+  description = "The number of AWS Organizations API calls the OrgBackupPolicyManager Lambda Function may make in a burst before being held to the sustained rate. It must be in string format"
+  type        = string
+  default     = "5"
+}
+
+variable "org_rate_table_name" {
+  description = "Name of a DynamoDB table, created by this module, through which concurrent OrgBackupPolicyManager invocations share org_api_requests_per_second and org_api_burst. Leave empty for each invocation to pace itself"
+  type        = string
+  default     = ""
+}
+
+variable "policy_catalog_ttl_seconds" {
+  description = "How long the OrgBackupPolicyManager Lambda Function keeps its index of backup policies warm across invocations. Use 0 to rebuild it on every invocation. It is a value in seconds but must be in string format"
+  type        = string
+  default     = "0"
+}
+
+variable "attachment_concurrency" {
+  description = "The number of attach/detach calls and independent reads the OrgBackupPolicyManager Lambda Function runs concurrently. Calls are still held to org_api_requests_per_second. It must be in string format"
+  type        = string
+  default     = "4"
+}
+
+variable "prune_redundant_targets" {
+  description = "Set to true to skip targets that a policy already covers through a targeted parent OU or root. It must be in string format"
+  type        = string
+  default     = "false"
+}
+
+variable "org_tree_ttl_seconds" {
+  description = "The time in seconds the OrgBackupPolicyManager Lambda Function keeps its index of OUs and accounts warm across invocations. It must be in string format"
+  type        = string
+  default     = "3600"
+}
+
+variable "max_policy_size" {
+  description = "The largest minified backup policy, in characters, AWS Organizations accepts. Larger definitions are split by plan into several policies. It must be in string format"
+  type        = string
+  default     = "10000"
+}
+
+variable "checkpoint_margin_seconds" {
+  description = "How long before the Lambda timeout the OrgBackupPolicyManager Lambda Function stops starting Organizations writes and hands the rest of a rollout to a continuation message. It must be in string format"
+  type        = string
+  default     = "30"
+}
+
+variable "ledger_verify_seconds" {
+  description = "How long, in seconds, the OrgBackupPolicyManager Lambda Function plans a policy from the ledger of what it last applied before reading the policy from AWS Organizations again. 0 turns the ledger off. It must be in string format"
+  type        = string
+  default     = "3600"
+}
+
+variable "ledger_noncurrent_version_days" {
+  description = "The number of days S3 keeps a policy ledger version after it has been replaced or deleted"
+  type        = number
+  default     = 1
+}
+
+variable "org_policy_lambda_batch_size" {
+  description = "The maximum number of SQS records sent to the OrgBackupPolicyManager Lambda Function in one invocation. Records for the same policy are merged into one reconcile. FIFO queues allow a value between 1 and 10"
+  type        = number
+  default     = 10
+}
+
+variable "full_sync_schedule" {
+  description = "EventBridge schedule expression (e.g. cron(0 2 * * ? *)) for a full sync of every policy in the bucket against AWS Organizations. Leave empty to disable the schedule"
+  type        = string
+  default     = ""
+}
+
 variable "lambda_runtime" {
   description = "Lambda Function runtime"
   type        = string
@@ -160,6 +250,12 @@ variable "log_retention_days" {
   default     = 14
 }
 
+variable "sqs_max_receive_count" {
+  description = "The number of times a record is received from the SQS queue before it is moved to the dead-letter queue. Only failures that a retry can fix, such as throttling or a timeout, are returned to the queue"
+  type        = number
+  default     = 3
+}
+
 variable "sqs_queue_name" {
   description = "The name of the SQS queue where backup policy data is sent. Since it is a FIFO queue, it should end with .fifo"
   type        = string
@@ -0,0 +1,136 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains the per-invocation API instrumentation shared by the
+# S3PolicyMapper and OrgBackupPolicyManager Lambda functions
+
+import json # structured metric output
+import random # sampling of call latencies
+import threading # guard counters updated from worker threads
+import time # call latency
+from collections import Counter, defaultdict # counters per API operation
+from os import getenv # environment variables
+
+metrics_namespace = getenv("METRICS_NAMESPACE", "BackupPolicyAutomation") # CloudWatch namespace for the emitted metrics
+
+# EMF accepts at most 100 values per metric, so busier operations keep a uniform random sample of their latencies
+max_latency_samples = 100
+
+##################################################
+# Per-invocation record of every AWS API call a
+# function makes: call counts, latency samples,
+# errors, throttling, retries and time spent
+# sleeping. Emitted once at the end of the
+# invocation as a CloudWatch Embedded Metric
+# Format (EMF) record.
+##################################################
+class InvocationMetrics:
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.calls = Counter()
+        self.errors = Counter()
+        self.throttles = Counter()
+        self.retries = Counter()
+        self.latency_ms = defaultdict(list)
+        self.sleep_seconds = 0.0
+        self.counters = Counter()
+
+    # call an AWS API operation and record how it went
+    def call(self, service, operation, **kwargs):
+        name = f"{service}.{getattr(operation, '__name__', 'unknown')}"
+        started = time.monotonic()
+        try:
+            return operation(**kwargs)
+        except Exception:
+            with self.lock:
+                self.errors[name] += 1
+            raise
+        finally:
+            elapsed_ms = round((time.monotonic() - started) * 1000, 1)
+            with self.lock:
+                self.calls[name] += 1
+                samples = self.latency_ms[name]
+                # reservoir sampling: every call so far has the same chance of being among the samples
+                if len(samples) < max_latency_samples:
+                    samples.append(elapsed_ms)
+                else:
+                    index = random.randrange(self.calls[name])
+                    if index < max_latency_samples:
+                        samples[index] = elapsed_ms
+
+    def record_throttle(self, service, operation):
+        with self.lock:
+            self.throttles[f"{service}.{getattr(operation, '__name__', 'unknown')}"] += 1
+
+    def record_retry(self, service, operation):
+        with self.lock:
+            self.retries[f"{service}.{getattr(operation, '__name__', 'unknown')}"] += 1
+
+    def record_sleep(self, seconds):
+        with self.lock:
+            self.sleep_seconds += seconds
+
+    # free-form counters for work done, e.g. policies reconciled or targets attached
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    # build the EMF record for everything measured so far
+    def to_emf(self, properties=None):
+        metric_definitions = []
+        record = {}
+
+        def add_metric(name, value, unit):
+            metric_definitions.append({'Name': name, 'Unit': unit})
+            record[name] = value
+
+        with self.lock:
+            for name, count in sorted(self.calls.items()):
+                add_metric(f"{name}.Calls", count, 'Count')
+                # an array of values, which CloudWatch publishes as one data point each, so percentiles can be read from it
+                add_metric(f"{name}.Latency", list(self.latency_ms[name]), 'Milliseconds')
+            for name, count in sorted(self.errors.items()):
+                add_metric(f"{name}.Errors", count, 'Count')
+            for name, count in sorted(self.throttles.items()):
+                add_metric(f"{name}.Throttles", count, 'Count')
+            for name, count in sorted(self.retries.items()):
+                add_metric(f"{name}.Retries", count, 'Count')
+            for name, count in sorted(self.counters.items()):
+                add_metric(name, count, 'Count')
+            add_metric('ApiCalls', sum(self.calls.values()), 'Count')
+            add_metric('SleepSeconds', round(self.sleep_seconds, 3), 'Seconds')
+            add_metric('DurationMilliseconds', round((time.monotonic() - self.started) * 1000, 1), 'Milliseconds')
+
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': [['FunctionName']],
+                'Metrics': metric_definitions
+            }]
+        }
+        record['FunctionName'] = self.function_name
+        record.update(properties or {})
+        return record
+
+    # write the EMF record to stdout, where Lambda sends it to CloudWatch Logs as-is
+    def emit(self, properties=None):
+        print(json.dumps(self.to_emf(properties)))
+
+# end class InvocationMetrics
@@ -17,10 +17,20 @@
 # Organization Backup Policy management
 
 import json # parsing json files
+import hashlib # hashing policy content
 import logging # log stuff
 import boto3 # aws stuff
 import re # regex parsing
 import time # sleep function
+import random # jitter for retry backoff
+import threading # guard shared throttle state
+import uuid # deduplication IDs for continuation messages
+from concurrent.futures import ThreadPoolExecutor # concurrent attach/detach
+from botocore.config import Config # client retry configuration
+from botocore.exceptions import ConnectionError as BotocoreConnectionError, HTTPClientError # connection failures and timeouts
+from ApiMetrics import InvocationMetrics # per-invocation API instrumentation
+from PolicyValidation import validate_policy_content, get_minified_policy, split_policy_content # local checks of policy files
+from TargetLists import TargetSet, read_target_list # streaming reads of large target lists
 from os import getenv # environment variables
 
 policy_definition_file_name = getenv("POLICY_DEFINITION_FILE_NAME", "policy_definition.json") # name of the Backup Policy .json definition
@@ -28,201 +38,710 @@ target_list_file_name = getenv("TARGET_LIST_FILE_NAME", "target_list.json") # na
 backup_policy_description = getenv("BACKUP_POLICY_DESCRIPTION", "Backup Policy created by CfCT Lambda function.") # policy description
 sqs_queue_url = getenv("SQS_QUEUE_URL") # URL of the FIFO queue used to process updates
 retry_count = getenv("RETRY_COUNT", 3) # global count for retries during processing errors
-sleep_time_seconds = getenv("SLEEP_TIME_SECONDS", 5) # global value for time to sleep when modifying values/during retries
+sleep_time_seconds = getenv("SLEEP_TIME_SECONDS", 5) # global value for the longest time to sleep between retries
+org_api_requests_per_second = getenv("ORG_API_REQUESTS_PER_SECOND", 2) # sustained rate of Organizations API calls
+org_api_burst = getenv("ORG_API_BURST", 5) # number of Organizations API calls allowed in a burst
+org_rate_table_name = getenv("ORG_RATE_TABLE_NAME", "") # DynamoDB table holding the Organizations rate shared by concurrent invocations (empty = each invocation paces itself)
+backoff_base_seconds = getenv("BACKOFF_BASE_SECONDS", 0.5) # first backoff window when Organizations throttles a call
+attachment_concurrency = int(getenv("ATTACHMENT_CONCURRENCY", 4)) # number of attach/detach calls that can be in flight at once
+policy_catalog_ttl_seconds = getenv("POLICY_CATALOG_TTL_SECONDS", 0) # how long the backup policy catalog stays warm across invocations (0 = per invocation)
+prune_redundant_targets = getenv("PRUNE_REDUNDANT_TARGETS", "false") # skip targets already covered through a targeted parent OU or root
+org_tree_ttl_seconds = getenv("ORG_TREE_TTL_SECONDS", 3600) # how long the index of OUs and accounts stays warm across invocations
+checkpoint_margin_seconds = getenv("CHECKPOINT_MARGIN_SECONDS", 30) # time left before the function timeout at which no new call is started and the rest of the plan is checkpointed
+ledger_verify_seconds = getenv("LEDGER_VERIFY_SECONDS", 3600) # how long the ledger of what was last applied to a policy is trusted before the policy is read from Organizations again (0 = no ledger)
+max_message_size = 262144 # largest SQS message, in bytes, counting the body and every attribute name, type and value
+ledger_folder_name = "_ledger" # folder of the policy bucket that holds the ledgers, which is never a policy
 
 # instantiate a logging tool
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# create aws clients
-org_client = boto3.client('organizations')
-s3_client = boto3.client('s3')
-sqs_client = boto3.client('sqs')
+# aws clients are created on first use and then shared by every thread and warm invocation
+org_client = None
+s3_client = None
+sqs_client = None
+dynamodb_client = None
+client_lock = threading.Lock()
 
-# boolean to flag if backup policy files were deleted
-deletion_flag = False
+##################################################
+# Functions to create the AWS clients lazily so a
+# cold start only pays for the clients the
+# invocation actually uses. Connection pools are
+# sized for the attach/detach worker threads and
+# retries for Organizations are handled by
+# OrganizationsThrottle.
+##################################################
+def get_org_client():
+    global org_client
+
+    if org_client is None:
+        with client_lock:
+            if org_client is None:
+                org_client = boto3.client('organizations', config=Config(retries={'mode': 'standard', 'max_attempts': 1}, max_pool_connections=max(10, attachment_concurrency), connect_timeout=5, read_timeout=30, tcp_keepalive=True))
+    return org_client
+
+# end function get_org_client
+
+def get_s3_client():
+    global s3_client
+
+    if s3_client is None:
+        with client_lock:
+            if s3_client is None:
+                s3_client = boto3.client('s3', config=Config(retries={'mode': 'standard'}, max_pool_connections=max(10, attachment_concurrency), connect_timeout=5, read_timeout=30, tcp_keepalive=True))
+    return s3_client
+
+# end function get_s3_client
+
+def get_sqs_client():
+    global sqs_client
+
+    if sqs_client is None:
+        with client_lock:
+            if sqs_client is None:
+                sqs_client = boto3.client('sqs', config=Config(retries={'mode': 'standard'}, connect_timeout=5, read_timeout=30, tcp_keepalive=True))
+    return sqs_client
+
+# end function get_sqs_client
+
+def get_dynamodb_client():
+    global dynamodb_client
+
+    if dynamodb_client is None:
+        with client_lock:
+            if dynamodb_client is None:
+                dynamodb_client = boto3.client('dynamodb', config=Config(retries={'mode': 'standard'}, connect_timeout=5, read_timeout=10, tcp_keepalive=True))
+    return dynamodb_client
+
+# end function get_dynamodb_client
 
 ##################################################
-# Helper function to test if a proposed Backup
-# Policy exists within AWS Organizations.
+# Token bucket kept in memory, which paces the
+# calls of a single invocation. It is used when no
+# shared bucket is configured, and when the shared
+# bucket cannot be reached.
 ##################################################
-def test_policy_exists(policy_name):
+class LocalTokenBucket:
+
+    def __init__(self, requests_per_second, burst):
+        self.requests_per_second = float(requests_per_second)
+        self.burst = float(burst)
+
+        # the bucket starts full so the first calls of an invocation are not delayed
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+
+    # take up to count tokens; returns how many were granted, and how long to wait before trying again when there were none
+    def take(self, count):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.requests_per_second)
+        self.last_refill = now
+        if self.tokens < 1:
+            # time until the next token is refilled
+            return 0, (1 - self.tokens) / self.requests_per_second
+        granted = min(count, int(self.tokens))
+        self.tokens -= granted
+        return granted, 0
+
+# end class LocalTokenBucket
 
-    # boolean to check values and return
-    exists = False
-    
-    # set retry flag for re-processing purposes
-    retries = 0
-    
-    # add info the logs about what operation is being performed
-    logger.info(f"Checking if policy named {policy_name} exists.")
+##################################################
+# Token bucket kept in one DynamoDB item, which
+# paces the calls of every concurrent invocation
+# together, so their combined rate stays under the
+# Organizations limit instead of each invocation
+# finding the limit by being throttled. Tokens are
+# reserved ahead of the refill, up to one burst,
+# and the caller waits until they are refilled, so
+# every round trip to the table hands out
+# permits instead of polling it. Each write is
+# conditional on the item not having changed
+# since it was last seen, so two invocations never
+# spend the same tokens; the loser of a race
+# reads the item again.
+##################################################
+class SharedTokenBucket:
+
+    def __init__(self, table_name, requests_per_second, burst, metrics):
+        self.table_name = table_name
+        self.requests_per_second = float(requests_per_second)
+        self.burst = float(burst)
+        self.metrics = metrics
+        self.key = {'BucketId': {'S': 'organizations'}}
+
+        # the item as this invocation last read or wrote it; None until it is read
+        self.item = None
+
+    # reserve up to count tokens; returns how many were reserved and how long to wait before using them
+    def take(self, count):
+        while True:
+            if self.item is None:
+                self.item = self.metrics.call('dynamodb', get_dynamodb_client().get_item, TableName=self.table_name, Key=self.key, ConsistentRead=True).get('Item', {})
+            now = time.time()
+
+            # a bucket nobody has used yet is full
+            if 'RefilledAt' not in self.item:
+                tokens = self.burst
+                refilled_at = now
+                condition_expression = 'attribute_not_exists(BucketId)'
+                condition_values = {}
+            else:
+                # clocks differ between invocations, so the refill time never moves backwards
+                refilled_at = max(now, float(self.item['RefilledAt']['N']))
+                tokens = min(self.burst, float(self.item['Tokens']['N']) + (refilled_at - float(self.item['RefilledAt']['N'])) * self.requests_per_second)
+                condition_expression = 'RefilledAt = :seen_at AND Tokens = :seen_tokens'
+                condition_values = {':seen_at': self.item['RefilledAt'], ':seen_tokens': self.item['Tokens']}
 
-    # set to a None value, which is only replaced if processing works
-    policy_list = None
-    
-    # iterate until we max out; iterator set to value above max if processing is successful before max retries
-    while retries < retry_count:
-        # get the list of existing policies
-        try:
-            # sleep before starting attach since we might have concurrent operations occurring
-            time.sleep(sleep_time_seconds)
-            # get the list of existing backup policies
-            response = org_client.list_policies(Filter='BACKUP_POLICY')
-            policy_list = response['Policies']
-            while 'NextToken' in response:
-                response = org_client.list_policies(Filter='BACKUP_POLICY', NextToken=response['NextToken'])
-                policy_list.extend(response['Policies'])
-                
-            # if we got a real value/list, can stop execution
-            if policy_list is not None:
-                retries = retry_count + 1
-                
-        except Exception as e:
-            # known error situation
-            if re.search('TooManyRequestsException', str(e)):
-                retries += 1
-                logger.info(f"Organizations operations pending. Adding additional wait period for retry.")
-                # sleep to wait a bit longer
-                time.sleep(sleep_time_seconds)
-            else: 
-                retries += 1
-                logger.error(f"Error retrieving the list of existing backup policies. Exception is: {e}")
-            
+            # the bucket can go into debt by one burst at most; beyond that, wait until a token is paid back
+            granted = min(count, int(tokens + self.burst))
+            if granted < 1:
+                return 0, (1 - tokens - self.burst) / self.requests_per_second
+
+            try:
+                response = self.metrics.call('dynamodb', get_dynamodb_client().update_item,
+                    TableName=self.table_name,
+                    Key=self.key,
+                    UpdateExpression='SET Tokens = :tokens, RefilledAt = :refilled_at',
+                    ConditionExpression=condition_expression,
+                    ExpressionAttributeValues={':tokens': {'N': repr(tokens - granted)}, ':refilled_at': {'N': repr(refilled_at)}, **condition_values},
+                    ReturnValues='ALL_NEW'
+                )
+                self.item = response['Attributes']
+                # the reserved tokens can be used once the last of them is refilled
+                return granted, max(0, (granted - tokens) / self.requests_per_second)
+            except Exception as e:
+                # anything other than losing the race to another invocation goes back to the caller
+                if re.search('ConditionalCheckFailedException', str(e)) is None:
+                    raise
+                self.metrics.increment('RateBucketConflicts')
+                self.item = None
+
+# end class SharedTokenBucket
+
+##################################################
+# Shared retry and throttle component for calls
+# to AWS Organizations. Every call needs a permit
+# from a token bucket, which keeps the call rate
+# under the API limits, and calls are only retried
+# (with exponential backoff and full jitter) when
+# Organizations reports throttling, a concurrent
+# modification or a server error, or when the
+# connection fails or times out. The client makes
+# a single attempt, so these are all the retries a
+# call gets, and each one waits for a permit like
+# the first attempt. Permits from a shared bucket are
+# taken a few at a time to save round trips; if
+# the shared bucket fails, the invocation paces
+# itself instead. The time spent waiting is
+# tracked so it can be reported.
+##################################################
+class OrganizationsThrottle:
+
+    # errors that mean "try again later" rather than "this will never work"; only the first two are throttling
+    throttling_errors = 'TooManyRequestsException|ConcurrentModificationException'
+    retryable_errors = throttling_errors + '|ServiceException|InternalFailure|ServiceUnavailable'
+
+    # connection resets, refused connections and connect or read timeouts, which botocore would otherwise retry itself
+    retryable_exceptions = (BotocoreConnectionError, HTTPClientError)
+
+    def __init__(self, requests_per_second, burst, max_retries, base_backoff_seconds, max_backoff_seconds, metrics, shared_bucket=None, lease_size=1):
+        self.metrics = metrics
+        self.max_retries = int(max_retries)
+        self.base_backoff_seconds = float(base_backoff_seconds)
+        self.max_backoff_seconds = float(max_backoff_seconds)
+
+        # where permits come from, and the permits taken but not used yet
+        self.local_bucket = LocalTokenBucket(requests_per_second, burst)
+        self.shared_bucket = shared_bucket
+        self.lease_size = max(1, min(int(lease_size), int(float(burst))))
+        self.permits = 0
+        self.permits_ready_at = time.monotonic()
+        self.lock = threading.Lock()
+
+        # accounting for how the invocation spent its time
+        self.wait_seconds = 0.0
+        self.throttle_wait_seconds = 0.0
+        self.backoff_wait_seconds = 0.0
+        self.retries = 0
+
+    # block until a permit is available and ready to use
+    def acquire(self):
+        while True:
+            with self.lock:
+                if self.permits == 0:
+                    granted, wait = self.take_permits()
+                    self.permits = granted
+                    self.permits_ready_at = time.monotonic() + wait
+                has_permit = self.permits > 0
+                if has_permit:
+                    self.permits -= 1
+                wait = self.permits_ready_at - time.monotonic()
+            if wait > 0:
+                self.sleep(wait, backoff=False)
+            if has_permit:
+                return
+
+    # take permits from the shared bucket when there is one, otherwise one at a time from the local bucket
+    def take_permits(self):
+        if self.shared_bucket is not None:
+            try:
+                return self.shared_bucket.take(self.lease_size)
+            except Exception as e:
+                logger.error(f"Could not take permits from the shared Organizations rate in {self.shared_bucket.table_name}. This invocation paces itself from now on. Exception is: {e}")
+                self.shared_bucket = None
+        return self.local_bucket.take(1)
+
+    # sleep and record where the time went
+    def sleep(self, seconds, backoff):
+        time.sleep(seconds)
+        self.metrics.record_sleep(seconds)
+        with self.lock:
+            self.wait_seconds += seconds
+            if backoff:
+                self.backoff_wait_seconds += seconds
+            else:
+                self.throttle_wait_seconds += seconds
+
+    # call an Organizations operation, retrying only on transient errors
+    def call(self, operation, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                return self.metrics.call('organizations', operation, **kwargs)
+            except Exception as e:
+                # anything other than a known transient error goes straight back to the caller
+                if not isinstance(e, self.retryable_exceptions) and re.search(self.retryable_errors, str(e)) is None:
+                    raise
+                if re.search(self.throttling_errors, str(e)) is not None:
+                    self.metrics.record_throttle('organizations', operation)
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.metrics.record_retry('organizations', operation)
+                with self.lock:
+                    self.retries += 1
+                # full jitter: anywhere between zero and the exponential window, capped at the configured sleep time
+                backoff = random.uniform(0, min(self.max_backoff_seconds, self.base_backoff_seconds * (2 ** attempt)))
+                logger.info(f"Organizations call failed with a transient error. Retrying in {backoff:.2f} seconds (attempt {attempt} of {self.max_retries}). Exception is: {e}")
+                self.sleep(backoff, backoff=True)
+
+# end class OrganizationsThrottle
+
+# S3 errors that mean "try again later": a 5xx response or a request that took too long
+transient_s3_errors = 'SlowDown|InternalError|ServiceUnavailable|RequestTimeout|503'
+
+##################################################
+# Helper function to tell a failure that a retry
+# can fix, such as throttling, a 5xx response, or
+# a lost connection or timeout, from one that
+# needs the policy files or the organization to
+# change first, such as AccessDeniedException or
+# TargetNotFoundException.
+##################################################
+def is_transient_error(e):
+
+    return isinstance(e, OrganizationsThrottle.retryable_exceptions) or re.search(OrganizationsThrottle.retryable_errors + '|' + transient_s3_errors, str(e)) is not None
+
+# end function is_transient_error
+
+##################################################
+# Class holding the state for the processing of
+# one event: the configuration read from the
+# environment, the instrumentation and the
+# Organizations throttle shared by every AWS call,
+# and the mode of the event. A new context is made
+# for every event and passed to every helper, so
+# nothing leaks from one event into the next in a
+# warm container, and the policies in a batch can
+# be planned in parallel threads. It also holds
+# the Lambda context, which sets the deadline for
+# starting new Organizations writes. The policy
+# catalog and the OU index are deliberately kept
+# outside of it, as caches shared across events.
+##################################################
+class ProcessingContext:
+
+    def __init__(self, lambda_context=None, mode='Records', dry_run=False):
+        # fix string values from CloudFormation
+        self.retry_count = int(retry_count)
+        self.sleep_time_seconds = int(sleep_time_seconds)
+        self.prune_redundant_targets = str(prune_redundant_targets).lower() == 'true'
+        self.checkpoint_margin_milliseconds = float(checkpoint_margin_seconds) * 1000
+        self.ledger_verify_seconds = float(ledger_verify_seconds)
+
+        # the Lambda context tells how much time is left; without one there is no deadline
+        self.lambda_context = lambda_context
+        function_name = getattr(lambda_context, 'function_name', "OrgBackupPolicyManager")
+
+        # what kind of event is processed, and whether it may change anything
+        self.mode = mode
+        self.dry_run = dry_run
+
+        # policies that failed for a reason a retry cannot fix, so their records are not returned to the queue
+        self.rejected_policies = set()
+
+        # fresh instrumentation and throttle so the accounting covers this event only
+        self.metrics = InvocationMetrics(function_name)
+        shared_bucket = SharedTokenBucket(org_rate_table_name, org_api_requests_per_second, org_api_burst, self.metrics) if org_rate_table_name != "" else None
+        self.throttle = OrganizationsThrottle(org_api_requests_per_second, org_api_burst, self.retry_count, backoff_base_seconds, self.sleep_time_seconds, self.metrics, shared_bucket, attachment_concurrency)
+
+    # whether the function timeout is close enough that no new call should be started
+    def deadline_reached(self):
+        if not hasattr(self.lambda_context, 'get_remaining_time_in_millis'):
+            return False
+        return self.lambda_context.get_remaining_time_in_millis() < self.checkpoint_margin_milliseconds
+
+# end class ProcessingContext
+
+##################################################
+# Helper generator to page through a list call in
+# AWS Organizations. Each page is requested only
+# when the caller asks for more items, and goes
+# through the shared throttle, so a throttled page
+# is retried without restarting the listing.
+##################################################
+def paginate_org(processing_context, operation, result_key, **kwargs):
+
+    response = processing_context.throttle.call(operation, **kwargs)
+    yield from response[result_key]
+    while 'NextToken' in response:
+        response = processing_context.throttle.call(operation, NextToken=response['NextToken'], **kwargs)
+        yield from response[result_key]
+
+# end function paginate_org
+
+# name -> policy summary index of the backup policies in the organization, and when it was built
+policy_catalog = None
+policy_catalog_loaded_at = 0
+policy_catalog_lock = threading.Lock()
+
+##################################################
+# Helper function to get the name -> policy index
+# of every backup policy in the organization. The
+# index is built with one paginated listing and
+# then reused by every helper until it expires or
+# is invalidated.
+##################################################
+def get_policy_catalog(processing_context, refresh=False):
+
+    global policy_catalog
+    global policy_catalog_loaded_at
+
+    with policy_catalog_lock:
+        if policy_catalog is None or refresh == True:
+            logger.info(f"Building the backup policy catalog.")
+            # get the list of existing backup policies; throttling is retried by the shared throttle
+            policy_list = paginate_org(processing_context, get_org_client().list_policies, 'Policies', Filter='BACKUP_POLICY')
+            policy_catalog = {policy['Name']: policy for policy in policy_list}
+            policy_catalog_loaded_at = time.monotonic()
+
+        return policy_catalog
+
+# end function get_policy_catalog
+
+##################################################
+# Helper functions to keep the catalog in step
+# with the writes made by this function, so it
+# does not need to be rebuilt after every change.
+##################################################
+def update_policy_catalog(policy_summary):
+
+    with policy_catalog_lock:
+        if policy_catalog is not None:
+            policy_catalog[policy_summary['Name']] = policy_summary
+
+def remove_from_policy_catalog(policy_name):
+
+    with policy_catalog_lock:
+        if policy_catalog is not None:
+            policy_catalog.pop(policy_name, None)
+
+def invalidate_policy_catalog():
+
+    global policy_catalog
+
+    with policy_catalog_lock:
+        policy_catalog = None
+
+# a write that only has the ID, such as an attach, drops every name the catalog holds for it
+def remove_policy_id_from_catalog(policy_id):
+
+    with policy_catalog_lock:
+        if policy_catalog is not None:
+            for policy_name in [name for name, summary in policy_catalog.items() if summary['Id'] == policy_id]:
+                policy_catalog.pop(policy_name)
+
+# end catalog maintenance functions
+
+# index of the roots, OUs and accounts in the organization, and when it was built
+org_tree = None
+org_tree_loaded_at = 0
+org_tree_lock = threading.Lock()
+
+##################################################
+# Helper function to list the IDs of the OUs or
+# accounts directly below a root or OU.
+##################################################
+def list_child_ids(processing_context, parent_id, child_type):
+
+    return [child['Id'] for child in paginate_org(processing_context, get_org_client().list_children, 'Children', ParentId=parent_id, ChildType=child_type)]
+
+# end function list_child_ids
+
+##################################################
+# Helper function to get the index of the
+# organization's hierarchy: the parent of every OU
+# and account, the children of every root and OU,
+# and the set of accounts. It is built one level
+# at a time with paginated ListChildren calls and
+# kept warm across invocations, because the
+# hierarchy changes far less often than policies.
+##################################################
+def get_org_tree(processing_context, refresh=False):
+
+    global org_tree
+    global org_tree_loaded_at
+
+    with org_tree_lock:
+        if org_tree is None or refresh == True or time.monotonic() - org_tree_loaded_at > float(org_tree_ttl_seconds):
+            logger.info(f"Building the organization hierarchy index.")
+            tree = {'roots': [], 'parents': {}, 'children': {}, 'accounts': set()}
+            tree['roots'] = [root['Id'] for root in paginate_org(processing_context, get_org_client().list_roots, 'Roots')]
+
+            # walk down one level at a time; every level is listed in parallel behind the shared throttle
+            level = list(tree['roots'])
+            with ThreadPoolExecutor(max_workers=attachment_concurrency) as executor:
+                while len(level) > 0:
+                    ou_futures = {parent_id: executor.submit(list_child_ids, processing_context, parent_id, 'ORGANIZATIONAL_UNIT') for parent_id in level}
+                    account_futures = {parent_id: executor.submit(list_child_ids, processing_context, parent_id, 'ACCOUNT') for parent_id in level}
+                    next_level = []
+                    for parent_id in level:
+                        ou_ids = ou_futures[parent_id].result()
+                        account_ids = account_futures[parent_id].result()
+                        tree['children'][parent_id] = ou_ids + account_ids
+                        for child_id in ou_ids + account_ids:
+                            tree['parents'][child_id] = parent_id
+                        tree['accounts'].update(account_ids)
+                        next_level.extend(ou_ids)
+                    level = next_level
+
+            logger.info(f"Organization hierarchy index has {len(tree['children']) - len(tree['roots'])} OU(s) and {len(tree['accounts'])} account(s).")
+            org_tree = tree
+            org_tree_loaded_at = time.monotonic()
+
+        return org_tree
+
+# end function get_org_tree
+
+def invalidate_org_tree():
+
+    global org_tree
+
+    with org_tree_lock:
+        org_tree = None
+
+##################################################
+# Helper function to get the OUs and root above a
+# target, nearest first. Targets missing from the
+# index, such as an account created since it was
+# built, are looked up with ListParents.
+##################################################
+def get_target_ancestors(processing_context, target_id, tree):
+
+    ancestors = []
+
+    if target_id in tree['parents'] or target_id in tree['roots']:
+        parent_id = tree['parents'].get(target_id)
+        while parent_id is not None:
+            ancestors.append(parent_id)
+            parent_id = tree['parents'].get(parent_id)
+        return ancestors
 
     try:
-        # filter results to see if the 'Name' key exists in the list of policies provided
-        match = list(filter(lambda policy: policy['Name'] == policy_name, policy_list))
-        # if we get a match, set our boolean to True
-        if len(match) > 0:
-            exists = True
+        child_id = target_id
+        while True:
+            parents = list(paginate_org(processing_context, get_org_client().list_parents, 'Parents', ChildId=child_id))
+            if len(parents) == 0:
+                break
+            child_id = parents[0]['Id']
+            ancestors.append(child_id)
+            if parents[0]['Type'] == 'ROOT':
+                break
     except Exception as e:
-        logger.error(f"Encountered an issue trying to find policies. Exception is: {e}")
-    
-    # return whether or not match was found
-    return exists
+        # an unknown target is kept as it is; attaching it will report the problem
+        logger.error(f"Could not find the parents of target {target_id}. Exception is: {e}")
+
+    return ancestors
+
+# end function get_target_ancestors
+
+##################################################
+# Helper function to drop targets that a policy
+# already covers through a targeted OU or root
+# above them. Each dropped target saves a slow
+# attach call, and an existing direct attachment
+# to it is detached as redundant.
+##################################################
+def prune_covered_targets(processing_context, policy_name, targets):
+
+    tree = get_org_tree(processing_context)
+    pruned = []
+
+    def not_covered():
+        for target_id in targets:
+            if any(ancestor_id in targets for ancestor_id in get_target_ancestors(processing_context, target_id, tree)):
+                pruned.append(target_id)
+            else:
+                yield target_id
+    kept = TargetSet(not_covered())
+
+    if len(pruned) > 0:
+        logger.info(f"Policy {policy_name}: {len(pruned)} target(s) already covered through a parent OU or root are skipped: {pruned[:100]}")
+        processing_context.metrics.increment('Targets.pruned', len(pruned))
+
+    return kept
+
+# end function prune_covered_targets
+
+##################################################
+# Helper function to get the targets a policy is
+# planned against, pruned of redundant targets
+# when PRUNE_REDUNDANT_TARGETS is enabled.
+##################################################
+def select_desired_targets(processing_context, policy_name, targets):
 
-# end function test_policy_exists
+    if processing_context.prune_redundant_targets == True:
+        return prune_covered_targets(processing_context, policy_name, targets)
+    return targets
+
+# end function select_desired_targets
+
+##################################################
+# Helper function to list the accounts a set of
+# targets effectively covers: accounts targeted
+# directly, and every account below a targeted
+# OU or root.
+##################################################
+def get_effective_accounts(targets, tree):
+
+    accounts = set()
+    pending = list(targets)
+
+    while len(pending) > 0:
+        target_id = pending.pop()
+        if target_id in tree['children']:
+            pending.extend(tree['children'][target_id])
+        elif target_id in tree['accounts'] or re.search(r'^\d{12}$', target_id) is not None:
+            accounts.add(target_id)
+
+    return accounts
+
+# end function get_effective_accounts
 
 ##################################################
 # Helper function to get the data from an object 
 # in S3 and return the jsonified output for use 
-# with API calls.
+# with API calls. A missing object returns None;
+# any other error is raised, so a file that could
+# not be read is never mistaken for a deleted one.
 ##################################################
-def get_s3_file_content(s3_bucket, s3_key):
+def read_s3_json(processing_context, s3_bucket, s3_key):
 
-    # check to see if we expect deleted objects, then avoid processing with failures
-    if deletion_flag == True and target_list_file_name in s3_key:
+    try:
+        logger.info(f"Attempting to retrieve data from {s3_key}")
+        # get the data from our S3 object
+        file_content = processing_context.metrics.call('s3', get_s3_client().get_object, Bucket=s3_bucket, Key=s3_key)['Body'].read()
+    except Exception as e:
+        # anything other than a missing object is a real problem
+        if re.search('NoSuchKey|404|Not Found', str(e)) is None:
+            raise
+        logger.info(f"No data found for {s3_bucket}/{s3_key}.")
         return None
-    
-    # otherwise process to get S3 object data
-    else:
-        try:
-            logger.info(f"Attempting to retrieve data from {s3_key}")
-            # get the data from our S3 object
-            file_content = s3_client.get_object(Bucket=s3_bucket,Key=s3_key)['Body'].read()
-        except Exception as e:
-            # if we are supposed to be evaluating an object, but the key is empty, log the info
-            if deletion_flag == False:
-                logger.info(f"No data found for {s3_bucket}/{s3_key}.")
-            return None
-            
-        # return jsonified file stuff
-        return json.loads(file_content)
 
-# end function get_s3_file_content
+    # return jsonified file stuff
+    return json.loads(file_content)
+
+# end function read_s3_json
 
 ##################################################
-# Helper function to get the list of policies
-# and retrieve the ID of a policy when only 
-# given the name.
+# Helper function to read a target list from S3.
+# The object body is parsed as it streams in and
+# the IDs are kept in a compact TargetSet, so a
+# list of tens of thousands of accounts is never
+# held as one string. A missing object returns
+# None, like read_s3_json.
 ##################################################
-def get_policy_id(policy_name):
+def read_s3_target_list(processing_context, s3_bucket, s3_key):
 
-    
-    # get a list of all the org backup policies
     try:
-        response = org_client.list_policies(Filter='BACKUP_POLICY')
-        policy_list = response['Policies']
-        while 'NextToken' in response:
-            response = org_client.list_policies(Filter='BACKUP_POLICY', NextToken=response['NextToken'])
-            policy_list.extend(response['Policies'])
+        logger.info(f"Attempting to retrieve targets from {s3_key}")
+        response = processing_context.metrics.call('s3', get_s3_client().get_object, Bucket=s3_bucket, Key=s3_key)
     except Exception as e:
-        # return an empty value
-        policy_list = None
-        logger.error(f"Could not retrieve the list of current policies. Exception is: {e}")
-    
-    # assuming there are policies returned from our query, see if any match by name
-    if policy_list is not None:
-        # use filter for faster processing than iteration
-        matched_policy = list(filter(lambda policy: policy['Name'] == policy_name, policy_list))
-        # if there's a match, return the Id field
-        if len(matched_policy) > 0:
-            return matched_policy[0]['Id']
-        # otherwise return an empty value
-        else:
-            return None
-  # return empty value if all processing made it to here somehow
-    else:
+        if re.search('NoSuchKey|404|Not Found', str(e)) is None:
+            raise
+        logger.info(f"No data found for {s3_bucket}/{s3_key}.")
         return None
 
-# end function get_policy_id
+    targets = read_target_list(response['Body'])
+    logger.info(f"Read {len(targets)} target(s) from {s3_key}")
+    return targets
 
+# end function read_s3_target_list
 
 ##################################################
-# Helper function to get the list of targets that
-# a Backup Policy is attached to.
+# Helper generator to stream the IDs of the
+# targets that a Backup Policy is attached to,
+# one page at a time. Only the IDs are kept,
+# which is all the plan needs.
 ##################################################
-def get_attached_targets(policy_id):
-    
-    # query for list of targets of a given Policy Id
-    try:
-        response = org_client.list_targets_for_policy(PolicyId=policy_id)
-        target_list = response['Targets']
-        while 'NextToken' in response:
-            response = org_client.list_policies(PolicyId=policy_id, NextToken=response['NextToken'])
-            target_list.extend(response['Policies'])
-        
-    except Exception as e: 
-        # return an empty value
-        target_list = None
-        logger.info(f"No targets found for {policy_id}.")
-    
-    # return the list (or None) for attached targets
-    return target_list
-
-# end function get_attached_targets
+def iter_attached_target_ids(processing_context, policy_id):
+
+    # query for targets of a given Policy Id, loading the next page only when it is needed
+    for target in paginate_org(processing_context, get_org_client().list_targets_for_policy, 'Targets', PolicyId=policy_id):
+        yield target['TargetId']
+
+# end function iter_attached_target_ids
+
+# results of a call that did not make its change: 'failed' may work on a retry, 'rejected' will not
+failure_results = ('failed', 'rejected')
+
+##################################################
+# Helper function to classify a write that failed
+# on an existing policy. A policy deleted outside
+# this function since the plan was made, which a
+# warm catalog or a ledger can still list, is
+# dropped from the catalog and the write is
+# failed, so the retry plans the policy again
+# from what exists now.
+##################################################
+def get_write_failure(e, policy_id):
+
+    if re.search('PolicyNotFoundException', str(e)) is not None:
+        remove_policy_id_from_catalog(policy_id)
+        return 'failed'
+    return 'failed' if is_transient_error(e) else 'rejected'
+
+# end function get_write_failure
 
 ##################################################
 # Helper function to attach an AWS Organizations
 # Backup Policy to the targets provided in .json
 # target_list_file_name
 ##################################################
-def attach_backup_policy(target_id, policy_id):
+def attach_backup_policy(processing_context, target_id, policy_id):
 
-    
-    # set retry flag for re-processing purposes
-    retries = 0
-
-    # iterate until we max out; iterator set to value above max if processing is successful before max retries
-    while retries < retry_count:
-        try:
-            logger.info(f"Attaching policy {policy_id} to target {target_id}")
-            # sleep before starting attach since we might have concurrent operations occurring
-            time.sleep(sleep_time_seconds)
-            # attempt to attach the policy and capture response
-            response = org_client.attach_policy(TargetId=target_id,PolicyId=policy_id)
-
-            # if the operation succeeded, set the iterator above its max to end processing
-            if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-                retries = retry_count + 1
-        except Exception as e:
-            # known (but OK) exception is if policy is already attached, then we don't need to do anything else
-            if re.search('DuplicatePolicyAttachmentException', str(e)):
-                retries = retry_count + 1
-            # if processing did not complete, try again but log an error
-            else:
-                retries += 1
-                logger.error(f"Encountered a problem attaching Backup Policy {policy_id} to Target {target_id}. Exception is {e}")
+    try:
+        logger.info(f"Attaching policy {policy_id} to target {target_id}")
+        # attempt to attach the policy; throttling and concurrent operations are retried by the shared throttle
+        processing_context.throttle.call(get_org_client().attach_policy, TargetId=target_id, PolicyId=policy_id)
+        return 'attached'
+    except Exception as e:
+        # known (but OK) exception is if policy is already attached, then we don't need to do anything else
+        if re.search('DuplicatePolicyAttachmentException', str(e)) is not None:
+            return 'already_attached'
+        logger.error(f"Encountered a problem attaching Backup Policy {policy_id} to Target {target_id}. Exception is {e}")
+        return get_write_failure(e, policy_id)
 
 # end function attach_backup_policy
 
@@ -233,252 +752,1440 @@ def attach_backup_policy(target_id, policy_id):
 # update in the target definition list, or when
 # a policy itself is deleted.
 #################################################
-def detach_backup_policy(target_id, policy_id):
+def detach_backup_policy(processing_context, target_id, policy_id):
+
+    try:
+        logger.info(f"Detaching policy {policy_id} from target {target_id}")
+        # attempt to detach the policy; throttling and concurrent operations are retried by the shared throttle
+        processing_context.throttle.call(get_org_client().detach_policy, TargetId=target_id, PolicyId=policy_id)
+        return 'detached'
+    except Exception as e:
+        # known (but OK) exception is if policy is NOT attached, then we don't need to do anything else
+        if re.search('PolicyNotAttachedException', str(e)) is not None:
+            return 'not_attached'
+        logger.error(f"Encountered a problem detaching Backup Policy {policy_id} from Target {target_id}. Exception is {e}")
+        return get_write_failure(e, policy_id)
+
+# end function detach_backup_policy
+
+##################################################
+# Helper function to compare the targets a policy
+# should be attached to with the targets it is
+# attached to. Both sides are TargetSets, so IDs
+# are matched exactly with a binary search and the
+# targets that are already in place, usually
+# nearly all of them, take 8 bytes per account.
+# Existing IDs are classified in a single pass as
+# each page arrives. The returned plan attaches
+# OUs and roots before accounts.
+##################################################
+def plan_attachment_changes(desired_targets, existing_target_ids):
+
+    plan = {'to_attach': [], 'to_detach': []}
+
+    # the IDs the policy should be attached to, without duplicates
+    if not isinstance(desired_targets, TargetSet):
+        desired_targets = TargetSet(desired_targets)
+
+    # anything attached that is no longer desired needs to be detached
+    def still_desired():
+        for target_id in existing_target_ids:
+            if target_id in desired_targets:
+                yield target_id
+            else:
+                plan['to_detach'].append(target_id)
+    plan['unchanged'] = TargetSet(still_desired())
+
+    # anything desired that is not attached yet needs to be attached
+    plan['to_attach'] = [target_id for target_id in desired_targets if target_id not in plan['unchanged']]
+
+    return plan
+
+# end function plan_attachment_changes
+
+##################################################
+# Helper function to wait for submitted attach and
+# detach calls and summarize their outcome.
+# Targets that are already in place make no call
+# and are left out of the results.
+##################################################
+def collect_attachment_results(processing_context, futures, policy_id):
+
+    results = {}
+
+    for target_id, future in futures.items():
+        results[target_id] = future.result()
+        processing_context.metrics.increment(f"Targets.{results[target_id]}")
+
+    # summarize the outcome so failures stand out in the logs
+    failed = [target_id for target_id, result in results.items() if result in failure_results]
+    if len(failed) > 0:
+        logger.error(f"Policy {policy_id} could not be changed for {len(failed)} target(s): {failed}")
 
-    
-    # set retry flag for re-processing purposes
-    retries = 0
+    return results
 
-    # iterate until we max out; iterator set to value above max if processing is successful before max retries
-    while retries < retry_count:
+# end function collect_attachment_results
+
+##################################################
+# Helper function to delete an AWS Organizations
+# Backup Policy once its definition is gone and
+# it is detached from every target.
+##################################################
+def delete_backup_policy(processing_context, policy_name, policy_id):
+
+    try:
+        logger.info(f"Deleting policy called {policy_name}, policy ID {policy_id}")
+        # attempt to delete the policy; throttling and concurrent operations are retried by the shared throttle
+        processing_context.throttle.call(get_org_client().delete_policy, PolicyId=policy_id)
+        # a successful delete is authoritative, so drop the policy from the catalog instead of listing again
+        remove_from_policy_catalog(policy_name)
+        return True
+
+    # if processing did not complete, log an error
+    except Exception as e:
+        # a policy already deleted elsewhere is gone as planned, but the catalog may still list it
+        if re.search('PolicyNotFoundException', str(e)) is not None:
+            remove_from_policy_catalog(policy_name)
+            return True
+        logger.error(f"Encountered an issue deleting policy {policy_name}. Exception is: {e}")
+        return 'failed' if is_transient_error(e) else 'rejected'
+
+# end function delete_backup_policy
+
+##################################################
+# Helper function to hash a policy document in a
+# canonical form (sorted keys, no whitespace), so
+# documents that only differ in formatting or key
+# order produce the same hash.
+##################################################
+def get_policy_content_hash(policy_content):
+
+    canonical_content = json.dumps(policy_content, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical_content.encode('utf-8')).hexdigest()
+
+# end function get_policy_content_hash
+
+##################################################
+# Helper function to check whether the content of
+# an existing policy already matches a definition.
+# Only a read call is needed, so re-uploads of an
+# unchanged policy never trigger an update that
+# would spread to every attached account.
+##################################################
+def test_policy_content_matches(processing_context, policy_id, policy_content):
+
+    try:
+        response = processing_context.throttle.call(get_org_client().describe_policy, PolicyId=policy_id)
+        current_content = json.loads(response['Policy']['Content'])
+    except Exception as e:
+        logger.error(f"Could not retrieve the current content of policy {policy_id}. Exception is: {e}")
+        return False
+
+    return get_policy_content_hash(current_content) == get_policy_content_hash(policy_content)
+
+# end function test_policy_content_matches
+
+##################################################
+# Helper function to write the content of a
+# Backup Policy: update it when a policy ID is
+# given, otherwise create it. Returns the ID of
+# the policy, or 'failed' or 'rejected' if the
+# write failed.
+##################################################
+def put_backup_policy(processing_context, policy_name, policy_id, policy_json_data):
+
+    # if the policy has previously been created, but we have an update to the definition file, we want to update the policy content
+    if policy_id is not None:
+        try:
+            logger.info(f"Updating policy called {policy_name} with policy definition in {policy_definition_file_name}")
+            # attempt to update the policy; throttling and concurrent operations are retried by the shared throttle
+            response = processing_context.throttle.call(get_org_client().update_policy, Content=policy_json_data, Description=backup_policy_description, Name=policy_name, PolicyId=policy_id)
+            update_policy_catalog(response['Policy']['PolicySummary'])
+            return policy_id
+        # if processing did not complete, log an error
+        except Exception as e:
+            logger.error(f"Encountered an issue updating policy {policy_name}. Exception is: {e}")
+            return get_write_failure(e, policy_id)
+
+    # if the policy does NOT exist but we have a definition file updated, create the new policy
+    else:
         try:
-            logger.info(f"Detaching policy {policy_id} from target {target_id}")
-            # sleep before starting attach since we might have concurrent operations occurring
-            time.sleep(sleep_time_seconds)
-            # attempt to detach the policy and capture response
-            response = org_client.detach_policy(TargetId=target_id, PolicyId=policy_id)
-            # if the operation succeeded, set the iterator above its max to end processing
-            if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-                retries = retry_count + 1
+            logger.info(f"Creating backup policy called {policy_name} from policy definition in {policy_definition_file_name}")
+            # attempt to create the policy; throttling and concurrent operations are retried by the shared throttle
+            response = processing_context.throttle.call(get_org_client().create_policy, Content=policy_json_data, Description=backup_policy_description, Name=policy_name, Type='BACKUP_POLICY')
+            update_policy_catalog(response['Policy']['PolicySummary'])
+            return response['Policy']['PolicySummary']['Id']
+        # if processing did not complete, log an error
         except Exception as e:
-            # known (but OK) exception is if policy is NOT attached, then we don't need to do anything else
-            if re.search('PolicyNotAttachedException', str(e)) is not None:
-                retries = retry_count + 1
-            # if processing did not complete, try again but log an error
+            logger.error(f"Encountered an issue creating the Backup Policy. The Exception is: {e}")
+            # a warm catalog can miss a policy created elsewhere; rebuild it on the next lookup, so the retry updates that policy
+            if re.search('DuplicatePolicyException', str(e)):
+                invalidate_policy_catalog()
+                return 'failed'
+            return 'failed' if is_transient_error(e) else 'rejected'
+
+# end function put_backup_policy
+
+##################################################
+# Helper function to check policy files with the
+# same local validation S3PolicyMapper runs, so a
+# definition or target list that AWS Organizations
+# would reject never reaches the throttled write
+# path. The folder name is checked as well.
+##################################################
+def get_policy_file_errors(policy_name, policy_content, targets):
+
+    errors = [f"{policy_definition_file_name}: {error}" for error in validate_policy_content(policy_content)]
+    # a folder named like a part would be mistaken for a piece of another policy
+    if policy_name != get_logical_policy_name(policy_name):
+        errors.append("the policy folder name must not end in -partNN, which is used for the parts of large policies")
+    if policy_name == ledger_folder_name:
+        errors.append(f"the policy folder name {ledger_folder_name} is reserved for the ledgers of applied policies")
+    if targets is not None:
+        errors.extend(f"{target_list_file_name}: {error}" for error in targets.errors)
+    return errors
+
+# end function get_policy_file_errors
+
+# suffix of the sibling policies a large definition is split into
+policy_part_pattern = r'-part\d{2,}$'
+
+##################################################
+# Helper functions to map a policy folder to the
+# AWS Organizations policies it is written to. A
+# definition that fits in one policy keeps the
+# folder name; a larger one is split by plan into
+# <name>-part01, <name>-part02 and so on, which are
+# attached to the same targets and planned as one
+# logical policy. A <name>-partNN policy is only
+# taken for a part when this pipeline wrote it, so
+# a policy created by hand with such a name is
+# never detached or deleted as a leftover part.
+##################################################
+def get_logical_policy_name(policy_name):
+
+    return re.sub(policy_part_pattern, '', policy_name)
+
+def get_policy_parts(policy_name, policy_content):
+
+    parts = split_policy_content(policy_content)
+    if len(parts) == 1:
+        return {policy_name: parts[0]}
+
+    logger.info(f"Policy {policy_name} is larger than one policy allows and is split into {len(parts)} policies.")
+    return {f"{policy_name}-part{index:02d}": part for index, part in enumerate(parts, start=1)}
+
+def is_policy_part(policy_name, part_name, summary):
+
+    if part_name == policy_name:
+        return True
+    return get_logical_policy_name(part_name) == policy_name and summary.get('Description') == backup_policy_description
+
+def find_existing_parts(policy_name, catalog):
+
+    return {name: summary for name, summary in catalog.items() if is_policy_part(policy_name, name, summary)}
+
+# end policy part functions
+
+##################################################
+# Helper function to create one entry of a policy
+# plan. An entry holds the write to make to the
+# policy itself (create, update, delete or None)
+# and the attachment changes for its targets. A
+# plan is a list of entries built with read calls
+# only: it is the dry-run output, and the input to
+# apply_policy_plan.
+##################################################
+def new_plan_entry(policy_name, policy_id, action, policy_content, desired_targets, existing_target_ids):
+
+    entry = {'policy_name': policy_name, 'policy_id': policy_id, 'action': action, 'content': policy_content}
+    entry.update(plan_attachment_changes(desired_targets, existing_target_ids))
+    return entry
+
+# end function new_plan_entry
+
+##################################################
+# Helper function to describe a plan in a machine-
+# readable form for dry runs and logs: what will
+# happen to each policy and its targets, and the
+# totals for the whole plan.
+##################################################
+def describe_policy_plan(plan):
+
+    policies = []
+    for entry in plan:
+        policies.append({
+            'PolicyName': entry['policy_name'],
+            'LogicalPolicyName': get_logical_policy_name(entry['policy_name']),
+            'PolicyId': entry['policy_id'],
+            'Action': entry['action'],
+            'ContentHash': get_policy_content_hash(entry['content']) if entry['content'] is not None else None,
+            'Attach': entry['to_attach'],
+            'Detach': entry['to_detach'],
+            'Unchanged': len(entry['unchanged'])
+        })
+
+    summary = {
+        'Policies': len(plan),
+        'Create': len([entry for entry in plan if entry['action'] == 'create']),
+        'Update': len([entry for entry in plan if entry['action'] == 'update']),
+        'Delete': len([entry for entry in plan if entry['action'] == 'delete']),
+        'Attach': sum(len(entry['to_attach']) for entry in plan),
+        'Detach': sum(len(entry['to_detach']) for entry in plan)
+    }
+
+    return {'Summary': summary, 'Policies': policies}
+
+# end function describe_policy_plan
+
+##################################################
+# Helper function to start a call only while the
+# invocation has time left. Once the checkpoint
+# margin is reached, every call that has not
+# started yet is deferred to a continuation.
+##################################################
+def run_before_deadline(processing_context, function, *args):
+
+    if processing_context.deadline_reached() == True:
+        return 'deferred'
+    return function(processing_context, *args)
+
+# end function run_before_deadline
+
+##################################################
+# Function to apply a plan. Policy content is
+# written first, then the attach/detach calls of
+# every policy share one bounded thread pool, and
+# policies are only deleted once they are detached
+# everywhere. Parts of a split policy that are no
+# longer needed are only detached and deleted once
+# every new part of it is written and attached.
+# The shared throttle keeps the combined call rate
+# within the Organizations limits. Calls that
+# would start too close to the function timeout
+# are not made; what is left of the plan is
+# returned as a checkpoint so a continuation can
+# pick up at the next unfinished target. Returns
+# the names of the policies that could not be
+# fully reconciled, and the remaining plan. Those
+# that failed for a reason a retry cannot fix are
+# also added to the rejected policies of the
+# processing context.
+##################################################
+def apply_policy_plan(processing_context, plan):
+
+    failed_policies = set()
+
+    # policies with calls left over for a continuation
+    deferred_policies = set()
+
+    # a created policy only gets its ID once it is written
+    policy_ids = {entry['policy_name']: entry['policy_id'] for entry in plan}
+    written_policies = set()
+
+    # create and update policy content
+    writes = [entry for entry in plan if entry['action'] in ('create', 'update')]
+    with ThreadPoolExecutor(max_workers=attachment_concurrency) as executor:
+        futures = [executor.submit(run_before_deadline, processing_context, put_backup_policy, entry['policy_name'], entry['policy_id'], get_minified_policy(entry['content'])) for entry in writes]
+        for entry, future in zip(writes, futures):
+            policy_id = future.result()
+            if policy_id == 'deferred':
+                deferred_policies.add(entry['policy_name'])
+            elif policy_id in failure_results:
+                failed_policies.add(entry['policy_name'])
+                if policy_id == 'rejected':
+                    processing_context.rejected_policies.add(entry['policy_name'])
+            else:
+                # the entry keeps the ID of a created policy, so the ledger can record it
+                policy_ids[entry['policy_name']] = policy_id
+                entry['policy_id'] = policy_id
+                written_policies.add(entry['policy_name'])
+                processing_context.metrics.increment(f"Policies.{entry['action']}d")
+
+    # attach and detach targets for every policy that has an ID; a failed update still leaves the policy in place,
+    # but a deferred write holds back the attachments too, so they are not rolled out with the old content
+    attachable = [entry for entry in plan if policy_ids[entry['policy_name']] is not None and entry['policy_name'] not in deferred_policies]
+    results = {entry['policy_name']: {} for entry in attachable}
+
+    futures = {entry['policy_name']: {} for entry in attachable}
+    with ThreadPoolExecutor(max_workers=attachment_concurrency) as executor:
+        for entry in attachable:
+            futures[entry['policy_name']].update({target_id: executor.submit(run_before_deadline, processing_context, attach_backup_policy, target_id, policy_ids[entry['policy_name']]) for target_id in entry['to_attach']})
+    for entry in attachable:
+        results[entry['policy_name']].update(collect_attachment_results(processing_context, futures[entry['policy_name']], policy_ids[entry['policy_name']]))
+
+    # how far the new parts of each logical policy got: their content and their attachments
+    unfinished_parts = {}
+    for entry in plan:
+        if entry['action'] == 'delete':
+            continue
+        policy_results = results.get(entry['policy_name'], {}).values()
+        if entry['policy_name'] in failed_policies or any(result in failure_results for result in policy_results):
+            unfinished_parts.setdefault(get_logical_policy_name(entry['policy_name']), set()).add('failed')
+        if entry['policy_name'] in deferred_policies or 'deferred' in policy_results:
+            unfinished_parts.setdefault(get_logical_policy_name(entry['policy_name']), set()).add('deferred')
+
+    # parts that are no longer needed stay attached until every new part of the same logical policy is in place,
+    # so a failed or deferred part never leaves the targets without the rules it replaces
+    held_parts = [entry for entry in plan if entry['action'] == 'delete' and get_logical_policy_name(entry['policy_name']) in unfinished_parts]
+    for entry in held_parts:
+        if 'failed' in unfinished_parts[get_logical_policy_name(entry['policy_name'])]:
+            failed_policies.add(entry['policy_name'])
+        if 'deferred' in unfinished_parts[get_logical_policy_name(entry['policy_name'])]:
+            deferred_policies.add(entry['policy_name'])
+    held_names = {entry['policy_name'] for entry in held_parts}
+
+    # detach only once every attachment of the policy is in place, so a policy moving from accounts to their OU never leaves a gap;
+    # a policy with an attachment that failed keeps its old targets and is reported as failed, so the retry plans it again
+    detachable = [entry for entry in attachable if entry['policy_name'] not in held_names and not any(result in failure_results + ('deferred',) for result in results[entry['policy_name']].values())]
+    futures = {entry['policy_name']: {} for entry in detachable}
+    with ThreadPoolExecutor(max_workers=attachment_concurrency) as executor:
+        for entry in detachable:
+            futures[entry['policy_name']].update({target_id: executor.submit(run_before_deadline, processing_context, detach_backup_policy, target_id, policy_ids[entry['policy_name']]) for target_id in entry['to_detach']})
+    for entry in detachable:
+        results[entry['policy_name']].update(collect_attachment_results(processing_context, futures[entry['policy_name']], policy_ids[entry['policy_name']]))
+
+    for entry in attachable:
+        if any(result in failure_results for result in results[entry['policy_name']].values()):
+            failed_policies.add(entry['policy_name'])
+        if 'rejected' in results[entry['policy_name']].values():
+            processing_context.rejected_policies.add(entry['policy_name'])
+        if 'deferred' in results[entry['policy_name']].values():
+            deferred_policies.add(entry['policy_name'])
+
+    # delete the policies that are no longer attached anywhere
+    deletes = [entry for entry in plan if entry['action'] == 'delete' and entry['policy_name'] not in failed_policies | deferred_policies]
+    with ThreadPoolExecutor(max_workers=attachment_concurrency) as executor:
+        futures = [executor.submit(run_before_deadline, processing_context, delete_backup_policy, entry['policy_name'], entry['policy_id']) for entry in deletes]
+        for entry, future in zip(deletes, futures):
+            result = future.result()
+            if result == 'deferred':
+                deferred_policies.add(entry['policy_name'])
+            elif result == True:
+                processing_context.metrics.increment('Policies.deleted')
             else:
-                retries += 1
-                logger.error(f"Encountered a problem detaching Backup Policy {policy_id} from Target {target_id}. Exception is {e}")
+                failed_policies.add(entry['policy_name'])
+                if result == 'rejected':
+                    processing_context.rejected_policies.add(entry['policy_name'])
+
+    if len(failed_policies) > 0:
+        logger.error(f"{len(failed_policies)} policies could not be fully reconciled: {sorted(failed_policies)}")
+
+    # the checkpoint keeps every write and target of a deferred policy that is not done yet; failed targets are tried again
+    done_results = ['attached', 'already_attached', 'detached', 'not_attached']
+    remaining_plan = []
+    for entry in plan:
+        if entry['policy_name'] not in deferred_policies:
+            continue
+        policy_results = results.get(entry['policy_name'], {})
+        write_pending = entry['action'] in ('create', 'update') and entry['policy_name'] not in written_policies
+        remaining_plan.append({
+            'policy_name': entry['policy_name'],
+            'policy_id': policy_ids[entry['policy_name']],
+            'action': entry['action'] if write_pending or entry['action'] == 'delete' else None,
+            'content': entry['content'] if write_pending else None,
+            'to_attach': [target_id for target_id in entry['to_attach'] if policy_results.get(target_id) not in done_results],
+            'to_detach': [target_id for target_id in entry['to_detach'] if policy_results.get(target_id) not in done_results],
+            'unchanged': []
+        })
+
+    if len(remaining_plan) > 0:
+        logger.info(f"The function timeout is close. {len(remaining_plan)} policies are left for a continuation: {sorted(deferred_policies)}")
+
+    return sorted(failed_policies), remaining_plan
+
+# end function apply_policy_plan
 
-# end function detach_backup_policy
+##################################################
+# Helper function to tell from an Upload record
+# which part of a policy has to be reconciled.
+# S3PolicyMapper lists the policy files an upload
+# changed: only the targets, only the content, or
+# both. A record without the list reconciles both.
+##################################################
+def get_upload_action(attributes):
+
+    components = set(attributes.get('ChangedComponents', {}).get('stringValue', 'Definition,Targets').split(','))
+    if components == {'Targets'}:
+        return 'ReconcileTargets'
+    if components == {'Definition'}:
+        return 'ReconcileContent'
+    return 'Upload'
+
+# end function get_upload_action
+
+##################################################
+# Helper function to collapse all of the SQS
+# records in a batch into one unit of work per
+# policy. Records arrive grouped and ordered per
+# policy, and the most recent change decides what
+# kind of reconcile is needed.
+##################################################
+def coalesce_policy_records(records):
+
+    # ordered mapping of policy name to the merged work for that policy
+    policy_work = {}
+
+    for record in records:
+        # get the relevant info into variables
+        attributes = record['messageAttributes']
+        s3_bucket = attributes['Bucket']['stringValue']
+        updated_object = attributes['UpdatedObject']['stringValue']
+        action = attributes['Action']['stringValue']
+        policy_name = updated_object.split("/")[0]
+
+        # start a new entry the first time a policy is seen in the batch
+        work = policy_work.setdefault(policy_name, {
+            'policy_name': policy_name,
+            's3_bucket': s3_bucket,
+            'action': None,
+            'updated_object': updated_object,
+            'records': []
+        })
+        work['records'].append(record)
+
+        # a file was uploaded to S3 and processed by the child Lambda; the upload reconciles what it changed, and
+        # everything once the records merged for the policy changed different parts of it
+        if 'Upload' in action:
+            upload_action = get_upload_action(attributes)
+            work['action'] = upload_action if work['action'] in (None, upload_action) else 'Upload'
+            work['updated_object'] = updated_object
+        # a deleted policy definition always wins over anything that came before it
+        elif 'Delete' in action and policy_definition_file_name in updated_object:
+            work['action'] = 'DeletePolicy'
+            work['updated_object'] = updated_object
+        # a deleted target list only matters if the policy is not being (re)created or deleted anyway
+        elif 'Delete' in action and target_list_file_name in updated_object:
+            if work['action'] in (None, 'ReconcileTargets'):
+                work['action'] = 'ReconcileTargets'
+                work['updated_object'] = updated_object
+            # a checkpoint taken before the target list was deleted is out of date, and a content-only reconcile would miss it,
+            # so the policy is planned in full
+            elif work['action'] in ('Continue', 'ReconcileContent'):
+                work['action'] = 'Upload'
+        # a rollout cut short by the function timeout resumes from its checkpoint, unless something else in the batch plans the policy again anyway
+        elif 'Continue' in action:
+            if work['action'] in (None, 'Continue'):
+                work['action'] = 'Continue'
+                work['checkpoint'] = json.loads(record['body'])
+                work['updated_object'] = updated_object
+            # a reconcile of only the targets or only the content could drop the other half of the checkpoint
+            elif work['action'] in ('ReconcileTargets', 'ReconcileContent'):
+                work['action'] = 'Upload'
+        # even though the child Lambda should not send .zip deletions to the queue, extra check to skip it
+        elif 'Delete' in action and '.zip' in updated_object:
+            logger.info(f"Deleted file {updated_object} is .zip archive. Skipping processing.")
+
+    return list(policy_work.values())
+
+# end function coalesce_policy_records
+
+##################################################
+# Helper function to fingerprint the files of a
+# policy. A checkpoint records the fingerprint of
+# the files it was planned from, so a continuation
+# can tell whether they changed in the meantime.
+# The targets are fingerprinted by the digest of
+# their IDs rather than their text.
+##################################################
+def get_policy_files_fingerprint(policy_content, targets):
+
+    return get_policy_content_hash({'definition': policy_content, 'targets': targets.digest() if targets is not None else None})
+
+# end function get_policy_files_fingerprint
+
+##################################################
+# Helper function to turn the checkpoint carried
+# by a continuation back into a plan. Returns None
+# when the policy has to be planned again: the
+# checkpoint was too large to carry, or the policy
+# files changed after it was taken.
+##################################################
+def resume_checkpoint(work):
+
+    checkpoint = work['checkpoint']
+
+    if checkpoint.get('Plan') is None:
+        logger.info(f"Continuation for policy {work['policy_name']} carries no checkpoint. Planning the policy again.")
+        return None
+    if checkpoint.get('Fingerprint') != work['fingerprint']:
+        logger.info(f"Policy files for {work['policy_name']} changed after the checkpoint was taken. Planning the policy again.")
+        return None
+
+    plan = [dict(entry, unchanged=[]) for entry in checkpoint['Plan']]
+    logger.info(f"Resuming policy {work['policy_name']} from its checkpoint: {sum(len(entry['to_attach']) + len(entry['to_detach']) for entry in plan)} target(s) left.")
+    return plan
+
+# end function resume_checkpoint
+
+##################################################
+# Helper functions to read and write the ledger of
+# a policy: a record of what was last applied to
+# it, kept in the policy bucket as
+# <ledger folder>/<policy>.json. It holds the ID,
+# content hash and targets of every part, and when
+# the policy was last read from AWS Organizations.
+# A ledger read longer than ledger_verify_seconds
+# ago is not trusted, so drift made outside the
+# pipeline is picked up on that interval. Reading
+# returns the ledger if it can be trusted, and
+# whether there is one to delete.
+##################################################
+def get_ledger_key(policy_name):
+
+    return f"{ledger_folder_name}/{policy_name}.json"
+
+def read_policy_ledger(processing_context, s3_bucket, policy_name):
+
+    if processing_context.ledger_verify_seconds <= 0:
+        return None, False
+
+    # a ledger that cannot be read only costs the reads it would have saved, but it may still exist
+    try:
+        ledger = read_s3_json(processing_context, s3_bucket, get_ledger_key(policy_name))
+    except Exception as e:
+        logger.error(f"Could not read the ledger for policy {policy_name}. Reading the policy from AWS Organizations instead. Exception is: {e}")
+        return None, True
+
+    if ledger is None:
+        return None, False
+    age_seconds = time.time() - ledger['VerifiedAt']
+    if age_seconds > processing_context.ledger_verify_seconds:
+        logger.info(f"Ledger for policy {policy_name} was verified {age_seconds:.0f} seconds ago. Reading the policy from AWS Organizations again.")
+        return None, True
+    return ledger, True
+
+def write_policy_ledger(processing_context, s3_bucket, policy_name, parts, verified_at):
+
+    ledger = {'PolicyName': policy_name, 'Parts': parts, 'AppliedAt': time.time(), 'VerifiedAt': verified_at}
+    processing_context.metrics.call('s3', get_s3_client().put_object, Bucket=s3_bucket, Key=get_ledger_key(policy_name), Body=json.dumps(ledger).encode('utf-8'), ContentType='application/json')
+
+def delete_policy_ledger(processing_context, s3_bucket, policy_name):
+
+    processing_context.metrics.call('s3', get_s3_client().delete_object, Bucket=s3_bucket, Key=get_ledger_key(policy_name))
+
+# the policies with a ledger, from one listing of the ledger folder
+def list_policy_ledgers(processing_context, s3_bucket):
+
+    ledger_names = set()
+    list_args = {'Bucket': s3_bucket, 'Prefix': f"{ledger_folder_name}/"}
+
+    while True:
+        response = processing_context.metrics.call('s3', get_s3_client().list_objects_v2, **list_args)
+        for s3_object in response.get('Contents', []):
+            ledger_names.add(s3_object['Key'][len(list_args['Prefix']):].removesuffix('.json'))
+        if response.get('IsTruncated') != True:
+            break
+        list_args['ContinuationToken'] = response['NextContinuationToken']
+
+    return ledger_names
+
+# end ledger functions
+
+##################################################
+# Helper function to plan a policy against its
+# ledger instead of AWS Organizations: the content
+# hash of each part tells whether it needs an
+# update, and the recorded targets what to attach
+# and detach. The work is marked as planned this
+# way, so a failure sends it back to be read from
+# AWS Organizations. Returns None when a part is
+# missing from the ledger, because only the
+# catalog can tell whether a policy with that
+# name exists.
+##################################################
+def plan_from_ledger(processing_context, work, ledger, desired_parts, desired_targets):
+
+    recorded_parts = ledger['Parts']
+    if any(part_name not in recorded_parts for part_name in desired_parts):
+        return None
+
+    plan = []
+    for part_name, part_content in desired_parts.items():
+        recorded = recorded_parts[part_name]
+        # the hash costs nothing to compare, so the content is checked even when only the target list changed
+        action = None if recorded['ContentHash'] == get_policy_content_hash(part_content) else 'update'
+        plan.append(new_plan_entry(part_name, recorded['PolicyId'], action, part_content, desired_targets, recorded['Targets']))
+
+    # parts the policy no longer needs are detached and deleted
+    for part_name, recorded in recorded_parts.items():
+        if part_name not in desired_parts:
+            plan.append(new_plan_entry(part_name, recorded['PolicyId'], 'delete', None, [], recorded['Targets']))
+
+    logger.info(f"Planned policy {work['policy_name']} from its ledger, verified {time.time() - ledger['VerifiedAt']:.0f} seconds ago.")
+    processing_context.metrics.increment('PlannedFromLedger')
+    work['verified_at'] = ledger['VerifiedAt']
+    work['planned_from_ledger'] = True
+    return plan
+
+# end function plan_from_ledger
 
 ##################################################
-# Helper function to manage attach and detach of
-# Backup Policy from targets in AWS Organizations
-# based on file changes (create, update, delete)
-# to the Backup Policy definition or targets list.
+# Helper function to plan the reconcile of a
+# single policy once all of the records for it
+# are merged. The plan is driven by what is in S3
+# now rather than by the individual events, so a
+# burst of changes to one policy is applied as its
+# final state in a single pass. Calls that do not
+# depend on each other run side by side: the two
+# S3 reads with the catalog lookup, and the
+# content check of each part with the listing of
+# its targets, so planning takes about as long as
+# the longest chain of dependent calls. With a
+# recent ledger no Organizations reads are needed
+# at all, and a continuation picks up its
+# checkpoint while the policy files are unchanged.
+# Without a ledger, an upload that changed only
+# one of the policy files skips the reads for the
+# other: the content check of each part, or the
+# listing of its targets. Returns one plan entry
+# per policy part, and none when there is nothing
+# to do.
 ##################################################
-def update_backup_policy_attachments(s3_bucket, policy_name):
+def plan_policy_work(processing_context, work):
+
+    s3_bucket = work['s3_bucket']
+    policy_name = work['policy_name']
+    updated_object = work['updated_object']
 
-    # call the helper function to derive the Policy Id from a Name
-    policy_id = get_policy_id(policy_name)
+    # nothing in the records touched the policy files
+    if work['action'] is None:
+        return []
 
-    # construct the object location from parameters 
-    s3_file_location = policy_name + "/" + target_list_file_name
+    # helpful info into the logs up front about which policy it is
+    logger.info(f"Evaluating backup policy called {policy_name} from {len(work['records'])} record(s)")
+    processing_context.metrics.increment('PoliciesReconciled')
 
-    # get the information from the file
-    targets_json_data = get_s3_file_content(s3_bucket, s3_file_location)
+    # results of the content checks of existing parts, by part name
+    match_futures = {}
 
-    # get a list of targets the policy is already attached to
-    existing_target_list = get_attached_targets(policy_id)
+    with ThreadPoolExecutor(max_workers=attachment_concurrency) as executor:
+        content_future = executor.submit(read_s3_json, processing_context, s3_bucket, policy_name + "/" + policy_definition_file_name)
+        targets_future = executor.submit(read_s3_target_list, processing_context, s3_bucket, policy_name + "/" + target_list_file_name)
+        ledger_future = executor.submit(read_policy_ledger, processing_context, s3_bucket, policy_name)
 
-    # if we got a target definition file, process based on that
-    if targets_json_data is not None:
-        # iterate through all targets defined in the target definition .json
-        for target in targets_json_data['targets']:
-            # check for a match of the policy already assigned to the target
-            if existing_target_list is not None and re.search(f"/{target}", json.dumps(existing_target_list)) is not None:
-                logger.info(f"Target {target} already has policy {policy_name} attached.")
-            # if it is not already attached, but is found here, it should be - so call the attach helper function
+        # whether a ledger exists decides if there is one to delete once the plan is applied
+        ledger, work['ledger_found'] = ledger_future.result()
+
+        # a recent ledger stands in for the reads from Organizations; without one, look the policy and any parts it was split
+        # into up in the catalog while both files are read. A failed lookup is raised so the records are retried. A
+        # continuation only looks the policy up if its checkpoint cannot be used
+        if ledger is None and work['action'] != 'Continue':
+            work['verified_at'] = time.time()
+            catalog_future = executor.submit(get_policy_catalog, processing_context)
+
+        # a file that is empty or cannot be parsed is rejected like one that fails validation: a retry would read the same bytes
+        try:
+            policy_content = content_future.result()
+            targets = targets_future.result()
+        except ValueError as e:
+            logger.error(f"Policy {policy_name} could not be parsed and is left unchanged. Exception is: {e}")
+            processing_context.metrics.increment('PoliciesRejected')
+            return []
+        work['fingerprint'] = get_policy_files_fingerprint(policy_content, targets)
+
+        # a continuation only needs the policy files, to check that its checkpoint is still current
+        if work['action'] == 'Continue':
+            plan = resume_checkpoint(work)
+            if plan is not None:
+                return plan
+            if ledger is None:
+                work['verified_at'] = time.time()
+                catalog_future = executor.submit(get_policy_catalog, processing_context)
+
+        # without a definition in S3 the policy should not exist, whatever the events said
+        if policy_content is None:
+            logger.info(f"Policy definition file in S3 Bucket: {s3_bucket} for {policy_name} is gone (latest change: {updated_object}). Planning to detach targets and delete the policy.")
+            if ledger is not None:
+                return plan_from_ledger(processing_context, work, ledger, {}, [])
+            existing_parts = find_existing_parts(policy_name, catalog_future.result())
+            if len(existing_parts) == 0:
+                logger.info(f"Policy {policy_name} does not exist. Nothing to delete.")
+                return []
+            entry_futures = [executor.submit(new_plan_entry, part_name, summary['Id'], 'delete', None, [], iter_attached_target_ids(processing_context, summary['Id'])) for part_name, summary in existing_parts.items()]
+            return [future.result() for future in entry_futures]
+
+        # files that Organizations would reject are left alone rather than retried, like files that cannot be parsed; they need to be fixed and uploaded again
+        errors = get_policy_file_errors(policy_name, policy_content, targets)
+        if len(errors) > 0:
+            logger.error(f"Policy {policy_name} failed validation and is left unchanged. Problems found: {errors}")
+            processing_context.metrics.increment('PoliciesRejected')
+            return []
+
+        # a missing target definition file means the policy should not be attached anywhere
+        desired_targets = select_desired_targets(processing_context, policy_name, targets if targets is not None else TargetSet())
+        desired_parts = get_policy_parts(policy_name, policy_content)
+
+        if ledger is not None:
+            plan = plan_from_ledger(processing_context, work, ledger, desired_parts, desired_targets)
+            if plan is not None:
+                return plan
+            logger.info(f"Policy {policy_name} needs a part its ledger does not record. Reading the policy from AWS Organizations.")
+            work['verified_at'] = time.time()
+            catalog_future = executor.submit(get_policy_catalog, processing_context)
+
+        existing_parts = find_existing_parts(policy_name, catalog_future.result())
+
+        if work['action'] == 'ReconcileTargets':
+            logger.info(f"Target definition file in S3 Bucket: {s3_bucket} at key: {updated_object} changed. Reconciling targets only.")
+            # the content is not checked, so the ledger could not vouch for it
+            work['verified_at'] = None
+        elif work['action'] == 'ReconcileContent':
+            logger.info(f"Policy definition file in S3 Bucket: {s3_bucket} for {policy_name} changed and the target list did not. Reconciling content only.")
+            # the targets are not listed, so the ledger could not vouch for them
+            work['verified_at'] = None
+
+        entry_futures = []
+        for part_name, part_content in desired_parts.items():
+            policy_id = existing_parts[part_name]['Id'] if part_name in existing_parts else None
+
+            # a new policy is attached to all of its targets
+            if policy_id is None:
+                entry_futures.append(executor.submit(new_plan_entry, part_name, None, 'create', part_content, desired_targets, []))
+                continue
+
+            # if only the target list changed only the attachments are reconciled; otherwise the content is checked alongside the target listing
+            action = 'update'
+            if work['action'] == 'ReconcileTargets':
+                action = None
             else:
-                attach_backup_policy(target, policy_id)
-    # if we have no existing targets in the list, process based on that
-    if existing_target_list is not None:
-        # iterate through all the existing targets the policy is attached to
-        for target in existing_target_list:
-            # check for a match to see if the policy is attached to a target that is NOT in our target defintion .json and remove it
-            if existing_target_list is not None and (targets_json_data is None or re.search(target['TargetId'], str(targets_json_data['targets']))==None) :
-                detach_backup_policy(target['TargetId'], policy_id)
+                match_futures[part_name] = executor.submit(test_policy_content_matches, processing_context, policy_id, part_content)
+
+            # if only the definition changed the attachments of an existing part are left as they are
+            if work['action'] == 'ReconcileContent':
+                entry_futures.append(executor.submit(new_plan_entry, part_name, policy_id, action, part_content, [], []))
+                continue
+
+            # compare against the targets the policy is already attached to, page by page; writes wait
+            # until the plan is applied because attaching or detaching would shift the later pages
+            entry_futures.append(executor.submit(new_plan_entry, part_name, policy_id, action, part_content, desired_targets, iter_attached_target_ids(processing_context, policy_id)))
+
+        # parts left over from an earlier split are deleted once the new parts are attached, so no target is left uncovered
+        for part_name, summary in existing_parts.items():
+            if part_name not in desired_parts:
+                entry_futures.append(executor.submit(new_plan_entry, part_name, summary['Id'], 'delete', None, [], iter_attached_target_ids(processing_context, summary['Id'])))
+
+        plan = [future.result() for future in entry_futures]
 
-# end function update_backup_policy_attachments
+    # a part that already has exactly this definition keeps its content, and only its attachments are reconciled
+    for entry in plan:
+        if entry['policy_name'] in match_futures and match_futures[entry['policy_name']].result() == True:
+            logger.info(f"Policy {entry['policy_name']} already matches the definition in {policy_definition_file_name}. Skipping the update.")
+            entry['action'] = None
 
+    return plan
+
+# end function plan_policy_work
 
 ##################################################
-# Helper function to update an AWS Organizations
-# Backup Policy based on changes to a policy
-# definition. If a policy is deleted, it should
-# also delete the policy.
+# Helper function to delete the SQS messages for
+# records that were processed successfully. The
+# batch API accepts up to 10 entries per call.
 ##################################################
-def delete_backup_policy(s3_bucket, policy_name, existing_target_list):
-    
-    
-    # call the helper function to derive the Policy Id from a Name
-    policy_id = get_policy_id(policy_name)
+def delete_processed_messages(processing_context, records):
 
-    # if we have a list of attached targets, but the delete function is being called, detach them all
-    if existing_target_list is not None:
-        for target in existing_target_list:
-            time.sleep(sleep_time_seconds)
-            detach_backup_policy(target['TargetId'], policy_id)
+    for index in range(0, len(records), 10):
+        entries = [
+            {'Id': str(position), 'ReceiptHandle': record['receiptHandle']}
+            for position, record in enumerate(records[index:index + 10])
+        ]
+        try:
+            response = processing_context.metrics.call('sqs', get_sqs_client().delete_message_batch, QueueUrl=sqs_queue_url, Entries=entries)
+            for failure in response.get('Failed', []):
+                logger.error(f"Could not delete SQS message in position {failure['Id']}. Reason is: {failure.get('Message')}")
+        except Exception as e:
+            logger.error(f"Encountered an issue deleting processed SQS messages. Exception is: {e}")
 
-    # set retry flag for re-processing purposes
-    retries = 0
+# end function delete_processed_messages
 
-    # making sure we did not get a bogus policy ID
-    if policy_id is not None:
-        # iterate until we max out; iterator set to value above max if processing is successful before max retries
-        while retries < retry_count:
-            try:
-                logger.info(f"Deleting policy called {policy_name}, policy ID {policy_id}")
-                # sleep before starting attach since we might have concurrent operations occurring
-                time.sleep(sleep_time_seconds)
-                # attempt to delete the policy
-                org_client.delete_policy(PolicyId=policy_id)
+##################################################
+# Helper function to get the size of an SQS
+# message as SQS counts it against its limit: the
+# body, plus the name, data type and value of
+# every message attribute.
+##################################################
+def get_message_size(message_body, message_attributes):
+
+    attribute_text = "".join(name + attribute['DataType'] + attribute['StringValue'] for name, attribute in message_attributes.items())
+    return len(message_body.encode('utf-8')) + len(attribute_text.encode('utf-8'))
+
+# end function get_message_size
+
+##################################################
+# Helper function to queue a continuation for
+# every policy whose rollout was cut short by the
+# function timeout. The message carries what is
+# left of the plan for the policy, so the next
+# invocation resumes at the next unfinished target
+# without listing and sleeping through the
+# finished ones again. A checkpoint of None, or
+# one too large for an SQS message, makes the
+# next invocation plan the policy from scratch.
+# Returns the policies no continuation could be
+# queued for.
+##################################################
+def send_continuations(processing_context, checkpoints, policy_sources):
+
+    unsent_policies = []
+
+    for policy_name, checkpoint in checkpoints.items():
+        source = policy_sources[policy_name]
+        message_attributes = {
+            'Bucket': {
+                'DataType': 'String',
+                'StringValue': source['s3_bucket']
+            },
+            'UpdatedObject': {
+                'DataType': 'String',
+                'StringValue': policy_name
+            },
+            'Action': {
+                'DataType': 'String',
+                'StringValue': 'Continue'
+            }
+        }
+        message_body = json.dumps({'Fingerprint': source.get('fingerprint'), 'Plan': checkpoint})
+        if get_message_size(message_body, message_attributes) > max_message_size:
+            logger.info(f"Checkpoint for policy {policy_name} is too large for an SQS message. The continuation will plan the policy again.")
+            message_body = json.dumps({'Fingerprint': None, 'Plan': None})
+
+        try:
+            # the continuation joins the message group of the policy, so it runs after this invocation and before any later change
+            processing_context.metrics.call('sqs', get_sqs_client().send_message,
+                QueueUrl=sqs_queue_url,
+                MessageAttributes=message_attributes,
+                MessageGroupId=policy_name,
+                MessageDeduplicationId=uuid.uuid4().hex,
+                MessageBody=message_body
+            )
+            processing_context.metrics.increment('Continuations')
+        except Exception as e:
+            logger.error(f"Could not queue the continuation for policy {policy_name}. Exception is: {e}")
+            unsent_policies.append(policy_name)
+
+    return unsent_policies
+
+# end function send_continuations
+
+##################################################
+# Helper function to group the entries of a plan,
+# or what is left of one, by the policy folder
+# each entry belongs to.
+##################################################
+def group_plan_by_policy(plan):
 
-                # use our existing helper to make sure the policy no longer exists. If not, it was deleted and we can end processing
-                if test_policy_exists(policy_name) == False:
-                    retries = retry_count + 1
+    entries_by_policy = {}
+    for entry in plan:
+        entries_by_policy.setdefault(get_logical_policy_name(entry['policy_name']), []).append(entry)
+    return entries_by_policy
 
-            # if processing did not complete, try again but log an error
+# end function group_plan_by_policy
+
+##################################################
+# Helper function to bring the ledgers in line
+# with an applied plan. A policy whose plan was
+# applied in full records its parts as they are
+# now. Any other policy loses its ledger, so the
+# next change to it reads AWS Organizations again:
+# one that failed or was cut short, one deleted
+# from the bucket, and one planned without
+# checking its content.
+##################################################
+def update_policy_ledgers(processing_context, plan, failed_policies, remaining_plan, policy_sources):
+
+    if processing_context.ledger_verify_seconds <= 0:
+        return
+
+    unsettled_policies = {get_logical_policy_name(policy_name) for policy_name in failed_policies} | set(group_plan_by_policy(remaining_plan))
+
+    def update_ledger(policy_name, entries):
+        source = policy_sources[policy_name]
+        # a part that is kept is attached to the targets it already had and the ones just attached
+        parts = {entry['policy_name']: {'PolicyId': entry['policy_id'], 'ContentHash': get_policy_content_hash(entry['content']), 'Targets': list(entry['unchanged']) + entry['to_attach']} for entry in entries if entry['action'] != 'delete'}
+        if policy_name in unsettled_policies or source.get('verified_at') is None or len(parts) == 0:
+            # every delete leaves a delete marker in the versioned bucket, so a policy without a ledger is left alone
+            if source.get('ledger_found', True) == True:
+                delete_policy_ledger(processing_context, source['s3_bucket'], policy_name)
+        else:
+            write_policy_ledger(processing_context, source['s3_bucket'], policy_name, parts, source['verified_at'])
+
+    with ThreadPoolExecutor(max_workers=attachment_concurrency) as executor:
+        futures = {policy_name: executor.submit(update_ledger, policy_name, entries) for policy_name, entries in group_plan_by_policy(plan).items()}
+        for policy_name, future in futures.items():
+            try:
+                future.result()
             except Exception as e:
-                retries += 1
-                logger.error(f"Encountered an issue deleting policy {policy_name}. Exception is: {e}")
+                logger.error(f"Could not update the ledger for policy {policy_name}. Exception is: {e}")
 
-# end function update_backup_policy
+# end function update_policy_ledgers
 
 ##################################################
-# Helper function to create an AWS Organizations
-# Backup Policy using definitions provided by the
-# .json policy_definition_file_name
+# Helper function to list the files of every
+# policy folder in the policy bucket. Each key is
+# listed once, so the full sync knows which policy
+# files exist without a request per file.
 ##################################################
-def create_backup_policy(s3_bucket, policy_name):
+def list_policy_folders(processing_context, s3_bucket):
 
-    # derive the object location from parameters 
-    s3_file_location = policy_name + "/" + policy_definition_file_name
+    # mapping of policy name to the file names in its <policy>/ folder
+    policy_folders = {}
+    list_args = {'Bucket': s3_bucket}
 
-    # get the jsonified data required to pass to the API
-    policy_json_data = json.dumps(get_s3_file_content(s3_bucket, s3_file_location))
+    while True:
+        response = processing_context.metrics.call('s3', get_s3_client().list_objects_v2, **list_args)
+        for s3_object in response.get('Contents', []):
+            # only objects inside a <policy>/ folder belong to a policy; archives at the root and the ledgers are skipped
+            if '/' in s3_object['Key'] and s3_object['Key'].split('/')[0] != ledger_folder_name:
+                policy_name, file_name = s3_object['Key'].split('/', 1)
+                policy_folders.setdefault(policy_name, set()).add(file_name)
+        if response.get('IsTruncated') != True:
+            break
+        list_args['ContinuationToken'] = response['NextContinuationToken']
 
-    # see if the policy exists already
-    policy_exists = test_policy_exists(policy_name)
-    if policy_exists == True:
-        policy_id = get_policy_id(policy_name)
-    
-        
-    # set retry flag for re-processing purposes
-    retries = 0
+    return policy_folders
 
-    # if the policy has previously been created, but we have an update to the definition file, we want to update the policy content
-    if policy_exists == True and policy_json_data is not None:
-        # iterate until we max out; iterator set to value above max if processing is successful before max retries
-        while retries < retry_count:
+# end function list_policy_folders
+
+##################################################
+# Helper function to read the definition and
+# target list of one policy folder. Errors are
+# raised: a file that exists but cannot be read
+# must not be mistaken for a policy that should
+# be deleted.
+##################################################
+def read_policy_folder(processing_context, s3_bucket, policy_name, file_names):
+
+    desired = {'content': None, 'targets': TargetSet()}
+
+    if policy_definition_file_name in file_names:
+        desired['content'] = read_s3_json(processing_context, s3_bucket, policy_name + "/" + policy_definition_file_name)
+
+    targets = None
+    if target_list_file_name in file_names:
+        targets = read_s3_target_list(processing_context, s3_bucket, policy_name + "/" + target_list_file_name)
+
+    desired['fingerprint'] = get_policy_files_fingerprint(desired['content'], targets)
+
+    # a definition that fails validation is skipped by the sync like one that cannot be read
+    if desired['content'] is not None:
+        errors = get_policy_file_errors(policy_name, desired['content'], targets)
+        if len(errors) > 0:
+            processing_context.metrics.increment('PoliciesRejected')
+            raise ValueError(f"Policy files failed validation. Problems found: {errors}")
+
+    if targets is not None:
+        desired['targets'] = select_desired_targets(processing_context, policy_name, targets)
+
+    return desired
+
+# end function read_policy_folder
+
+##################################################
+# Helper function to read the desired state of
+# every policy in the bucket (or only the named
+# ones) in parallel. Returns the policies with a
+# definition and the policies that could not be
+# read.
+##################################################
+def load_desired_state(processing_context, s3_bucket, policy_names=None):
+
+    policy_folders = list_policy_folders(processing_context, s3_bucket)
+    if policy_names is not None:
+        policy_folders = {policy_name: file_names for policy_name, file_names in policy_folders.items() if policy_name in policy_names}
+
+    desired_state = {}
+    unreadable = []
+
+    with ThreadPoolExecutor(max_workers=attachment_concurrency) as executor:
+        futures = {policy_name: executor.submit(read_policy_folder, processing_context, s3_bucket, policy_name, file_names) for policy_name, file_names in policy_folders.items()}
+        for policy_name, future in futures.items():
             try:
-                logger.info(f"Updating policy called {policy_name} with policy definition in {policy_definition_file_name}")
-                # sleep before starting attach since we might have concurrent operations occurring
-                time.sleep(sleep_time_seconds)
-                # attempt to update the policy
-                response = org_client.update_policy(Content=policy_json_data,Description=backup_policy_description,Name=policy_name,PolicyId=policy_id)
-                # if the operation succeeded, set the iterator above its max to end processing
-                if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-                    retries = retry_count + 1
-            # if processing did not complete, try again but log an error
+                desired_state[policy_name] = future.result()
             except Exception as e:
-                retries += 1
-                logger.error(f"Encountered an issue updating policy {policy_name}. Exception is: {e}")
-    
-    # if the policy does NOT exist but we have a definition file updated, create the new policy
-    elif policy_exists == False and policy_json_data is not None:
-        # iterate until we max out; iterator set to value above max if processing is successful before max retries
-        while retries < retry_count:
-            try: 
-                logger.info(f"Creating backup policy called {policy_name} from policy definition in {policy_definition_file_name}")
-                # sleep before starting attach since we might have concurrent operations occurring
-                time.sleep(sleep_time_seconds)
-                # attempt to create the policy
-                response = org_client.create_policy(Content=policy_json_data,Description=backup_policy_description,Name=policy_name,Type='BACKUP_POLICY')
-                # if the operation succeeded, set the iterator above its max to end processing
-                if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-                    retries = retry_count + 1
-            
-            # if processing did not complete, try again but log an error
+                logger.error(f"Could not read the files for policy {policy_name}. The policy is skipped by this sync. Exception is: {e}")
+                unreadable.append(policy_name)
+
+    # a folder without a definition describes a policy that should not exist
+    desired_state = {policy_name: desired for policy_name, desired in desired_state.items() if desired['content'] is not None}
+    logger.info(f"Found {len(policy_folders)} policy folder(s) in {s3_bucket}, {len(desired_state)} with a policy definition.")
+
+    return desired_state, unreadable
+
+# end function load_desired_state
+
+##################################################
+# Helper function to read the current state of
+# the backup policies in one pass: the policy
+# catalog, the targets of every policy the sync
+# could change, and the content of every policy
+# that has a definition in S3. Only read calls are
+# made, in parallel behind the shared throttle.
+##################################################
+def take_organizations_snapshot(processing_context, desired_state, policy_names=None):
+
+    catalog = get_policy_catalog(processing_context, refresh=True)
+
+    # policies created outside this pipeline are left alone unless the bucket defines them; parts of a split policy go with it,
+    # but only the parts this pipeline wrote
+    relevant = {policy_name: summary for policy_name, summary in catalog.items() if is_policy_part(get_logical_policy_name(policy_name), policy_name, summary) and get_logical_policy_name(policy_name) in desired_state or summary.get('Description') == backup_policy_description}
+    if policy_names is not None:
+        relevant = {policy_name: summary for policy_name, summary in relevant.items() if get_logical_policy_name(policy_name) in policy_names}
+
+    def read_policy(policy_name, summary):
+        # the attached IDs of every policy are held until the plan is built, so they are kept compact
+        policy = {'summary': summary, 'targets': TargetSet(iter_attached_target_ids(processing_context, summary['Id'])), 'content_hash': None}
+        if get_logical_policy_name(policy_name) in desired_state:
+            response = processing_context.throttle.call(get_org_client().describe_policy, PolicyId=summary['Id'])
+            policy['content_hash'] = get_policy_content_hash(json.loads(response['Policy']['Content']))
+        return policy
+
+    snapshot = {}
+    unreadable = []
+
+    with ThreadPoolExecutor(max_workers=attachment_concurrency) as executor:
+        futures = {policy_name: executor.submit(read_policy, policy_name, summary) for policy_name, summary in relevant.items()}
+        for policy_name, future in futures.items():
+            try:
+                snapshot[policy_name] = future.result()
             except Exception as e:
-                retries += 1
-                logger.error(f"Encountered an issue creating the Backup Policy. The Exception is: {e}")
+                logger.error(f"Could not read the current state of policy {policy_name}. The policy is skipped by this sync. Exception is: {e}")
+                unreadable.append(policy_name)
+
+    logger.info(f"Snapshot of {len(snapshot)} backup policies taken from {len(catalog)} in the organization.")
 
-    # once the policy is updated, call the helper function to reconcile target attachment
-    update_backup_policy_attachments(s3_bucket, policy_name)
+    return snapshot, unreadable
 
-# end function create_backup_policy
+# end function take_organizations_snapshot
 
 ##################################################
-# Main Lambda handler function. Event trigger
-# should come from a SQS queue, which is populated
-# by a child Lambda function that parses updates
-# to backup policy files stored in S3.
+# Helper function to compute the changes needed to
+# bring every policy in line with the bucket. Only
+# policies created by this pipeline are deleted.
 ##################################################
-def lambda_handler(event, context):
+def build_sync_plan(desired_state, snapshot, skipped_policies):
 
-    # log beginning of the handler event
-    logger.info('event received: {}'.format(event))
+    plan = []
+
+    # a policy split into parts is skipped as a whole when any part of it could not be read
+    skipped_policies = {get_logical_policy_name(policy_name) for policy_name in skipped_policies}
+    planned_parts = set()
 
-    # get the receipt of the SQS message so we can delete it when finished processing
-    receipt_handle = event['Records'][0]['receiptHandle']
+    for policy_name, desired in desired_state.items():
+        if policy_name in skipped_policies:
+            continue
 
-    # get the relevant info into variables
-    s3_bucket = event['Records'][0]['messageAttributes']['Bucket']['stringValue']
-    updated_object = event['Records'][0]['messageAttributes']['UpdatedObject']['stringValue']
-    policy_name = updated_object.split("/")[0]
+        for part_name, part_content in get_policy_parts(policy_name, desired['content']).items():
+            planned_parts.add(part_name)
+            existing = snapshot.get(part_name)
 
-    # create a variable from the globalized value
-    global deletion_flag
-    global retry_count
-    global sleep_time_seconds
+            # a new policy is attached to all of its targets
+            if existing is None:
+                plan.append(new_plan_entry(part_name, None, 'create', part_content, desired['targets'], []))
+            else:
+                action = 'update' if existing['content_hash'] != get_policy_content_hash(part_content) else None
+                plan.append(new_plan_entry(part_name, existing['summary']['Id'], action, part_content, desired['targets'], existing['targets']))
 
-    # fix string values from CloudFormation
-    retry_count = int(retry_count)
-    sleep_time_seconds = int(sleep_time_seconds)
+    for policy_name, existing in snapshot.items():
+        if policy_name in planned_parts or get_logical_policy_name(policy_name) in skipped_policies:
+            continue
+        # a policy this pipeline created that is no longer in the bucket, or a part left over from an earlier split, is detached and deleted
+        plan.append(new_plan_entry(policy_name, existing['summary']['Id'], 'delete', None, [], existing['targets']))
 
-    # helpful info into the logs up front about which policy it is
-    logger.info(f"Evaluating backup policy called {policy_name}")
+    return plan
+
+# end function build_sync_plan
+
+##################################################
+# Function to reconcile the whole policy bucket
+# (or only the named policies) against AWS
+# Organizations in one pass. Corrects drift made
+# outside the pipeline, such as manual detaches or
+# deleted policies, without waiting for the policy
+# files to be uploaded again. A dry run returns the
+# plan without applying it.
+##################################################
+def full_sync(processing_context, s3_bucket, policy_names=None):
+
+    logger.info(f"Starting a full sync of backup policies in S3 Bucket: {s3_bucket}")
+
+    # desired state from S3 and current state from Organizations, both read in parallel
+    desired_state, unreadable_files = load_desired_state(processing_context, s3_bucket, policy_names)
+    verified_at = time.time()
+    snapshot, unreadable_policies = take_organizations_snapshot(processing_context, desired_state, policy_names)
+
+    # a policy that could not be read is left as it is rather than changed on partial information
+    skipped_policies = set(unreadable_files) | set(unreadable_policies)
+    plan = build_sync_plan(desired_state, snapshot, skipped_policies)
+
+    result = describe_policy_plan(plan)
+    result['Skipped'] = sorted(skipped_policies)
+    logger.info(f"Full sync plan: {json.dumps(result['Summary'])}")
+
+    if processing_context.dry_run == True:
+        result['DryRun'] = True
+        return result
+
+    result['Failed'], remaining_plan = apply_policy_plan(processing_context, plan)
 
-    # a file was uploaded to S3 and processed by the child Lambda
-    if 'Upload' in event['Records'][0]['messageAttributes']['Action']['stringValue']:
-        # be certain we are in "create" mode to avoid skipped processing
-        deletion_flag = False
-        # create the policy from uploaded definition (will update if it already exists)
+    # the ledgers that exist, so only those are deleted; a listing that fails only costs the deletes it would have saved
+    ledger_names = set()
+    if processing_context.ledger_verify_seconds > 0:
         try:
-            create_backup_policy(s3_bucket, policy_name)
+            ledger_names = list_policy_ledgers(processing_context, s3_bucket)
         except Exception as e:
-            logger.error(f"Failure occurred processing uploaded file. Event info is: {e}.")
-            raise
+            logger.error(f"Could not list the policy ledgers in {s3_bucket}. Exception is: {e}")
+            ledger_names = None
 
-    # a file was deleted from S3 and processed by the child Lambda
-    elif 'Delete' in event['Records'][0]['messageAttributes']['Action']['stringValue']:
-        # operate in "delete" mode to avoid errors and processing of things we know should be gone
-        deletion_flag = True
+    # every policy in the plan was just read from Organizations, so its ledger starts a new verify interval
+    update_policy_ledgers(processing_context, plan, result['Failed'], remaining_plan, {policy_name: {'s3_bucket': s3_bucket, 'verified_at': verified_at, 'ledger_found': ledger_names is None or policy_name in ledger_names} for policy_name in group_plan_by_policy(plan)})
 
-        # even though the child Lambda should not send .zip deletions to the queue, extra check to skip it
-        if '.zip' in updated_object:
-            logger.info(f"Deleted file is .zip archive. Skipping processing.")
-        
-        # otherwise we need to figure out if it was the targets definition or policy definition deleted
-        else:
+    # policies the sync ran out of time for continue through the queue like an interrupted upload
+    checkpoints = group_plan_by_policy(remaining_plan)
+    policy_sources = {policy_name: {'s3_bucket': s3_bucket, 'fingerprint': desired_state.get(policy_name, {}).get('fingerprint')} for policy_name in checkpoints}
+    unsent_policies = send_continuations(processing_context, checkpoints, policy_sources)
+    result['Continued'] = sorted(policy_name for policy_name in checkpoints if policy_name not in unsent_policies)
+    result['Failed'] = sorted(set(result['Failed']) | set(unsent_policies))
+    return result
+
+# end function full_sync
+
+##################################################
+# Function to answer which backup policies apply
+# to an account: the policies attached to the
+# account itself and to every OU and root above
+# it. One ListPoliciesForTarget call per level is
+# needed instead of a scan of every policy.
+##################################################
+def find_policies_for_account(processing_context, account_id):
+
+    tree = get_org_tree(processing_context)
+    policies = []
+
+    for target_id in [account_id] + get_target_ancestors(processing_context, account_id, tree):
+        for policy in paginate_org(processing_context, get_org_client().list_policies_for_target, 'Policies', TargetId=target_id, Filter='BACKUP_POLICY'):
+            policies.append({'PolicyName': policy['Name'], 'PolicyId': policy['Id'], 'AttachedTo': target_id, 'Inherited': target_id != account_id})
+
+    return {'AccountId': account_id, 'Policies': policies}
+
+# end function find_policies_for_account
+
+##################################################
+# Function to report the accounts each policy
+# effectively covers. By default every policy
+# created by this pipeline is reported.
+##################################################
+def report_policy_coverage(processing_context, policy_names=None):
+
+    tree = get_org_tree(processing_context)
+    catalog = get_policy_catalog(processing_context)
+
+    if policy_names is None:
+        reported = {policy_name: summary for policy_name, summary in catalog.items() if summary.get('Description') == backup_policy_description}
+    else:
+        reported = {policy_name: summary for policy_name, summary in catalog.items() if get_logical_policy_name(policy_name) in policy_names}
+
+    with ThreadPoolExecutor(max_workers=attachment_concurrency) as executor:
+        futures = {policy_name: executor.submit(lambda policy_id: list(iter_attached_target_ids(processing_context, policy_id)), summary['Id']) for policy_name, summary in reported.items()}
+
+        coverage = []
+        for policy_name, summary in reported.items():
+            targets = futures[policy_name].result()
+            accounts = get_effective_accounts(targets, tree)
+            coverage.append({'PolicyName': policy_name, 'PolicyId': summary['Id'], 'Targets': targets, 'AccountCount': len(accounts), 'Accounts': sorted(accounts)})
+
+    return {'Policies': coverage}
+
+# end function report_policy_coverage
+
+##################################################
+# Helper function to start processing an event:
+# make its processing context, and drop the
+# policy catalog unless it is kept warm.
+##################################################
+def start_invocation(event, context):
+
+    # the kind of event decides the mode; only these modes are known
+    mode = event.get('Action') if event.get('Action') in ('Coverage', 'FullSync') else 'Records'
+    processing_context = ProcessingContext(context, mode, event.get('DryRun') == True)
+
+    # the policy catalog is only kept warm across invocations when a TTL is configured
+    if float(policy_catalog_ttl_seconds) <= 0 or time.monotonic() - policy_catalog_loaded_at > float(policy_catalog_ttl_seconds):
+        invalidate_policy_catalog()
+
+    return processing_context
+
+# end function start_invocation
+
+##################################################
+# Helper function to log where the time went and
+# emit the metrics for the invocation.
+##################################################
+def finish_invocation(processing_context, context):
+
+    throttle = processing_context.throttle
+
+    # report where the time went so slow rollouts can be explained
+    logger.info(f"Organizations throttle waited {throttle.wait_seconds:.2f} seconds ({throttle.throttle_wait_seconds:.2f} rate limiting, {throttle.backoff_wait_seconds:.2f} backoff over {throttle.retries} retries).")
+    processing_context.metrics.emit({
+        'RequestId': getattr(context, 'aws_request_id', None),
+        'Mode': processing_context.mode,
+        'DryRun': processing_context.dry_run,
+        'ThrottleWaitSeconds': round(throttle.throttle_wait_seconds, 3),
+        'BackoffWaitSeconds': round(throttle.backoff_wait_seconds, 3)
+    })
+
+# end function finish_invocation
+
+##################################################
+# Helper function to plan every policy in a batch
+# in parallel. Each policy only reads its own
+# files and policies, and all of them share the
+# throttle of the processing context. Returns the
+# combined plan, the records that could not be
+# planned but may be on a retry, and the policies
+# that were not planned because the function
+# timeout is close. A policy that cannot be
+# planned for a reason a retry cannot fix is added
+# to the rejected policies of the processing
+# context instead.
+##################################################
+def plan_batch(processing_context, policy_work):
+
+    plan = []
+    failed_records = []
+    deferred_policies = []
+
+    with ThreadPoolExecutor(max_workers=attachment_concurrency) as executor:
+        futures = [executor.submit(run_before_deadline, processing_context, plan_policy_work, work) for work in policy_work]
+        # results are collected in batch order, so the plan does not depend on which thread finished first
+        for work, future in zip(policy_work, futures):
             try:
-                # if it is the target list, we just want to reconcile the attachments with the updated targets
-                if target_list_file_name in updated_object:
-                    logger.info(f"Target definition file in S3 Bucket: {s3_bucket} at key: {updated_object} deleted.") 
-                    update_backup_policy_attachments(s3_bucket, policy_name)
-
-                # if the policy file is deleted, we want to delete the policy, too
-                elif policy_definition_file_name in updated_object:
-                    logger.info(f"Policy definition file in S3 Bucket: {s3_bucket} at key: {updated_object} deleted. Attempting to detach targets and delete the policy.")
-                    delete_backup_policy(s3_bucket, policy_name, get_attached_targets(get_policy_id(policy_name)))
+                result = future.result()
+                if result == 'deferred':
+                    deferred_policies.append(work['policy_name'])
+                else:
+                    plan.extend(result)
             except Exception as e:
-                logger.error(f"Exception occurred with processing deleted object. Exception is: {e}")
+                logger.error(f"Failure occurred processing backup policy {work['policy_name']}. Exception is: {e}.")
+                # a policy deleted elsewhere since the warm catalog was built is planned again from a new catalog on the retry
+                if re.search('PolicyNotFoundException', str(e)) is not None:
+                    invalidate_policy_catalog()
+                    failed_records.extend(work['records'])
+                elif is_transient_error(e):
+                    failed_records.extend(work['records'])
+                else:
+                    processing_context.rejected_policies.add(work['policy_name'])
+
+    return plan, failed_records, deferred_policies
 
-    # after everything is processed, delete the SQS message
-    sqs_client.delete_message(
-        QueueUrl = sqs_queue_url,
-        ReceiptHandle = receipt_handle
-    )
+# end function plan_batch
+
+##################################################
+# Main Lambda handler function. Event trigger
+# should come from a SQS queue, which is populated
+# by a child Lambda function that parses updates
+# to backup policy files stored in S3. Every
+# policy in the batch is planned in parallel and
+# the combined plan is applied in one pass;
+# records that fail are returned as a partial
+# batch response so only they are retried. Work
+# left when the timeout nears is handed on in
+# continuation messages on the same queue. A
+# scheduled event with {"Action": "FullSync",
+# "Bucket": ...} reconciles the whole bucket
+# instead. Either event can set "DryRun": true to
+# get the plan without applying it. {"Action":
+# "Coverage"} reports the accounts each policy
+# covers, or with an "AccountId" the policies that
+# apply to that account.
+##################################################
+def lambda_handler(event, context):
+
+    processing_context = start_invocation(event, context)
+
+    # report which policies apply to an account, or which accounts each policy covers
+    if processing_context.mode == 'Coverage':
+        try:
+            if event.get('AccountId') is not None:
+                result = find_policies_for_account(processing_context, event['AccountId'])
+            else:
+                result = report_policy_coverage(processing_context, event.get('Policies'))
+        finally:
+            finish_invocation(processing_context, context)
+        return result
+
+    # scheduled reconcile of every policy in the bucket
+    if processing_context.mode == 'FullSync':
+        try:
+            result = full_sync(processing_context, event['Bucket'], event.get('Policies'))
+        finally:
+            finish_invocation(processing_context, context)
+        return result
+
+    records = event['Records']
+
+    # log beginning of the handler event
+    logger.info(f"Event received with {len(records)} record(s): {[record['messageId'] for record in records]}")
+
+    # merge the records so each policy is only planned once per batch
+    policy_work = coalesce_policy_records(records)
+    plan, failed_records, deferred_policies = plan_batch(processing_context, policy_work)
+
+    # records that can be removed from the queue
+    failed_message_ids = {record['messageId'] for record in failed_records}
+    processed_records = [record for work in policy_work for record in work['records'] if record['messageId'] not in failed_message_ids]
+
+    plan_description = describe_policy_plan(plan)
+    logger.info(f"Plan for {len(records)} record(s): {json.dumps(plan_description['Summary'])}")
+
+    # a dry run changes nothing and leaves the messages alone
+    if processing_context.dry_run == True:
+        finish_invocation(processing_context, context)
+        plan_description['DryRun'] = True
+        return plan_description
+
+    # apply the plan for every policy in the batch together
+    try:
+        failed_policies, remaining_plan = apply_policy_plan(processing_context, plan)
+        policy_sources = {work['policy_name']: work for work in policy_work}
+        update_policy_ledgers(processing_context, plan, failed_policies, remaining_plan, policy_sources)
+
+        # policies that ran out of time continue in a new message; policies that were not planned at all are planned again there
+        checkpoints = {policy_name: None for policy_name in deferred_policies}
+        checkpoints.update(group_plan_by_policy(remaining_plan))
+        unsent_policies = send_continuations(processing_context, checkpoints, policy_sources)
+
+        # a policy with a failed write is retried from its records, unless a continuation already carries what is left of it;
+        # its ledger is gone by now, so a policy planned from an out-of-date ledger is planned from Organizations the next time
+        continued_policies = set(checkpoints) - set(unsent_policies)
+        rejected_names = {get_logical_policy_name(policy_name) for policy_name in processing_context.rejected_policies}
+        failed_names = {get_logical_policy_name(policy_name) for policy_name in failed_policies} - continued_policies - rejected_names
+
+        # a retry cannot fix a rejected policy and would only hold up the later changes to it, so its records are removed
+        if len(rejected_names) > 0:
+            logger.error(f"{len(rejected_names)} policies failed for a reason a retry cannot fix and are not retried: {sorted(rejected_names)}. Fix the cause and upload the policy files again.")
+            processing_context.metrics.increment('PoliciesFailedPermanently', len(rejected_names))
+
+        # without a continuation the records themselves have to come back
+        retried_message_ids = {record['messageId'] for work in policy_work if work['policy_name'] in set(unsent_policies) | failed_names for record in work['records']}
+        failed_records.extend(record for record in processed_records if record['messageId'] in retried_message_ids)
+        processed_records = [record for record in processed_records if record['messageId'] not in retried_message_ids]
+    except Exception as e:
+        logger.error(f"Failure occurred applying the plan for the batch. Exception is: {e}.")
+        failed_records.extend(processed_records)
+        processed_records = []
+
+    # after everything is processed, delete the SQS messages that succeeded
+    delete_processed_messages(processing_context, processed_records)
+
+    processing_context.metrics.increment('RecordsReceived', len(records))
+    processing_context.metrics.increment('RecordsFailed', len(failed_records))
+    finish_invocation(processing_context, context)
+
+    # report the records that failed so only they are made visible again on the queue
+    return {
+        'batchItemFailures': [{'itemIdentifier': record['messageId']} for record in failed_records]
+    }
 
 # end of function lambda_handler
+
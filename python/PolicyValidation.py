@@ -0,0 +1,204 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains the local validation of backup policy definitions shared by
+# the S3PolicyMapper and OrgBackupPolicyManager Lambda functions, and the formats
+# of the target IDs that TargetLists checks target lists against
+
+import json # minified policy documents
+import re # ID and name formats
+from os import getenv # environment variables
+
+max_policy_size = int(getenv("MAX_POLICY_SIZE", 10000)) # largest backup policy document AWS Organizations accepts, in characters
+
+# formats of the IDs a backup policy can be attached to
+target_id_patterns = [
+    r'^\d{12}$', # account
+    r'^ou-[0-9a-z]{4,32}-[a-z0-9]{8,32}$', # organizational unit
+    r'^r-[0-9a-z]{4,32}$' # root
+]
+
+# inheritance operators that can appear as keys in a backup policy
+policy_operators = ['@@assign', '@@append', '@@remove', '@@operators_allowed_for_child_policies']
+
+# settings a backup plan can hold
+plan_keys = ['regions', 'rules', 'selections', 'advanced_backup_settings', 'backup_plan_tags']
+
+# kinds of resource selection in a backup plan
+selection_keys = ['tags', 'resources']
+
+# names of plans, rules and selections
+name_pattern = r'^[a-zA-Z0-9\-\_\.]{1,50}$'
+
+# AWS Region names used in the regions setting
+region_pattern = r'^[a-z]{2}(-[a-z]+)+-\d+$'
+
+##################################################
+# Helper function to render a policy document the
+# way it is sent to AWS Organizations: without
+# whitespace, which is what the size limit is
+# measured against.
+##################################################
+def get_minified_policy(policy_content):
+
+    return json.dumps(policy_content, separators=(',', ':'))
+
+# end function get_minified_policy
+
+##################################################
+# Helper function to split a policy that is too
+# large for one document into several, each with
+# a share of the plans. Plans are packed in name
+# order, so the same definition always produces
+# the same parts. Inheritance operators on the
+# plans object are copied into every part.
+##################################################
+def split_policy_content(policy_content):
+
+    if len(get_minified_policy(policy_content)) <= max_policy_size:
+        return [policy_content]
+
+    plans = policy_content['plans']
+    shared = {key: value for key, value in plans.items() if key in policy_operators}
+
+    parts = []
+    part_plans = {}
+    for plan_name in sorted(key for key in plans if key not in policy_operators):
+        candidate = {**part_plans, plan_name: plans[plan_name]}
+        # start a new part once the next plan would not fit; a plan too large on its own is caught by validation
+        if len(part_plans) > 0 and len(get_minified_policy({'plans': {**shared, **candidate}})) > max_policy_size:
+            parts.append(part_plans)
+            candidate = {plan_name: plans[plan_name]}
+        part_plans = candidate
+    parts.append(part_plans)
+
+    return [{'plans': {**shared, **part}} for part in parts]
+
+# end function split_policy_content
+
+##################################################
+# Helper function to check that every key that
+# looks like an inheritance operator is one that
+# AWS Organizations knows.
+##################################################
+def check_operators(value, path, errors):
+
+    if isinstance(value, dict):
+        for key, child in value.items():
+            if key.startswith('@@') and key not in policy_operators:
+                errors.append(f"{path}: unknown operator {key}")
+            check_operators(child, f"{path}.{key}", errors)
+    elif isinstance(value, list):
+        for child in value:
+            check_operators(child, path, errors)
+
+# end function check_operators
+
+##################################################
+# Helper function to check a map of named blocks,
+# such as the rules of a plan: it has to be an
+# object whose entries are objects with valid
+# names.
+##################################################
+def check_named_blocks(blocks, path, errors):
+
+    if not isinstance(blocks, dict):
+        errors.append(f"{path} must be an object")
+        return
+
+    for name, block in blocks.items():
+        if name in policy_operators:
+            continue
+        if re.search(name_pattern, name) is None:
+            errors.append(f"{path}: name {name} must be 1 to 50 letters, numbers, hyphens, underscores or periods")
+        if not isinstance(block, dict):
+            errors.append(f"{path}.{name} must be an object")
+
+# end function check_named_blocks
+
+##################################################
+# Function to validate a backup policy definition
+# against the backup policy syntax and the policy
+# size limit. A policy over the limit is split by
+# plan, so only a single plan has to fit in one
+# document. Returns a list of problems, which is
+# empty when the definition can be sent to AWS
+# Organizations.
+##################################################
+def validate_policy_content(policy_content):
+
+    errors = []
+
+    # the document is a single object holding the plans
+    if not isinstance(policy_content, dict):
+        return ["the policy definition must be a JSON object"]
+    for key in policy_content:
+        if key != 'plans':
+            errors.append(f"unknown top-level key {key}; a backup policy only holds plans")
+
+    plans = policy_content.get('plans')
+    if not isinstance(plans, dict) or len(plans) == 0:
+        errors.append("the policy definition must have a non-empty plans object")
+        plans = {}
+    check_named_blocks(plans, 'plans', errors)
+
+    for plan_name, plan in plans.items():
+        if not isinstance(plan, dict):
+            continue
+        path = f"plans.{plan_name}"
+        for key in plan:
+            if key not in plan_keys and key not in policy_operators:
+                errors.append(f"{path}: unknown setting {key}")
+
+        # every region in the plan has to look like an AWS Region
+        regions = plan.get('regions', {})
+        if not isinstance(regions, dict):
+            errors.append(f"{path}.regions must be an object")
+        else:
+            for operator in ['@@assign', '@@append', '@@remove']:
+                region_list = regions.get(operator, [])
+                if not isinstance(region_list, list) or any(not isinstance(region, str) or re.search(region_pattern, region) is None for region in region_list):
+                    errors.append(f"{path}.regions.{operator} must be a list of AWS Region names")
+
+        if 'rules' in plan:
+            check_named_blocks(plan['rules'], f"{path}.rules", errors)
+
+        if 'selections' in plan:
+            selections = plan['selections']
+            if not isinstance(selections, dict):
+                errors.append(f"{path}.selections must be an object")
+            else:
+                for key, blocks in selections.items():
+                    if key in policy_operators:
+                        continue
+                    if key not in selection_keys:
+                        errors.append(f"{path}.selections: unknown selection type {key}")
+                    else:
+                        check_named_blocks(blocks, f"{path}.selections.{key}", errors)
+
+    check_operators(policy_content, 'policy', errors)
+
+    # Organizations measures the size of the document it stores, so measure it without whitespace
+    shared = {key: value for key, value in plans.items() if key in policy_operators}
+    for plan_name, plan in plans.items():
+        if plan_name in policy_operators:
+            continue
+        plan_size = len(get_minified_policy({'plans': {**shared, plan_name: plan}}))
+        if plan_size > max_policy_size:
+            errors.append(f"plans.{plan_name} is {plan_size} characters when minified, more than the {max_policy_size} AWS Organizations allows in one policy")
+
+    return errors
+
+# end function validate_policy_content
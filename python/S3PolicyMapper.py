@@ -17,119 +17,449 @@
 # cloudformation resource management for Organization policies
 
 import json # parsing json
+import time # wait between attempts to queue messages
 import logging # log output for Lambda
 import boto3 # aws stuff
-import time # sleep function
 import uuid # generate unique ID for SQS message
+import hashlib # derive SQS deduplication IDs
 import zipfile # managing zipped data in S3
-from io import BytesIO # used for file buffer to get info from file in S3
+from tempfile import SpooledTemporaryFile # buffer for the archive that spills to /tmp when it gets large
+import threading # guard lazy client creation
+from concurrent.futures import ThreadPoolExecutor # concurrent upload of archive members
+from botocore.config import Config # client connection configuration
 from os import getenv # environment variables
+from ApiMetrics import InvocationMetrics # per-invocation API instrumentation
+from PolicyValidation import validate_policy_content # local checks of policy files
+from TargetLists import read_target_list # streaming reads of large target lists
 
 sqs_queue_url = getenv("SQS_QUEUE_URL") # URL of the FIFO queue used to process updates
 retry_count = getenv("RETRY_COUNT", 3) # global count for retries during processing errors
+sleep_time_seconds = int(getenv("SLEEP_TIME_SECONDS", 5)) # wait between attempts to download an archive or queue messages the queue rejected
+policy_definition_file_name = getenv("POLICY_DEFINITION_FILE_NAME", "policy_definition.json") # name of the Backup Policy .json definition
+target_list_file_name = getenv("TARGET_LIST_FILE_NAME", "target_list.json") # name of the .json listing of target accounts/OUs
+spool_size_bytes = int(getenv("SPOOL_SIZE_BYTES", 8388608)) # archive bytes held in memory before spilling to /tmp
+upload_concurrency = int(getenv("UPLOAD_CONCURRENCY", 4)) # number of archive members uploaded at once
+component_files = [(policy_definition_file_name, 'Definition'), (target_list_file_name, 'Targets')] # policy files and the component of the policy each one defines
+crc_metadata_key = "zip-crc32" # object metadata holding the CRC-32 of the archive member an object was extracted from
+ledger_folder_name = "_ledger" # folder of the policy bucket where OrgBackupPolicyManager keeps its ledgers, which is never a policy
 
 # instantiate a logging tool
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# create aws clients
-s3_resource = boto3.resource('s3')
-lambda_client = boto3.client('lambda')
-sqs_client = boto3.client('sqs')
+# aws clients are created on first use and then shared by every thread and warm invocation
+s3_client = None
+sqs_client = None
+client_lock = threading.Lock()
+
+# instrumentation shared by every AWS call in an invocation
+invocation_metrics = InvocationMetrics("S3PolicyMapper")
 
 #################################################
-# Helper function to unzip files uploaded to S3
+# Functions to create the AWS clients lazily so a
+# cold start only pays for the clients the
+# invocation actually uses. The S3 connection pool
+# is sized for the concurrent member uploads.
 #################################################
-def unzip_files(s3_bucket, s3_key):
+def get_s3_client():
+    global s3_client
 
-    # set retry flag for re-processing purposes
-    retries = 0
+    if s3_client is None:
+        with client_lock:
+            if s3_client is None:
+                s3_client = boto3.client('s3', config=Config(retries={'mode': 'standard'}, max_pool_connections=max(10, upload_concurrency), connect_timeout=5, read_timeout=30, tcp_keepalive=True))
+    return s3_client
 
-    # set initial file value to None so that it can be used as completion criteria for loop when it is no longer 'None'
-    zipped_file = None
+# end function get_s3_client
 
-    # iterate until we max out; iterator set to value above max if processing is successful before max retries
-    while zipped_file is None and retries < retry_count:
-        try: 
-            # get the zip file from the S3 location
-            zipped_file = s3_resource.Object(bucket_name=s3_bucket, key=s3_key)
+def get_sqs_client():
+    global sqs_client
 
-            # read the file info if we get the object
-            if zipped_file is not None:
-                # if the file exists, create a buffer to get the data
-                buffer = BytesIO(zipped_file.get()['Body'].read())
-                retries = retry_count + 1
-        
-        # if processing did not complete, try again but log an error
-        except Exception as e:
-            retries += 1
-            logger.error(f"Error occurred retrieving .zip file from S3. Exception is: {e}")  
-    
-    # start working with the .zip file
-    with zipfile.ZipFile(buffer) as zipf:
+    if sqs_client is None:
+        with client_lock:
+            if sqs_client is None:
+                sqs_client = boto3.client('sqs', config=Config(retries={'mode': 'standard'}, connect_timeout=5, read_timeout=30, tcp_keepalive=True))
+    return sqs_client
+
+# end function get_sqs_client
 
-        # flag to see if we got everything successfully re-inflated
-        process_completed = False
+#################################################
+# Helper function to wait before another attempt
+# at an S3 or SQS operation. The retry and the
+# time slept are recorded with the rest of the
+# invocation's API metrics.
+#################################################
+def wait_to_retry(service, operation):
 
-        # go through all the files in the archive
-        for file in zipf.namelist():
+    invocation_metrics.record_retry(service, operation)
+    time.sleep(sleep_time_seconds)
+    invocation_metrics.record_sleep(sleep_time_seconds)
 
-            # derive the folder name from the .zip to put the files in
-            new_key = s3_key.replace(".zip","/") + f"{file}"
+# end function wait_to_retry
 
-            # upload the unzipped file back to S3
+#################################################
+# Helper function to get the CRC-32 an archive
+# records for a member, in the form it is kept in
+# the metadata of the extracted object.
+#################################################
+def get_member_crc(member):
+
+    return f"{member.CRC:08x}"
+
+# end function get_member_crc
+
+#################################################
+# Helper function to tell whether a member of an
+# archive is already extracted: the object at its
+# key has the same size and was extracted from a
+# member with the same CRC-32. The archive lists
+# the CRC of every member, so nothing is read or
+# hashed. The ETag cannot be used instead: it is
+# not an MD5 digest for objects encrypted with
+# KMS, as the policy bucket is, or for objects
+# uploaded in parts.
+#################################################
+def member_is_extracted(member, s3_bucket, new_key):
+
+    try:
+        response = invocation_metrics.call('s3', get_s3_client().head_object, Bucket=s3_bucket, Key=new_key)
+    except Exception as e:
+        # a missing object, or one that cannot be checked, is extracted again
+        logger.info(f"Object {new_key} is extracted because it could not be compared with the archive. Exception is: {e}")
+        return False
+
+    return response['ContentLength'] == member.file_size and response.get('Metadata', {}).get(crc_metadata_key) == get_member_crc(member)
+
+# end function member_is_extracted
+
+#################################################
+# Helper function to extract one member of an
+# archive to S3 and confirm that it arrived, using
+# a metadata-only request instead of downloading
+# the object again.
+#################################################
+def upload_member(zipf, member, s3_bucket, new_key):
+
+    # upload the unzipped file back to S3, streaming it out of the archive, with the CRC it is compared by next time
+    try:
+        with zipf.open(member) as member_file:
+            invocation_metrics.call('s3', get_s3_client().upload_fileobj, Fileobj=member_file, Bucket=s3_bucket, Key=new_key, ExtraArgs={'Metadata': {crc_metadata_key: get_member_crc(member)}})
+    except Exception as e:
+        logger.error(f"Encountered an issue with upload of the object to {new_key}. Exception is: {e}")
+        return False
+
+    # be sure that the object exists with the expected size
+    try:
+        response = invocation_metrics.call('s3', get_s3_client().head_object, Bucket=s3_bucket, Key=new_key)
+        if response['ContentLength'] == member.file_size:
+            return True
+        logger.error(f"Object {new_key} is {response['ContentLength']} bytes but {member.file_size} bytes were extracted.")
+    except Exception as e:
+        logger.error(f"Something went wrong with unzipping files. Exception is: {e}")
+
+    return False
+
+# end function upload_member
+
+#################################################
+# Helper function to extract a member of an
+# archive only when it differs from the object
+# already at its key. Returns 'unchanged',
+# 'extracted' or 'failed'.
+#################################################
+def extract_member(zipf, member, s3_bucket, new_key):
+
+    if member_is_extracted(member, s3_bucket, new_key):
+        logger.info(f"Object {new_key} already matches {member.filename}. Skipping the upload.")
+        return 'unchanged'
+
+    return 'extracted' if upload_member(zipf, member, s3_bucket, new_key) else 'failed'
+
+# end function extract_member
+
+#################################################
+# Helper function to work out where each member of
+# an archive is extracted to, and which policies
+# the archive holds. A bundle archive holds one
+# <policy>/ folder with a policy definition per
+# policy, and each folder is extracted to the top
+# of the bucket. Any other archive holds a single
+# policy named after the archive itself.
+#################################################
+def map_archive_members(members, s3_key):
+
+    # folders that hold a policy definition mark the archive as a bundle
+    bundle_policies = [
+        member.filename.split("/")[0] for member in members
+        if member.filename.count("/") == 1 and member.filename.endswith("/" + policy_definition_file_name)
+    ]
+
+    # single policy archive: everything goes in a folder named after the archive
+    if len(bundle_policies) == 0:
+        policy_name = s3_key.replace(".zip","")
+        return {member.filename: s3_key.replace(".zip","/") + f"{member.filename}" for member in members}, [policy_name]
+
+    # bundle archive: every policy folder is extracted as-is
+    member_keys = {}
+    for member in members:
+        if member.filename.split("/")[0] in bundle_policies:
+            member_keys[member.filename] = member.filename
+        else:
+            logger.info(f"Skipping {member.filename} in bundle {s3_key} because it is not in a policy folder.")
+
+    return member_keys, bundle_policies
+
+# end function map_archive_members
+
+#################################################
+# Helper function to validate the policy files in
+# an archive before anything is extracted. A
+# policy with an invalid definition or target list
+# is rejected here, in milliseconds, instead of
+# failing later in the Organizations calls. Only
+# the files an archive holds are checked, so an
+# archive may update just a target list. Returns
+# the members and policies that passed.
+#################################################
+def validate_archive_policies(zipf, member_keys, policy_names, s3_key):
+
+    # the archive member extracted to each key
+    members_by_key = {new_key: filename for filename, new_key in member_keys.items()}
+    accepted_names = []
+
+    for policy_name in policy_names:
+        errors = []
+        # the ledger folder belongs to OrgBackupPolicyManager, and a policy extracted there would be overwritten
+        if policy_name.split("/")[0] == ledger_folder_name:
+            errors.append(f"the policy folder name {ledger_folder_name} is reserved for the ledgers of applied policies")
+        filename = members_by_key.get(f"{policy_name}/{policy_definition_file_name}")
+        if filename is not None:
             try:
-                s3_resource.meta.client.upload_fileobj(zipf.open(file),Bucket=s3_bucket,Key=new_key)
-            except Exception as e:
-                logger.error(f"Encountered an issue with upload of the object to {new_key}. Exception is: {e}")
-            
-            # be sure that the object exists; if they all do after processing is done, we can delete the .zip
+                errors.extend(f"{policy_definition_file_name}: {error}" for error in validate_policy_content(json.loads(zipf.read(filename))))
+            except ValueError as e:
+                errors.append(f"{policy_definition_file_name} is not valid JSON: {e}")
+
+        # a target list can be far larger than a definition, so it is parsed as it is decompressed instead of read whole
+        filename = members_by_key.get(f"{policy_name}/{target_list_file_name}")
+        if filename is not None:
             try:
-                if s3_resource.Object(s3_bucket,new_key).get()['ResponseMetadata']['HTTPStatusCode'] is not None:
-                    # sets to true; gets re-evaluated until everything is done
-                    process_completed = True
+                with zipf.open(filename) as target_list:
+                    errors.extend(f"{target_list_file_name}: {error}" for error in read_target_list(target_list).errors)
+            except ValueError as e:
+                errors.append(f"{target_list_file_name} could not be parsed: {e}")
 
-            except Exception as e:
-                logger.error(f"Something went wrong with unzipping files. Exception is: {e}")
-                process_completed = False
+        if len(errors) > 0:
+            logger.error(f"Policy {policy_name} in {s3_key} was rejected and will not be extracted. Problems found: {errors}")
+            invocation_metrics.increment('PoliciesRejected')
+        else:
+            accepted_names.append(policy_name)
+
+    # only the members of accepted policies are extracted
+    accepted_keys = {filename: new_key for filename, new_key in member_keys.items() if new_key.split("/")[0] in accepted_names}
+
+    return accepted_keys, accepted_names
+
+# end function validate_archive_policies
 
-        # delete the .zip archive if we successfully unzipped everything        
-        if process_completed == True:
-            # delete and set the flag that we are done processing
+#################################################
+# Helper function to unzip files uploaded to S3.
+# The archive is streamed into a spool that only
+# keeps spool_size_bytes in memory and spills the
+# rest to /tmp, and its members are uploaded
+# concurrently. Members that match the object
+# already extracted are not uploaded again.
+# Policies that fail validation are not
+# extracted, and the archive is kept so they can
+# be fixed. Returns whether every valid policy was
+# extracted, the policy files each valid policy
+# changed, and whether no policy was rejected.
+#################################################
+def unzip_files(s3_bucket, s3_key):
+
+    # set retry flag for re-processing purposes
+    retries = 0
+
+    # flag to see if we got everything successfully re-inflated
+    process_completed = False
+
+    with SpooledTemporaryFile(max_size=spool_size_bytes) as spool:
+
+        # iterate until we max out; iterator set to value above max if processing is successful before max retries
+        while retries < retry_count:
             try:
-                response = s3_resource.Object(s3_bucket, s3_key).delete()
-                # if the operation succeeded, set the iterator above its max to end processing
-                if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-                    process_completed = True
-            # if the processing did not complete, flag it as failed
+                # stream the zip file from the S3 location into the spool
+                spool.seek(0)
+                spool.truncate()
+                invocation_metrics.call('s3', get_s3_client().download_fileobj, Bucket=s3_bucket, Key=s3_key, Fileobj=spool)
+                retries = retry_count + 1
+
+            # if processing did not complete, try again but log an error
             except Exception as e:
-                logger.error(f"Encountered an error deleting the original .zip file. Exception is {e}")
-                process_completed = False
-    
-    # return the value (true or false) to make sure processing happened fully
-    return(process_completed)
+                retries += 1
+                logger.error(f"Error occurred retrieving .zip file from S3. Exception is: {e}")
+                if retries < retry_count:
+                    wait_to_retry('s3', get_s3_client().download_fileobj)
+
+        # the archive could not be retrieved, so there is nothing to extract
+        if retries == retry_count:
+            return process_completed, {}, False
+
+        # start working with the .zip file
+        spool.seek(0)
+        with zipfile.ZipFile(spool) as zipf:
+
+            # go through all the files in the archive, skipping folder entries
+            members = [member for member in zipf.infolist() if not member.is_dir()]
+
+            # derive the folder names to put the files in
+            member_keys, archive_policy_names = map_archive_members(members, s3_key)
+
+            # check the policy files before anything reaches the bucket or the queue
+            member_keys, policy_names = validate_archive_policies(zipf, member_keys, archive_policy_names, s3_key)
+
+            with ThreadPoolExecutor(max_workers=upload_concurrency) as executor:
+                uploads = {
+                    member_keys[member.filename]: executor.submit(extract_member, zipf, member, s3_bucket, member_keys[member.filename])
+                    for member in members if member.filename in member_keys
+                }
+                results = {new_key: upload.result() for new_key, upload in uploads.items()}
+
+            # every member has to be in place before the policies are queued
+            process_completed = len(results) > 0 and 'failed' not in results.values()
+            invocation_metrics.increment('MembersExtracted', list(results.values()).count('extracted'))
+            invocation_metrics.increment('MembersUnchanged', list(results.values()).count('unchanged'))
+
+            # the policy files each policy actually changed, so OrgBackupPolicyManager only reconciles what they affect
+            changed_components = {
+                policy_name: [component for file_name, component in component_files if results.get(f"{policy_name}/{file_name}") == 'extracted']
+                for policy_name in policy_names
+            }
+
+    # return the value (true or false) to make sure processing happened fully, what was extracted, and whether the archive can go
+    return process_completed, changed_components, len(policy_names) == len(archive_policy_names)
 
 # end function unzip_files
 
+##################################################
+# Helper function to derive the SQS deduplication
+# ID for a change. The S3 sequencer is unique per
+# change to a key, so duplicate deliveries of the
+# same S3 event collapse in the queue while real
+# changes never do.
+##################################################
+def get_deduplication_id(s3_key, sequencer, policy_name):
+
+    # events without a sequencer (e.g. test events) are always treated as new changes
+    if sequencer is None:
+        sequencer = str(uuid.uuid4())
+
+    return hashlib.sha256(f"{s3_key}:{sequencer}:{policy_name}".encode('utf-8')).hexdigest()
+
+# end function get_deduplication_id
+
+##################################################
+# Helper function to send one Upload message per
+# policy to the SQS queue. Messages are sent with
+# send_message_batch (up to 10 per call). Each
+# policy is its own message group, so changes to
+# one policy stay in order while different
+# policies are processed in parallel. The
+# ChangedComponents attribute lists the policy
+# files the upload changed. Entries the queue
+# rejects are sent again, and if any are still
+# rejected after the retries an exception is
+# raised so S3 invokes the function again.
+##################################################
+def send_upload_messages(s3_bucket, s3_key, sequencer, changed_components):
+
+    entries = []
+    for index, policy_name in enumerate(changed_components):
+        # construct the message to send to SQS
+        entries.append({
+            'Id': str(index),
+            'MessageAttributes': {
+                'Bucket': {
+                    'DataType': 'String',
+                    'StringValue': s3_bucket
+                },
+                'UpdatedObject': {
+                    'DataType': 'String',
+                    'StringValue': policy_name
+                },
+                'Action': {
+                    'DataType': 'String',
+                    'StringValue': 'Upload'
+                },
+                # an upload that changed neither file may follow an earlier extraction that was never queued, so it reconciles both
+                'ChangedComponents': {
+                    'DataType': 'String',
+                    'StringValue': ",".join(changed_components[policy_name] or [component for file_name, component in component_files])
+                }
+            },
+            'MessageGroupId': policy_name,
+            'MessageDeduplicationId': get_deduplication_id(s3_key, sequencer, policy_name),
+            'MessageBody': f'S3 Object {policy_name} uploaded to {s3_bucket}'
+        })
+
+    retries = 0
+    while True:
+        failed_entries = []
+        for index in range(0, len(entries), 10):
+            batch = {entry['Id']: entry for entry in entries[index:index + 10]}
+            response = invocation_metrics.call('sqs', get_sqs_client().send_message_batch, QueueUrl=sqs_queue_url, Entries=list(batch.values()))
+
+            # keep anything the queue did not accept for the next attempt
+            for failure in response.get('Failed', []):
+                logger.error(f"Could not send the message for {batch[failure['Id']]['MessageAttributes']['UpdatedObject']['StringValue']}. Reason is: {failure.get('Message')}")
+                failed_entries.append(batch[failure['Id']])
+
+        if len(failed_entries) == 0:
+            return
+
+        # the archive is still in the bucket, so the next invocation extracts it again and the deduplication IDs drop what was already sent
+        retries += 1
+        if retries >= retry_count:
+            raise RuntimeError(f"{len(failed_entries)} policy message(s) could not be sent to {sqs_queue_url} after {retries} attempt(s)")
+        entries = failed_entries
+        wait_to_retry('sqs', get_sqs_client().send_message_batch)
+
+# end function send_upload_messages
+
+##################################################
+# Helper function to delete an archive once all
+# of its policies are extracted and queued.
+##################################################
+def delete_archive(s3_bucket, s3_key):
+
+    try:
+        invocation_metrics.call('s3', get_s3_client().delete_object, Bucket=s3_bucket, Key=s3_key)
+    # a leftover archive is extracted again on its next upload, so this is only logged
+    except Exception as e:
+        logger.error(f"Encountered an error deleting the original .zip file. Exception is {e}")
+
+# end function delete_archive
+
 ##################################################
 # Main Lambda handler function. Event trigger
 # should come from an object upload or deletion
 # in a specific S3 bucket. The file should be a
-# .zip archive, which is unzipped and then
+# .zip archive holding one policy, or a bundle of
+# <policy>/ folders, which is unzipped and then
 # deleted. Once this is complete, the relevant
 # information is sent to a SQS queue to be
 # processed by a parent Lambda function.
 ##################################################
 def lambda_handler(event, context):
 
-    # log beginning of the handler event
-    logger.info('event received: {}'.format(event))
-    
     # boolean to flag our progress
     process_completed = False
 
     # create a variable from the globalized value
     global retry_count
+    global invocation_metrics
+
+    # fresh instrumentation per invocation so the accounting covers this invocation only
+    invocation_metrics = InvocationMetrics(getattr(context, 'function_name', "S3PolicyMapper"))
 
     # fix string values from CloudFormation
     retry_count = int(retry_count)
@@ -137,51 +467,40 @@ def lambda_handler(event, context):
     # get the relevant info into variables
     s3_bucket = event['Records'][0]['s3']['bucket']['name']
     s3_key = event['Records'][0]['s3']['object']['key']
+    sequencer = event['Records'][0]['s3']['object'].get('sequencer')
+
+    # log beginning of the handler event
+    logger.info(f"Event {event['Records'][0]['eventName']} received for {s3_bucket}/{s3_key}")
 
     try:
         # see if there is an upload
         if "ObjectCreated" in event['Records'][0]['eventName'] and ".zip" in s3_key:
             # request the unzip and get the feedback if it was successful
-            process_completed = unzip_files(s3_bucket, event['Records'][0]['s3']['object']['key'])
+            process_completed, changed_components, archive_accepted = unzip_files(s3_bucket, event['Records'][0]['s3']['object']['key'])
             # log end of unzip phase
             logger.info(f"Processing run finished. The process completion boolean is: {process_completed}")
             
             # if we finished everything, pass it to the SQS queue
             if process_completed == True:
-                # derive the backup policy name from the uploaded folder
-                policy_name = s3_key.replace(".zip","")
-                logger.info(f"S3 Object {s3_key} uploaded to {s3_bucket}. Sending event to {sqs_queue_url}")
-
-                # construct the message to send to SQS
-                response = sqs_client.send_message(
-                    QueueUrl = sqs_queue_url,
-                    MessageAttributes={
-                        'Bucket': {
-                            'DataType': 'String',
-                            'StringValue': s3_bucket
-                        },
-                        'UpdatedObject': {
-                            'DataType': 'String',
-                            'StringValue': policy_name
-                        },
-                        'Action': {
-                            'DataType': 'String',
-                            'StringValue': 'Upload'
-                        }
-                    },
-                    # generate a unique message ID so that multiple file changes for the same policy don't get incorrectly deduplicated
-                    MessageGroupId=str(uuid.uuid4()),
-                    MessageBody=(
-                        f'S3 Object {policy_name} uploaded to {s3_bucket}'
-                    )
-                )
+                logger.info(f"S3 Object {s3_key} uploaded to {s3_bucket} with {len(changed_components)} policy(ies). Sending events to {sqs_queue_url}")
+                send_upload_messages(s3_bucket, s3_key, sequencer, changed_components)
+                invocation_metrics.increment('PoliciesQueued', len(changed_components))
+
+                # the archive is only removed once nothing in it was rejected and every policy is queued
+                if archive_accepted == True:
+                    delete_archive(s3_bucket, s3_key)
               
+        # the ledgers are written and removed by OrgBackupPolicyManager itself, so their deletion is not a policy change; the
+        # bucket notification leaves them out, and this covers a notification configured outside the module
+        elif "ObjectRemoved" in event['Records'][0]['eventName'] and s3_key.split("/")[0] == ledger_folder_name:
+            logger.info(f"S3 Object {s3_key} is a policy ledger. Skipping processing.")
+
         # see if there is an object deletion
         elif "ObjectRemoved" in event['Records'][0]['eventName'] and ".zip" not in s3_key:
             logger.info(f"S3 Object {s3_key} deleted from {s3_bucket}. Sending event to {sqs_queue_url}")
 
             # construct the message to send to SQS
-            response = sqs_client.send_message(
+            response = invocation_metrics.call('sqs', get_sqs_client().send_message,
                 QueueUrl = sqs_queue_url,
                 MessageAttributes={
                     'Bucket': {
@@ -197,8 +516,9 @@ def lambda_handler(event, context):
                         'StringValue': 'Delete'
                     }
                 },
-                # generate a unique message ID so that multiple file changes for the same policy don't get incorrectly deduplicated
-                MessageGroupId=str(uuid.uuid4()),
+                # group by policy so changes to one policy are processed in order, and only deduplicate repeats of the same S3 event
+                MessageGroupId=s3_key.split("/")[0],
+                MessageDeduplicationId=get_deduplication_id(s3_key, sequencer, s3_key.split("/")[0]),
                 MessageBody=(
                     f'S3 Object {s3_key} deleted from {s3_bucket}'
                 )
@@ -209,4 +529,8 @@ def lambda_handler(event, context):
         logger.error(f"Failure occurred. Event info is: {e}.")
         raise
 
+    # emit the API call metrics for this invocation, even when it failed
+    finally:
+        invocation_metrics.emit({'RequestId': getattr(context, 'aws_request_id', None), 'ObjectKey': s3_key})
+
 # end of function lambda_handler
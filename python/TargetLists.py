@@ -0,0 +1,318 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains the reading of target lists shared by the S3PolicyMapper and
+# OrgBackupPolicyManager Lambda functions. A target list is read as a stream and
+# kept as a compact set, so a list of tens of thousands of accounts never has to
+# be held as one string or as a list of Python objects
+
+import bisect # membership checks in sorted IDs
+import codecs # incremental UTF-8 decoding
+import hashlib # digest of a target set
+import json # target lists in .json format
+import re # ID formats
+import zlib # gzip-compressed target lists
+from array import array # compact storage of account IDs
+from PolicyValidation import target_id_patterns # formats of the IDs a policy can be attached to
+
+chunk_size = 65536 # number of bytes read from a target list at a time
+max_reported_errors = 20 # number of invalid targets listed before the rest are only counted
+gzip_magic = b'\x1f\x8b' # first bytes of a gzip stream
+
+##################################################
+# Error raised when a target list has the wrong
+# shape, such as a JSON document without a
+# targets list. It is reported as a validation
+# problem rather than as a file that could not be
+# parsed.
+##################################################
+class TargetListError(ValueError):
+    pass
+
+# end class TargetListError
+
+##################################################
+# Helper function to tell account IDs apart from
+# OU and root IDs. Accounts are stored as numbers.
+##################################################
+def is_account_id(target_id):
+
+    return len(target_id) == 12 and target_id.isascii() and target_id.isdigit()
+
+# end function is_account_id
+
+##################################################
+# Class holding the IDs of a target list without
+# duplicates. Account IDs, which make up almost
+# all of a large list, are kept sorted in an array
+# of 64-bit numbers: 8 bytes each instead of a
+# Python string of about 60, and still found with
+# a binary search. The few OU and root IDs are
+# kept in a sorted list. Iteration yields OUs and
+# roots first, so broad attachments are made
+# before the accounts below them, and then the
+# accounts in ascending order. A set read from a
+# file also carries the problems found in it.
+##################################################
+class TargetSet:
+
+    def __init__(self, target_ids=()):
+        accounts = array('Q')
+        others = set()
+        for target_id in target_ids:
+            if is_account_id(target_id):
+                accounts.append(int(target_id))
+            else:
+                others.add(target_id)
+
+        # sort and drop duplicates once, so every lookup is a binary search
+        self.accounts = array('Q')
+        for account in sorted(accounts):
+            if len(self.accounts) == 0 or self.accounts[-1] != account:
+                self.accounts.append(account)
+        self.others = sorted(others)
+        self.errors = []
+
+    def __contains__(self, target_id):
+        if is_account_id(target_id):
+            values, value = self.accounts, int(target_id)
+        else:
+            values, value = self.others, target_id
+        index = bisect.bisect_left(values, value)
+        return index < len(values) and values[index] == value
+
+    def __iter__(self):
+        yield from self.others
+        for account in self.accounts:
+            yield f"{account:012d}"
+
+    def __len__(self):
+        return len(self.accounts) + len(self.others)
+
+    # a stable digest of the IDs, whatever order and format the list was written in
+    def digest(self):
+        digest = hashlib.sha256()
+        for target_id in self:
+            digest.update(target_id.encode('utf-8') + b'\n')
+        return digest.hexdigest()
+
+# end class TargetSet
+
+##################################################
+# Helper generator to turn the bytes of a target
+# list into text. A gzip-compressed list is
+# recognized by its first bytes and inflated one
+# bounded piece at a time, so a small compressed
+# file cannot expand all at once in memory.
+##################################################
+def iter_text_chunks(stream):
+
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    first_chunk = stream.read(chunk_size)
+    # a first read shorter than the gzip magic cannot tell the formats apart, so read on until it can
+    while 0 < len(first_chunk) < len(gzip_magic):
+        next_chunk = stream.read(chunk_size)
+        if len(next_chunk) == 0:
+            break
+        first_chunk += next_chunk
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16) if first_chunk[:2] == gzip_magic else None
+
+    chunk = first_chunk
+    while len(chunk) > 0:
+        if decompressor is None:
+            yield decoder.decode(chunk)
+        else:
+            while len(chunk) > 0:
+                yield decoder.decode(decompressor.decompress(chunk, chunk_size))
+                chunk = decompressor.unconsumed_tail
+                # concatenated gzip members are read one after the other, as gzip itself does
+                if decompressor.eof and len(decompressor.unused_data) > 0:
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        chunk = stream.read(chunk_size)
+
+    if decompressor is not None and not decompressor.eof:
+        raise ValueError("the gzip stream ends before its last block")
+    yield decoder.decode(b'', final=True)
+
+# end function iter_text_chunks
+
+##################################################
+# Class reading JSON from text that arrives in
+# chunks. Only the text that has not been parsed
+# yet is buffered, so memory is bounded by the
+# chunk size and the longest single value rather
+# than by the size of the file.
+##################################################
+class JsonTextStream:
+
+    whitespace = re.compile(r'\s*')
+
+    def __init__(self, text_chunks):
+        self.chunks = iter(text_chunks)
+        self.buffer = ''
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    # append the next chunk and drop the parsed text; False at the end of the stream
+    def fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    # the next character that is not whitespace, without consuming it; '' at the end of the stream
+    def peek(self):
+        while True:
+            self.position = self.whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return ''
+
+    def expect(self, characters):
+        character = self.peek()
+        if character == '' or character not in characters:
+            raise ValueError(f"expected one of {characters!r} but found {character or 'the end of the file'!r}")
+        self.position += 1
+        return character
+
+    # a value that reaches the end of the buffer may continue in the next chunk, so it is decoded again once more text arrives
+    def decode(self):
+        if self.peek() == '':
+            raise ValueError("the file ends in the middle of the JSON document")
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            if end < len(self.buffer) or not self.fill():
+                self.position = end
+                return value
+
+    # the remaining text, for the parts of a file that are not JSON
+    def rest(self):
+        yield self.buffer[self.position:]
+        yield from self.chunks
+
+# end class JsonTextStream
+
+##################################################
+# Helper generator to yield the entries of the
+# targets list of a JSON target list one at a
+# time. Other keys of the object are read and
+# ignored.
+##################################################
+def iter_json_targets(text):
+
+    found = False
+    text.expect('{')
+    if text.peek() == '}':
+        text.expect('}')
+    else:
+        while True:
+            key = text.decode()
+            text.expect(':')
+            if key == 'targets' and text.peek() == '[':
+                found = True
+                text.expect('[')
+                if text.peek() == ']':
+                    text.expect(']')
+                else:
+                    while True:
+                        yield text.decode()
+                        if text.expect(',]') == ']':
+                            break
+            else:
+                text.decode()
+            if text.expect(',}') == '}':
+                break
+
+    if text.peek() != '':
+        raise ValueError("unexpected data after the target list object")
+    if not found:
+        raise TargetListError("the target list must be a JSON object with a targets list")
+
+# end function iter_json_targets
+
+##################################################
+# Helper generator to yield the IDs of a target
+# list written one per line. Blank lines and lines
+# starting with # are skipped.
+##################################################
+def iter_line_targets(text_chunks):
+
+    remainder = ''
+    for chunk in text_chunks:
+        lines = (remainder + chunk).split('\n')
+        remainder = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if len(line) > 0 and not line.startswith('#'):
+                yield line
+
+    remainder = remainder.strip()
+    if len(remainder) > 0 and not remainder.startswith('#'):
+        yield remainder
+
+# end function iter_line_targets
+
+##################################################
+# Function to read a target list from a file-like
+# object, such as an S3 object body or a member of
+# a .zip archive. The list can be the documented
+# JSON object, {"targets": [...]}, or one ID per
+# line, and either can be gzip-compressed. IDs
+# that are not an account, OU or root ID are left
+# out of the returned TargetSet and listed in its
+# errors. A file that cannot be parsed raises
+# ValueError.
+##################################################
+def read_target_list(stream):
+
+    errors = []
+    invalid_count = 0
+    text = JsonTextStream(iter_text_chunks(stream))
+    # an empty upload is more likely a mistake than a request to detach the policy everywhere
+    if text.peek() == '':
+        raise ValueError("the target list is empty")
+    entries = iter_json_targets(text) if text.peek() == '{' else iter_line_targets(text.rest())
+
+    def valid_targets():
+        nonlocal invalid_count
+        for target_id in entries:
+            if isinstance(target_id, str) and any(re.search(pattern, target_id) for pattern in target_id_patterns):
+                yield target_id
+                continue
+            invalid_count += 1
+            if invalid_count <= max_reported_errors:
+                errors.append(f"target {target_id} is not an account ID, OU ID or root ID")
+
+    try:
+        targets = TargetSet(valid_targets())
+    except TargetListError as e:
+        targets = TargetSet()
+        errors.append(str(e))
+
+    if invalid_count > max_reported_errors:
+        errors.append(f"{invalid_count - max_reported_errors} more target(s) are not an account ID, OU ID or root ID")
+    targets.errors = errors
+    return targets
+
+# end function read_target_list
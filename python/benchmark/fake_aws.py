@@ -0,0 +1,469 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains an in-process stand-in for the parts of AWS Organizations,
+# S3, SQS and DynamoDB used by the Lambda functions, so they can be benchmarked offline
+
+import json # item keys
+import re # condition expressions
+import threading # guard shared fake state
+import time # latency and throttling
+import uuid # message and policy IDs
+from collections import Counter # API call counts
+
+max_message_size = 262144 # largest SQS message, in bytes, counting the body and the message attributes
+
+##################################################
+# Error raised by the fakes. The message matches
+# the format of botocore's ClientError, which is
+# what the Lambda functions inspect.
+##################################################
+class FakeClientError(Exception):
+
+    def __init__(self, code, operation, message=''):
+        super().__init__(f"An error occurred ({code}) when calling the {operation} operation: {message}")
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+# end class FakeClientError
+
+##################################################
+# State shared by every fake service: API call
+# counters, a per-call latency and a token bucket
+# that models the Organizations rate limit.
+##################################################
+class FakeAws:
+
+    def __init__(self, latency_seconds=0.005, org_requests_per_second=20, org_burst=40, page_size=20):
+        self.latency_seconds = latency_seconds
+        self.org_requests_per_second = org_requests_per_second
+        self.org_burst = org_burst
+        self.page_size = page_size
+
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.lock = threading.Lock()
+
+        self.org_tokens = float(org_burst)
+        self.org_last_refill = time.monotonic()
+
+        self.organizations = FakeOrganizations(self)
+        self.s3 = FakeS3(self)
+        self.sqs = FakeSqs(self)
+        self.dynamodb = FakeDynamoDb(self)
+
+    # record a call and wait for the modelled latency
+    def record(self, service, operation):
+        with self.lock:
+            self.calls[f"{service}:{operation}"] += 1
+        if self.latency_seconds > 0:
+            time.sleep(self.latency_seconds)
+
+    # take a token from the Organizations bucket, or throttle the call
+    def take_org_token(self, operation):
+        with self.lock:
+            now = time.monotonic()
+            self.org_tokens = min(self.org_burst, self.org_tokens + (now - self.org_last_refill) * self.org_requests_per_second)
+            self.org_last_refill = now
+            if self.org_tokens < 1:
+                self.throttled[f"organizations:{operation}"] += 1
+                raise FakeClientError('TooManyRequestsException', operation, "AWS Organizations can't complete your request because another request is already in progress.")
+            self.org_tokens -= 1
+
+    # return one page of items along with the token for the next page
+    def page(self, items, result_key, next_token):
+        start = int(next_token or 0)
+        response = {result_key: items[start:start + self.page_size], 'ResponseMetadata': {'HTTPStatusCode': 200}}
+        if start + self.page_size < len(items):
+            response['NextToken'] = str(start + self.page_size)
+        return response
+
+    # reset counters between scenarios
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.throttled.clear()
+
+# end class FakeAws
+
+##################################################
+# Fake AWS Organizations client for backup
+# policies and a hierarchy of one root, OUs and
+# accounts. Targets do not have to be added to
+# the hierarchy to be attached to.
+##################################################
+class FakeOrganizations:
+
+    # largest policy document the real service accepts, in characters
+    max_policy_size = 10000
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.policies = {}
+        self.attachments = {}
+        self.root_id = 'r-ab12'
+        self.parents = {}
+
+    # place an OU or account in the hierarchy (setup helper, not an API call)
+    def add_child(self, child_id, parent_id=None):
+        self.parents[child_id] = parent_id or self.root_id
+
+    def child_type(self, child_id):
+        if child_id == self.root_id:
+            return 'ROOT'
+        return 'ORGANIZATIONAL_UNIT' if child_id.startswith('ou-') else 'ACCOUNT'
+
+    def list_roots(self, NextToken=None, **kwargs):
+        self.call('ListRoots')
+        return self.aws.page([{'Id': self.root_id, 'Name': 'Root'}], 'Roots', NextToken)
+
+    def list_children(self, ParentId, ChildType, NextToken=None, **kwargs):
+        self.call('ListChildren')
+        children = [{'Id': child_id, 'Type': ChildType} for child_id, parent_id in sorted(self.parents.items()) if parent_id == ParentId and self.child_type(child_id) == ChildType]
+        return self.aws.page(children, 'Children', NextToken)
+
+    def list_parents(self, ChildId, NextToken=None, **kwargs):
+        self.call('ListParents')
+        if ChildId not in self.parents:
+            raise FakeClientError('ChildNotFoundException', 'ListParents')
+        return self.aws.page([{'Id': self.parents[ChildId], 'Type': self.child_type(self.parents[ChildId])}], 'Parents', NextToken)
+
+    def list_policies_for_target(self, TargetId, Filter, NextToken=None, **kwargs):
+        self.call('ListPoliciesForTarget')
+        summaries = [self.policies[policy_id]['PolicySummary'] for policy_id, targets in self.attachments.items() if TargetId in targets and self.policies[policy_id]['PolicySummary']['Type'] == Filter]
+        return self.aws.page(summaries, 'Policies', NextToken)
+
+    def call(self, operation):
+        self.aws.record('organizations', operation)
+        self.aws.take_org_token(operation)
+
+    def list_policies(self, Filter, NextToken=None, **kwargs):
+        self.call('ListPolicies')
+        summaries = [policy['PolicySummary'] for policy in self.policies.values() if policy['PolicySummary']['Type'] == Filter]
+        return self.aws.page(summaries, 'Policies', NextToken)
+
+    def describe_policy(self, PolicyId):
+        self.call('DescribePolicy')
+        if PolicyId not in self.policies:
+            raise FakeClientError('PolicyNotFoundException', 'DescribePolicy')
+        return {'Policy': self.policies[PolicyId], 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def create_policy(self, Content, Description, Name, Type, **kwargs):
+        self.call('CreatePolicy')
+        if len(Content) > self.max_policy_size:
+            raise FakeClientError('ConstraintViolationException', 'CreatePolicy', "POLICY_CONTENT_LIMIT_EXCEEDED")
+        with self.aws.lock:
+            if any(policy['PolicySummary']['Name'] == Name for policy in self.policies.values()):
+                raise FakeClientError('DuplicatePolicyException', 'CreatePolicy')
+            policy_id = 'p-' + uuid.uuid4().hex[:8]
+            self.policies[policy_id] = {
+                'PolicySummary': {'Id': policy_id, 'Arn': f"arn:aws:organizations::111111111111:policy/o-example/backup_policy/{policy_id}", 'Name': Name, 'Description': Description, 'Type': Type, 'AwsManaged': False},
+                'Content': Content
+            }
+            self.attachments[policy_id] = set()
+        return {'Policy': self.policies[policy_id], 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def update_policy(self, PolicyId, Content=None, Description=None, Name=None):
+        self.call('UpdatePolicy')
+        if PolicyId not in self.policies:
+            raise FakeClientError('PolicyNotFoundException', 'UpdatePolicy')
+        if Content is not None and len(Content) > self.max_policy_size:
+            raise FakeClientError('ConstraintViolationException', 'UpdatePolicy', "POLICY_CONTENT_LIMIT_EXCEEDED")
+        policy = self.policies[PolicyId]
+        if Content is not None:
+            policy['Content'] = Content
+        if Description is not None:
+            policy['PolicySummary']['Description'] = Description
+        if Name is not None:
+            policy['PolicySummary']['Name'] = Name
+        return {'Policy': policy, 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def delete_policy(self, PolicyId):
+        self.call('DeletePolicy')
+        with self.aws.lock:
+            if PolicyId not in self.policies:
+                raise FakeClientError('PolicyNotFoundException', 'DeletePolicy')
+            if len(self.attachments[PolicyId]) > 0:
+                raise FakeClientError('PolicyInUseException', 'DeletePolicy')
+            del self.policies[PolicyId]
+            del self.attachments[PolicyId]
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def attach_policy(self, PolicyId, TargetId):
+        self.call('AttachPolicy')
+        with self.aws.lock:
+            if PolicyId not in self.policies:
+                raise FakeClientError('PolicyNotFoundException', 'AttachPolicy')
+            if TargetId in self.attachments[PolicyId]:
+                raise FakeClientError('DuplicatePolicyAttachmentException', 'AttachPolicy')
+            self.attachments[PolicyId].add(TargetId)
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def detach_policy(self, PolicyId, TargetId):
+        self.call('DetachPolicy')
+        with self.aws.lock:
+            if TargetId not in self.attachments.get(PolicyId, ()):
+                raise FakeClientError('PolicyNotAttachedException', 'DetachPolicy')
+            self.attachments[PolicyId].discard(TargetId)
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def list_targets_for_policy(self, PolicyId, NextToken=None, **kwargs):
+        self.call('ListTargetsForPolicy')
+        if PolicyId not in self.policies:
+            raise FakeClientError('PolicyNotFoundException', 'ListTargetsForPolicy')
+        targets = [
+            {'TargetId': target_id, 'Arn': f"arn:aws:organizations::111111111111:account/o-example/{target_id}", 'Name': target_id, 'Type': 'ORGANIZATIONAL_UNIT' if target_id.startswith('ou-') else 'ACCOUNT'}
+            for target_id in sorted(self.attachments[PolicyId])
+        ]
+        return self.aws.page(targets, 'Targets', NextToken)
+
+    # summary of which policy names are attached to which targets
+    def attachment_summary(self):
+        return {policy['PolicySummary']['Name']: sorted(self.attachments[policy_id]) for policy_id, policy in self.policies.items()}
+
+# end class FakeOrganizations
+
+##################################################
+# Streaming body returned by FakeS3.get_object.
+##################################################
+class FakeBody:
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, amount=None):
+        if amount is None:
+            amount = len(self.data) - self.position
+        chunk = self.data[self.position:self.position + amount]
+        self.position += len(chunk)
+        return chunk
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        pass
+
+# end class FakeBody
+
+##################################################
+# Fake S3 client holding every bucket in memory.
+##################################################
+class FakeS3:
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.objects = {}
+
+    def call(self, operation):
+        self.aws.record('s3', operation)
+
+    def missing(self, operation):
+        return FakeClientError('404', operation, 'Not Found')
+
+    def put(self, bucket, key, data, metadata=None):
+        with self.aws.lock:
+            self.objects[(bucket, key)] = {'Body': bytes(data), 'Metadata': dict(metadata or {}), 'ETag': '"' + uuid.uuid4().hex + '"'}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.call('GetObject')
+        if (Bucket, Key) not in self.objects:
+            raise FakeClientError('NoSuchKey', 'GetObject', 'The specified key does not exist.')
+        stored = self.objects[(Bucket, Key)]
+        return {'Body': FakeBody(stored['Body']), 'ContentLength': len(stored['Body']), 'ETag': stored['ETag'], 'Metadata': stored['Metadata']}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.call('HeadObject')
+        if (Bucket, Key) not in self.objects:
+            raise self.missing('HeadObject')
+        stored = self.objects[(Bucket, Key)]
+        return {'ContentLength': len(stored['Body']), 'ETag': stored['ETag'], 'Metadata': stored['Metadata'], 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def put_object(self, Bucket, Key, Body=b'', Metadata=None, **kwargs):
+        self.call('PutObject')
+        data = Body.encode('utf-8') if isinstance(Body, str) else Body if isinstance(Body, bytes) else Body.read()
+        self.put(Bucket, Key, data, Metadata)
+        return {'ETag': self.objects[(Bucket, Key)]['ETag'], 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.call('DeleteObject')
+        with self.aws.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {'ResponseMetadata': {'HTTPStatusCode': 204}}
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        self.call('GetObject')
+        if (Bucket, Key) not in self.objects:
+            raise self.missing('HeadObject')
+        Fileobj.write(self.objects[(Bucket, Key)]['Body'])
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, **kwargs):
+        self.call('PutObject')
+        self.put(Bucket, Key, Fileobj.read(), (ExtraArgs or {}).get('Metadata'))
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, ContinuationToken=None, **kwargs):
+        self.call('ListObjectsV2')
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        if Delimiter is not None:
+            prefixes = sorted(set(Prefix + key[len(Prefix):].split(Delimiter)[0] + Delimiter for key in keys if Delimiter in key[len(Prefix):]))
+            contents = [key for key in keys if Delimiter not in key[len(Prefix):]]
+        else:
+            prefixes = []
+            contents = keys
+
+        # page through contents and common prefixes together, as S3 does
+        entries = [('Prefix', prefix) for prefix in prefixes] + [('Key', key) for key in contents]
+        start = int(ContinuationToken or 0)
+        page = entries[start:start + 1000]
+        response = {
+            'Contents': [{'Key': key, 'Size': len(self.objects[(Bucket, key)]['Body']), 'ETag': self.objects[(Bucket, key)]['ETag']} for kind, key in page if kind == 'Key'],
+            'CommonPrefixes': [{'Prefix': prefix} for kind, prefix in page if kind == 'Prefix'],
+            'IsTruncated': start + 1000 < len(entries)
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(start + 1000)
+        return response
+
+# end class FakeS3
+
+##################################################
+# Fake SQS client that keeps sent messages in a
+# list so the benchmark can feed them back to the
+# OrgBackupPolicyManager handler.
+##################################################
+class FakeSqs:
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.messages = []
+
+    def call(self, operation):
+        self.aws.record('sqs', operation)
+
+    def store(self, entry):
+        message_id = str(uuid.uuid4())
+        with self.aws.lock:
+            self.messages.append({
+                'messageId': message_id,
+                'receiptHandle': message_id,
+                'body': entry.get('MessageBody', ''),
+                'attributes': {'MessageGroupId': entry.get('MessageGroupId')},
+                'messageAttributes': {
+                    name: {'stringValue': value['StringValue'], 'dataType': value['DataType']}
+                    for name, value in entry.get('MessageAttributes', {}).items()
+                }
+            })
+        return message_id
+
+    def send_message(self, QueueUrl, **kwargs):
+        self.call('SendMessage')
+        # SQS counts the attribute names, types and values against the message size limit along with the body
+        attributes = kwargs.get('MessageAttributes', {})
+        size = len(kwargs.get('MessageBody', '').encode('utf-8')) + sum(len((name + value['DataType'] + value['StringValue']).encode('utf-8')) for name, value in attributes.items())
+        if size > max_message_size:
+            raise FakeClientError('InvalidParameterValue', 'SendMessage', f"One or more parameters are invalid. Reason: Message must be shorter than {max_message_size} bytes.")
+        return {'MessageId': self.store(kwargs), 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.call('SendMessageBatch')
+        return {'Successful': [{'Id': entry['Id'], 'MessageId': self.store(entry)} for entry in Entries], 'Failed': []}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.call('DeleteMessage')
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.call('DeleteMessageBatch')
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    # hand back everything sent so far as SQS event records, in batches
+    def drain_batches(self, batch_size=10):
+        with self.aws.lock:
+            messages = self.messages
+            self.messages = []
+        return [messages[index:index + batch_size] for index in range(0, len(messages), batch_size)]
+
+# end class FakeSqs
+
+##################################################
+# Fake DynamoDB client that keeps items in a dict.
+# Only the expressions the handler uses are
+# understood: a SET of plain attributes, and a
+# condition that is either attribute_not_exists
+# or equalities joined with AND.
+##################################################
+class FakeDynamoDb:
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.items = {}
+
+    def call(self, operation):
+        self.aws.record('dynamodb', operation)
+
+    def get_item(self, TableName, Key, **kwargs):
+        self.call('GetItem')
+        response = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+        with self.aws.lock:
+            item = self.items.get((TableName, json.dumps(Key, sort_keys=True)))
+        if item is not None:
+            response['Item'] = dict(item)
+        return response
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+        self.call('UpdateItem')
+        values = ExpressionAttributeValues or {}
+        item_key = (TableName, json.dumps(Key, sort_keys=True))
+        with self.aws.lock:
+            item = self.items.get(item_key)
+            if ConditionExpression is not None and not self.matches(item, ConditionExpression, values):
+                raise FakeClientError('ConditionalCheckFailedException', 'UpdateItem', 'The conditional request failed')
+            item = dict(item or Key)
+            for assignment in UpdateExpression.replace('SET ', '', 1).split(','):
+                name, value = [part.strip() for part in assignment.split('=')]
+                item[name] = values[value]
+            self.items[item_key] = item
+        return {'Attributes': dict(item), 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def matches(self, item, condition, values):
+        not_exists = re.fullmatch(r'attribute_not_exists\((\w+)\)', condition.strip())
+        if not_exists is not None:
+            return item is None or not_exists.group(1) not in item
+        for comparison in condition.split(' AND '):
+            name, value = [part.strip() for part in comparison.split('=')]
+            if item is None or item.get(name) != values[value]:
+                return False
+        return True
+
+# end class FakeDynamoDb
+
+##################################################
+# Stand-in for the Lambda context object.
+##################################################
+class FakeLambdaContext:
+
+    def __init__(self, timeout_seconds=900):
+        self.deadline = time.monotonic() + timeout_seconds
+        self.function_name = 'benchmark'
+        self.aws_request_id = str(uuid.uuid4())
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+# end class FakeLambdaContext
@@ -0,0 +1,440 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains an offline benchmark harness that runs the S3PolicyMapper and
+# OrgBackupPolicyManager handlers against the in-process fakes in fake_aws.py
+#
+# Usage: python python/benchmark/run_benchmark.py [--scenario NAME] [--latency-ms N]
+#                                                 [--org-rate N] [--org-burst N]
+
+import argparse # command line options
+import contextlib # capture metric records
+import gzip # compressed target lists
+import io # in-memory archives
+import json # policy files
+import logging # quiet the handlers
+import os # environment for the handlers
+import sys # import path for the handlers
+import time # wall time
+import zipfile # building upload archives
+from concurrent.futures import ThreadPoolExecutor # concurrent invocations
+
+# the handlers read their configuration from the environment when they are imported
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+os.environ.setdefault("SQS_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/111111111111/BackupPolicyQ.fifo")
+os.environ.setdefault("SLEEP_TIME_SECONDS", "1")
+os.environ.setdefault("ORG_API_REQUESTS_PER_SECOND", "15")
+os.environ.setdefault("ORG_API_BURST", "30")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import OrgBackupPolicyManager # Lambda handling Organizations
+import S3PolicyMapper # Lambda handling S3 uploads
+from fake_aws import FakeAws, FakeLambdaContext # in-process AWS stand-in
+
+bucket_name = "benchmark-policy-bucket"
+
+# example policy shipped with the module, used as the content of every benchmark policy
+example_policy_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "modules", "backup-account", "PolicyExample", "policy_definition.json")
+
+##################################################
+# Helper function to point both handlers at the
+# fakes. The handlers create their clients lazily,
+# so filling the client caches means no real
+# client is ever built.
+##################################################
+def install_fakes(aws):
+
+    OrgBackupPolicyManager.org_client = aws.organizations
+    OrgBackupPolicyManager.s3_client = aws.s3
+    OrgBackupPolicyManager.sqs_client = aws.sqs
+    OrgBackupPolicyManager.dynamodb_client = aws.dynamodb
+
+    S3PolicyMapper.s3_client = aws.s3
+    S3PolicyMapper.sqs_client = aws.sqs
+
+# end function install_fakes
+
+##################################################
+# Helper functions to build benchmark input.
+##################################################
+def load_example_policy():
+
+    with open(example_policy_file) as policy_file:
+        return json.load(policy_file)
+
+def account_ids(count, offset=0):
+
+    return [f"{100000000000 + offset + index:012d}" for index in range(count)]
+
+def put_policy_files(aws, policy_name, policy_content, targets):
+
+    aws.s3.put(bucket_name, f"{policy_name}/{OrgBackupPolicyManager.policy_definition_file_name}", json.dumps(policy_content, indent=4).encode('utf-8'))
+    aws.s3.put(bucket_name, f"{policy_name}/{OrgBackupPolicyManager.target_list_file_name}", json.dumps({'targets': targets}, indent=4).encode('utf-8'))
+
+def upload_record(policy_name, action='Upload', updated_object=None):
+
+    return {
+        'messageId': f"{policy_name}-{action}",
+        'receiptHandle': f"{policy_name}-{action}",
+        'attributes': {'MessageGroupId': policy_name},
+        'messageAttributes': {
+            'Bucket': {'stringValue': bucket_name, 'dataType': 'String'},
+            'UpdatedObject': {'stringValue': updated_object or policy_name, 'dataType': 'String'},
+            'Action': {'stringValue': action, 'dataType': 'String'}
+        }
+    }
+
+def s3_event(s3_key, event_name='ObjectCreated:Put'):
+
+    return {'Records': [{'eventName': event_name, 's3': {'bucket': {'name': bucket_name}, 'object': {'key': s3_key, 'sequencer': format(time.time_ns(), 'X')}}}]}
+
+def build_archive(files):
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+# end benchmark input functions
+
+##################################################
+# Helper class that runs handlers and accumulates
+# the measurements for one scenario.
+##################################################
+class ScenarioRun:
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.timeout_seconds = 900
+        self.reset()
+
+    # forget everything measured so far, e.g. after seeding a scenario with a first rollout
+    def reset(self):
+        self.aws.reset_counters()
+        self.started = time.monotonic()
+        self.invocations = 0
+        self.failed_records = 0
+        self.org_wait_seconds = 0.0
+        self.org_retries = 0
+
+    def run_manager(self, records, batch_size=10):
+        for index in range(0, len(records), batch_size):
+            with self.capture_metrics():
+                response = OrgBackupPolicyManager.lambda_handler({'Records': records[index:index + batch_size]}, FakeLambdaContext(self.timeout_seconds))
+            self.invocations += 1
+            self.failed_records += len((response or {}).get('batchItemFailures', []))
+
+    def run_mapper(self, event):
+        with self.capture_metrics():
+            S3PolicyMapper.lambda_handler(event, FakeLambdaContext())
+        self.invocations += 1
+
+    def run_full_sync(self, dry_run=False):
+        with self.capture_metrics():
+            OrgBackupPolicyManager.lambda_handler({'Action': 'FullSync', 'Bucket': bucket_name, 'DryRun': dry_run}, FakeLambdaContext(self.timeout_seconds))
+        self.invocations += 1
+
+    # run one manager invocation per batch at the same time, as Lambda does when several message groups have work
+    def run_concurrent(self, batches):
+        with self.capture_metrics():
+            with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+                responses = list(executor.map(lambda batch: OrgBackupPolicyManager.lambda_handler({'Records': batch}, FakeLambdaContext(self.timeout_seconds)), batches))
+        self.invocations += len(batches)
+        self.failed_records += sum(len((response or {}).get('batchItemFailures', [])) for response in responses)
+
+    # feed everything queued to the manager, including the continuations it queues itself, until the queue is empty
+    def run_queued(self, batch_size=10):
+        while len(self.aws.sqs.messages) > 0:
+            for batch in self.aws.sqs.drain_batches(batch_size):
+                self.run_manager(batch, batch_size)
+
+    # read the metric records the handlers print instead of showing them
+    @contextlib.contextmanager
+    def capture_metrics(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            yield
+        for line in output.getvalue().splitlines():
+            if not line.startswith('{'):
+                continue
+            record = json.loads(line)
+            if '_aws' not in record:
+                continue
+            self.org_wait_seconds += record.get('SleepSeconds', 0)
+            self.org_retries += sum(value for name, value in record.items() if name.endswith('.Retries'))
+
+# end class ScenarioRun
+
+##################################################
+# Benchmark scenarios. Each one seeds the fakes,
+# then runs the handlers the way an upload would.
+##################################################
+def scenario_one_policy_many_targets(aws, run):
+
+    put_policy_files(aws, "LargeRollout", load_example_policy(), account_ids(1000))
+    run.run_manager([upload_record("LargeRollout")])
+
+def scenario_many_policies_few_targets(aws, run):
+
+    policy_content = load_example_policy()
+    for index in range(300):
+        put_policy_files(aws, f"Policy{index:03d}", policy_content, account_ids(5, offset=index * 5))
+    run.run_manager([upload_record(f"Policy{index:03d}") for index in range(300)])
+
+def scenario_unchanged_reupload(aws, run):
+
+    policy_content = load_example_policy()
+    for index in range(50):
+        put_policy_files(aws, f"Policy{index:03d}", policy_content, account_ids(20, offset=index * 20))
+    records = [upload_record(f"Policy{index:03d}") for index in range(50)]
+
+    # first rollout is not measured; the re-upload of the same files is
+    run.run_manager(records)
+    run.reset()
+    run.run_manager(records)
+
+def scenario_target_churn(aws, run):
+
+    put_policy_files(aws, "Churn", load_example_policy(), account_ids(500))
+    run.run_manager([upload_record("Churn")])
+    run.reset()
+
+    # replace half of the targets
+    put_policy_files(aws, "Churn", load_example_policy(), account_ids(250) + account_ids(250, offset=10000))
+    run.run_manager([upload_record("Churn")])
+
+def scenario_bundle_upload(aws, run):
+
+    policy_content = json.dumps(load_example_policy(), indent=4)
+    files = {}
+    for index in range(150):
+        files[f"Bundle{index:03d}/{S3PolicyMapper.policy_definition_file_name}"] = policy_content
+        files[f"Bundle{index:03d}/{S3PolicyMapper.target_list_file_name}"] = json.dumps({'targets': account_ids(3, offset=index * 3)})
+    aws.s3.put(bucket_name, "quarterly.zip", build_archive(files))
+
+    run.run_mapper(s3_event("quarterly.zip"))
+    run.run_queued()
+
+def scenario_bundle_targets_reupload(aws, run):
+
+    # the bundle is re-uploaded with the target lists of 10 policies changed; without ledgers the manager reads Organizations
+    OrgBackupPolicyManager.ledger_verify_seconds = 0
+    try:
+        scenario_bundle_upload(aws, run)
+        run.reset()
+
+        policy_content = json.dumps(load_example_policy(), indent=4)
+        files = {}
+        for index in range(150):
+            files[f"Bundle{index:03d}/{S3PolicyMapper.policy_definition_file_name}"] = policy_content
+            files[f"Bundle{index:03d}/{S3PolicyMapper.target_list_file_name}"] = json.dumps({'targets': account_ids(3, offset=index * 3 + (10000 if index < 10 else 0))})
+        aws.s3.put(bucket_name, "quarterly.zip", build_archive(files))
+
+        run.run_mapper(s3_event("quarterly.zip"))
+        run.run_queued()
+    finally:
+        OrgBackupPolicyManager.ledger_verify_seconds = 3600
+
+def scenario_delete_policy(aws, run):
+
+    put_policy_files(aws, "Retired", load_example_policy(), account_ids(200))
+    run.run_manager([upload_record("Retired")])
+    run.reset()
+
+    definition_key = f"Retired/{OrgBackupPolicyManager.policy_definition_file_name}"
+    aws.s3.delete_object(Bucket=bucket_name, Key=definition_key)
+    run.run_manager([upload_record("Retired", 'Delete', definition_key)])
+
+def seed_drift(aws, run):
+
+    policy_content = load_example_policy()
+    for index in range(200):
+        put_policy_files(aws, f"Policy{index:03d}", policy_content, account_ids(5, offset=index * 5))
+    run.run_manager([upload_record(f"Policy{index:03d}") for index in range(200)])
+
+    # drift made outside the pipeline, none of which sends an event; the fake state is changed
+    # directly so the setup is not held to the Organizations rate limit
+    policy_ids = {policy['PolicySummary']['Name']: policy_id for policy_id, policy in aws.organizations.policies.items()}
+    for index in range(20):
+        aws.organizations.attachments[policy_ids[f"Policy{index:03d}"]].discard(account_ids(1, offset=index * 5)[0])
+    for index in range(20, 30):
+        del aws.organizations.policies[policy_ids[f"Policy{index:03d}"]]
+        del aws.organizations.attachments[policy_ids[f"Policy{index:03d}"]]
+    for index in range(30, 40):
+        aws.s3.delete_object(Bucket=bucket_name, Key=f"Policy{index:03d}/{OrgBackupPolicyManager.policy_definition_file_name}")
+    run.reset()
+
+def scenario_full_sync_drift(aws, run):
+
+    seed_drift(aws, run)
+    run.run_full_sync()
+
+def scenario_plan_only_drift(aws, run):
+
+    seed_drift(aws, run)
+    run.run_full_sync(dry_run=True)
+
+def scenario_prune_ou_targets(aws, run):
+
+    # one OU with 200 accounts, all of them also listed individually in the target list
+    accounts = account_ids(200)
+    aws.organizations.add_child("ou-ab12-prod0001")
+    for account_id in accounts:
+        aws.organizations.add_child(account_id, "ou-ab12-prod0001")
+    put_policy_files(aws, "OrgWide", load_example_policy(), ["ou-ab12-prod0001"] + accounts)
+
+    OrgBackupPolicyManager.prune_redundant_targets = "true"
+    try:
+        run.run_manager([upload_record("OrgWide")])
+    finally:
+        OrgBackupPolicyManager.prune_redundant_targets = "false"
+
+def scenario_split_large_policy(aws, run):
+
+    # 40 copies of the example plan are well over the size of one policy, so the definition is split
+    example_plan = next(iter(load_example_policy()['plans'].values()))
+    policy_content = {'plans': {f"Plan{index:02d}": example_plan for index in range(40)}}
+    put_policy_files(aws, "LargeDefinition", policy_content, account_ids(50))
+    run.run_manager([upload_record("LargeDefinition")])
+
+def scenario_checkpointed_rollout(aws, run):
+
+    # a short timeout makes the rollout continue across several invocations
+    put_policy_files(aws, "LargeRollout", load_example_policy(), account_ids(300))
+    run.timeout_seconds = 8
+    OrgBackupPolicyManager.checkpoint_margin_seconds = 2
+    try:
+        run.run_manager([upload_record("LargeRollout")])
+        run.run_queued()
+    finally:
+        OrgBackupPolicyManager.checkpoint_margin_seconds = 30
+
+def scenario_concurrent_rollouts(aws, run):
+
+    # three invocations roll out a policy each; every one of them paces itself at the full API rate
+    for index in range(3):
+        put_policy_files(aws, f"Concurrent{index}", load_example_policy(), account_ids(100, offset=index * 100))
+    run.run_concurrent([[upload_record(f"Concurrent{index}")] for index in range(3)])
+
+def scenario_concurrent_rollouts_shared_rate(aws, run):
+
+    # the same rollouts drawing from one rate shared through DynamoDB
+    OrgBackupPolicyManager.org_rate_table_name = "BenchmarkOrgRate"
+    try:
+        scenario_concurrent_rollouts(aws, run)
+    finally:
+        OrgBackupPolicyManager.org_rate_table_name = ""
+
+def scenario_large_target_list(aws, run):
+
+    # a policy already attached to 20,000 accounts, as its ledger records
+    policy_content = load_example_policy()
+    accounts = account_ids(20000)
+    response = aws.organizations.create_policy(Content=OrgBackupPolicyManager.get_minified_policy(policy_content), Description=OrgBackupPolicyManager.backup_policy_description, Name="LargeTargetList", Type='BACKUP_POLICY')
+    policy_id = response['Policy']['PolicySummary']['Id']
+    aws.organizations.attachments[policy_id].update(accounts)
+    ledger_parts = {"LargeTargetList": {'PolicyId': policy_id, 'ContentHash': OrgBackupPolicyManager.get_policy_content_hash(policy_content), 'Targets': accounts}}
+    aws.s3.put(bucket_name, OrgBackupPolicyManager.get_ledger_key("LargeTargetList"), json.dumps({'PolicyName': "LargeTargetList", 'Parts': ledger_parts, 'AppliedAt': time.time(), 'VerifiedAt': time.time()}).encode('utf-8'))
+    run.reset()
+
+    # the new list swaps 100 accounts and arrives gzip-compressed, one ID per line
+    aws.s3.put(bucket_name, f"LargeTargetList/{OrgBackupPolicyManager.policy_definition_file_name}", json.dumps(policy_content).encode('utf-8'))
+    aws.s3.put(bucket_name, f"LargeTargetList/{OrgBackupPolicyManager.target_list_file_name}", gzip.compress("\n".join(accounts[100:] + account_ids(100, offset=50000)).encode('utf-8')))
+    run.run_manager([upload_record("LargeTargetList")])
+
+scenarios = {
+    '1-policy-x-1000-targets': scenario_one_policy_many_targets,
+    '300-policies-x-5-targets': scenario_many_policies_few_targets,
+    'unchanged-reupload-50-policies': scenario_unchanged_reupload,
+    'target-churn-500': scenario_target_churn,
+    'bundle-150-policies': scenario_bundle_upload,
+    'bundle-150-policies-targets-reupload': scenario_bundle_targets_reupload,
+    'delete-policy-200-targets': scenario_delete_policy,
+    'full-sync-200-policies-drift': scenario_full_sync_drift,
+    'plan-only-200-policies-drift': scenario_plan_only_drift,
+    'prune-ou-200-accounts': scenario_prune_ou_targets,
+    'split-policy-40-plans': scenario_split_large_policy,
+    'checkpoint-300-targets': scenario_checkpointed_rollout,
+    'concurrent-3x100-targets': scenario_concurrent_rollouts,
+    'concurrent-3x100-targets-shared-rate': scenario_concurrent_rollouts_shared_rate,
+    'large-target-list-20000-accounts': scenario_large_target_list
+}
+
+# end benchmark scenarios
+
+##################################################
+# Helper function to run one scenario against a
+# fresh set of fakes and return its measurements.
+##################################################
+def run_scenario(name, latency_seconds, org_rate, org_burst):
+
+    aws = FakeAws(latency_seconds=latency_seconds, org_requests_per_second=org_rate, org_burst=org_burst)
+    install_fakes(aws)
+
+    # every scenario starts from a cold catalog and hierarchy index
+    OrgBackupPolicyManager.invalidate_policy_catalog()
+    OrgBackupPolicyManager.invalidate_org_tree()
+
+    run = ScenarioRun(aws)
+    scenarios[name](aws, run)
+    wall_seconds = time.monotonic() - run.started
+
+    return {
+        'scenario': name,
+        'wall_seconds': round(wall_seconds, 3),
+        'invocations': run.invocations,
+        'failed_records': run.failed_records,
+        'api_calls': sum(aws.calls.values()),
+        'api_calls_by_operation': dict(sorted(aws.calls.items())),
+        'throttled_calls': sum(aws.throttled.values()),
+        # summed over every thread, so it can exceed the wall time when attachments run concurrently
+        'org_wait_seconds': round(run.org_wait_seconds, 3),
+        'org_retries': run.org_retries
+    }
+
+# end function run_scenario
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the backup policy Lambda functions against in-process fakes.")
+    parser.add_argument('--scenario', action='append', choices=sorted(scenarios), help="scenario to run (repeatable, default: all)")
+    parser.add_argument('--latency-ms', type=float, default=5.0, help="latency added to every fake API call")
+    parser.add_argument('--org-rate', type=float, default=20.0, help="requests per second the fake Organizations API allows")
+    parser.add_argument('--org-burst', type=float, default=40.0, help="burst size of the fake Organizations API")
+    parser.add_argument('--json', action='store_true', help="print results as JSON lines")
+    args = parser.parse_args()
+
+    # the handlers log every call; only keep warnings and errors
+    logging.getLogger().setLevel(logging.WARNING)
+    OrgBackupPolicyManager.logger.setLevel(logging.WARNING)
+    S3PolicyMapper.logger.setLevel(logging.WARNING)
+
+    for name in args.scenario or list(scenarios):
+        result = run_scenario(name, args.latency_ms / 1000, args.org_rate, args.org_burst)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"{result['scenario']:<32} wall {result['wall_seconds']:>8.2f}s  invocations {result['invocations']:>4}  "
+                  f"api calls {result['api_calls']:>6}  throttled {result['throttled_calls']:>4}  "
+                  f"org waits {result['org_wait_seconds']:>7.2f}s  retries {result['org_retries']:>4}  failed {result['failed_records']}")
+            for operation, count in result['api_calls_by_operation'].items():
+                print(f"    {operation:<40} {count:>6}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains a cold start benchmark for the S3PolicyMapper and
+# OrgBackupPolicyManager handlers. Every sample runs in a fresh Python process and
+# measures the module import, the first (cold) invocation and a second (warm) one.
+# The handlers build real boto3 clients, so client construction is included in the
+# first invocation, but every API call is answered by the fakes in fake_aws.py.
+#
+# Usage: python python/benchmark/startup_benchmark.py [--handler NAME] [--samples N] [--json]
+
+import argparse # command line options
+import contextlib # silence the metric records
+import io # in-memory archives
+import json # results and policy files
+import logging # quiet the handlers
+import os # environment for the handlers
+import statistics # summarising samples
+import subprocess # fresh interpreter per sample
+import sys # interpreter path
+import time # timing
+import zipfile # building the upload archive
+
+benchmark_folder = os.path.dirname(os.path.abspath(__file__))
+handler_folder = os.path.join(benchmark_folder, "..")
+bucket_name = "benchmark-policy-bucket"
+startup_policy = {'plans': {'StartupPlan': {'regions': {'@@assign': ["us-east-1"]}, 'rules': {'Daily': {'schedule_expression': {'@@assign': "cron(0 5 ? * * *)"}, 'target_backup_vault_name': {'@@assign': "Default"}}}}}}
+handlers = ["S3PolicyMapper", "OrgBackupPolicyManager"]
+
+##################################################
+# Helper function to make every boto3 client the
+# handler creates answer from the fakes. The real
+# client is still built so its construction cost
+# is part of the measurement.
+##################################################
+def route_clients_to_fakes(aws):
+    import boto3
+
+    build_client = boto3.client
+    fakes = {'organizations': aws.organizations, 's3': aws.s3, 'sqs': aws.sqs}
+
+    def client(service_name, *args, **kwargs):
+        build_client(service_name, *args, **kwargs)
+        return fakes[service_name]
+
+    boto3.client = client
+
+# end function route_clients_to_fakes
+
+##################################################
+# Helper functions to build one invocation worth
+# of input for each handler.
+##################################################
+def mapper_event(aws, handler):
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as archive_file:
+        archive_file.writestr(handler.policy_definition_file_name, json.dumps(startup_policy))
+        archive_file.writestr(handler.target_list_file_name, json.dumps({'targets': ["111111111111"]}))
+    aws.s3.put(bucket_name, "StartupPolicy.zip", archive.getvalue())
+
+    return {'Records': [{'eventName': 'ObjectCreated:Put', 's3': {'bucket': {'name': bucket_name}, 'object': {'key': "StartupPolicy.zip", 'sequencer': format(time.time_ns(), 'X')}}}]}
+
+def manager_event(aws, handler):
+
+    aws.s3.put(bucket_name, f"StartupPolicy/{handler.policy_definition_file_name}", json.dumps(startup_policy).encode('utf-8'))
+    aws.s3.put(bucket_name, f"StartupPolicy/{handler.target_list_file_name}", json.dumps({'targets': ["111111111111"]}).encode('utf-8'))
+
+    return {'Records': [{
+        'messageId': "StartupPolicy-Upload",
+        'receiptHandle': "StartupPolicy-Upload",
+        'attributes': {'MessageGroupId': "StartupPolicy"},
+        'messageAttributes': {
+            'Bucket': {'stringValue': bucket_name, 'dataType': 'String'},
+            'UpdatedObject': {'stringValue': "StartupPolicy", 'dataType': 'String'},
+            'Action': {'stringValue': 'Upload', 'dataType': 'String'}
+        }
+    }]}
+
+# end benchmark input functions
+
+##################################################
+# Function run inside the fresh process: time the
+# import, the first and a second invocation, and
+# print the result as json.
+##################################################
+def measure_sample(handler_name):
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("SQS_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/111111111111/BackupPolicyQ.fifo")
+    sys.path.insert(0, handler_folder)
+
+    # the fakes only use the standard library, so they don't warm anything the handler imports
+    from fake_aws import FakeAws, FakeLambdaContext
+    aws = FakeAws(latency_seconds=0, org_requests_per_second=1000, org_burst=1000)
+
+    started = time.perf_counter()
+    handler = __import__(handler_name)
+    import_ms = (time.perf_counter() - started) * 1000
+
+    logging.getLogger().setLevel(logging.WARNING)
+    route_clients_to_fakes(aws)
+    build_event = mapper_event if handler_name == "S3PolicyMapper" else manager_event
+
+    timings = []
+    for _ in range(2):
+        event = build_event(aws, handler)
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            handler.lambda_handler(event, FakeLambdaContext())
+        timings.append((time.perf_counter() - started) * 1000)
+
+    print(json.dumps({'import_ms': import_ms, 'first_invocation_ms': timings[0], 'warm_invocation_ms': timings[1]}))
+
+# end function measure_sample
+
+##################################################
+# Function to collect samples for one handler,
+# each in its own interpreter.
+##################################################
+def run_handler(handler_name, samples):
+
+    results = []
+    for _ in range(samples):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", handler_name], cwd=benchmark_folder, capture_output=True, text=True, check=True)
+        results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+    summary = {'handler': handler_name, 'samples': samples}
+    for measurement in ['import_ms', 'first_invocation_ms', 'warm_invocation_ms']:
+        values = [result[measurement] for result in results]
+        summary[measurement] = {'median': round(statistics.median(values), 1), 'min': round(min(values), 1), 'max': round(max(values), 1)}
+    cold_start = [result['import_ms'] + result['first_invocation_ms'] for result in results]
+    summary['cold_start_ms'] = {'median': round(statistics.median(cold_start), 1), 'min': round(min(cold_start), 1), 'max': round(max(cold_start), 1)}
+    return summary
+
+# end function run_handler
+
+def print_summary(summary):
+
+    print(f"\n== {summary['handler']} ({summary['samples']} samples, milliseconds) ==")
+    for measurement in ['import_ms', 'first_invocation_ms', 'warm_invocation_ms', 'cold_start_ms']:
+        values = summary[measurement]
+        print(f"{measurement:<22} median {values['median']:>8}   min {values['min']:>8}   max {values['max']:>8}")
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Measure import and first-invocation time of the Lambda handlers.")
+    parser.add_argument("--handler", choices=handlers, action="append", help="handler to measure (default: both)")
+    parser.add_argument("--samples", type=int, default=5, help="number of fresh processes per handler")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    parser.add_argument("--child", choices=handlers, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure_sample(args.child)
+        return
+
+    summaries = [run_handler(handler_name, args.samples) for handler_name in args.handler or handlers]
+    if args.json:
+        print(json.dumps(summaries, indent=2))
+    else:
+        for summary in summaries:
+            print_summary(summary)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains the pytest fixtures shared by the tests of the Lambda functions,
+# which run the handlers against the in-process fakes in benchmark/fake_aws.py
+#
+# Usage: python -m pytest python/tests
+
+import os # environment for the handlers
+import sys # import path for the handlers
+import pytest # test fixtures
+
+# the handlers read their configuration from the environment when they are imported; the Organizations
+# rate is raised so the tests are not paced like a real organization
+os.environ["ORG_API_REQUESTS_PER_SECOND"] = "1000"
+os.environ["ORG_API_BURST"] = "1000"
+os.environ["SLEEP_TIME_SECONDS"] = "0"
+
+python_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(python_folder, "benchmark"))
+sys.path.insert(0, python_folder)
+
+import OrgBackupPolicyManager # Lambda handling Organizations
+import S3PolicyMapper # Lambda handling S3 uploads
+import run_benchmark # helpers to install the fakes and build input
+from fake_aws import FakeAws # in-process AWS stand-in
+
+##################################################
+# Fixture with a fresh set of fakes installed in
+# both handlers. The caches the handlers keep
+# across warm invocations are cleared, and the
+# retry waits are shortened.
+##################################################
+@pytest.fixture
+def aws(monkeypatch):
+
+    fake_aws = FakeAws(latency_seconds=0, org_requests_per_second=1000, org_burst=1000)
+    run_benchmark.install_fakes(fake_aws)
+    OrgBackupPolicyManager.invalidate_policy_catalog()
+    monkeypatch.setattr(OrgBackupPolicyManager, 'org_tree', None)
+    monkeypatch.setattr(OrgBackupPolicyManager, 'backoff_base_seconds', 0.001)
+    monkeypatch.setattr(OrgBackupPolicyManager, 'sleep_time_seconds', 0)
+    monkeypatch.setattr(OrgBackupPolicyManager, 'retry_count', 2)
+    monkeypatch.setattr(S3PolicyMapper, 'sleep_time_seconds', 0)
+    yield fake_aws
+    OrgBackupPolicyManager.invalidate_policy_catalog()
+
+# end fixture aws
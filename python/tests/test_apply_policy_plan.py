@@ -0,0 +1,153 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains the tests of apply_policy_plan: parts of a split policy that are
+# no longer needed stay attached until every new part of it is in place
+
+import OrgBackupPolicyManager # Lambda handling Organizations
+from OrgBackupPolicyManager import ProcessingContext, apply_policy_plan, new_plan_entry, get_policy_parts, get_minified_policy # plan helpers
+from run_benchmark import put_policy_files, upload_record, load_example_policy # test input
+from fake_aws import FakeClientError, FakeLambdaContext # in-process AWS stand-in
+from test_policy_parts import large_policy # a definition split into two parts
+
+def create_owned_policy(aws, policy_name, policy_content, target_ids):
+
+    response = aws.organizations.create_policy(Content=get_minified_policy(policy_content), Description=OrgBackupPolicyManager.backup_policy_description, Name=policy_name, Type='BACKUP_POLICY')
+    policy_id = response['Policy']['PolicySummary']['Id']
+    aws.organizations.attachments[policy_id].update(target_ids)
+    return policy_id
+
+def get_policy_id(aws, policy_name):
+
+    return next(policy_id for policy_id, policy in aws.organizations.policies.items() if policy['PolicySummary']['Name'] == policy_name)
+
+# a plan that splits policy P, attached to one account, into two new parts
+def plan_split(aws):
+
+    policy_id = create_owned_policy(aws, 'P', load_example_policy(), ['111111111111'])
+    plan = [new_plan_entry(part_name, None, 'create', part_content, ['111111111111'], []) for part_name, part_content in get_policy_parts('P', large_policy()).items()]
+    plan.append(new_plan_entry('P', policy_id, 'delete', None, [], ['111111111111']))
+    return plan
+
+def remaining_by_name(remaining_plan):
+
+    return {entry['policy_name']: (entry['action'], entry['to_attach'], entry['to_detach']) for entry in remaining_plan}
+
+##################################################
+# A new part that cannot be created keeps the old
+# policy attached, and the retry finishes the
+# split.
+##################################################
+def test_failed_new_part_keeps_the_old_policy(aws, monkeypatch):
+
+    put_policy_files(aws, 'P', load_example_policy(), ['111111111111'])
+    assert OrgBackupPolicyManager.lambda_handler({'Records': [upload_record('P')]}, FakeLambdaContext(900)) == {'batchItemFailures': []}
+
+    create_policy = aws.organizations.create_policy
+    def create_all_but_part02(Content, Description, Name, Type, **kwargs):
+        if Name == 'P-part02':
+            raise FakeClientError('ServiceException', 'CreatePolicy')
+        return create_policy(Content=Content, Description=Description, Name=Name, Type=Type, **kwargs)
+    monkeypatch.setattr(aws.organizations, 'create_policy', create_all_but_part02)
+
+    put_policy_files(aws, 'P', large_policy(), ['111111111111'])
+    assert OrgBackupPolicyManager.lambda_handler({'Records': [upload_record('P')]}, FakeLambdaContext(900)) == {'batchItemFailures': [{'itemIdentifier': 'P-Upload'}]}
+    assert aws.organizations.attachment_summary() == {'P': ['111111111111'], 'P-part01': ['111111111111']}
+
+    monkeypatch.setattr(aws.organizations, 'create_policy', create_policy)
+    assert OrgBackupPolicyManager.lambda_handler({'Records': [upload_record('P')]}, FakeLambdaContext(900)) == {'batchItemFailures': []}
+    assert aws.organizations.attachment_summary() == {'P-part01': ['111111111111'], 'P-part02': ['111111111111']}
+
+##################################################
+# A new part whose attachment is left for a
+# continuation keeps the old policy attached, and
+# the continuation carries its detach and delete.
+##################################################
+def test_deferred_new_part_carries_the_old_policy_into_the_checkpoint(aws, monkeypatch):
+
+    plan = plan_split(aws)
+
+    attach_backup_policy = OrgBackupPolicyManager.attach_backup_policy
+    def defer_part02(processing_context, target_id, policy_id):
+        if aws.organizations.policies[policy_id]['PolicySummary']['Name'] == 'P-part02':
+            return 'deferred'
+        return attach_backup_policy(processing_context, target_id, policy_id)
+    monkeypatch.setattr(OrgBackupPolicyManager, 'attach_backup_policy', defer_part02)
+
+    failed_policies, remaining_plan = apply_policy_plan(ProcessingContext(), plan)
+
+    assert failed_policies == []
+    assert remaining_by_name(remaining_plan) == {'P-part02': (None, ['111111111111'], []), 'P': ('delete', [], ['111111111111'])}
+    assert aws.organizations.attachment_summary() == {'P': ['111111111111'], 'P-part01': ['111111111111'], 'P-part02': []}
+
+##################################################
+# When a shrinking definition fails to update a
+# remaining part, the part it no longer needs is
+# neither detached nor deleted, and is reported
+# with it.
+##################################################
+def test_failed_update_keeps_the_leftover_part(aws, monkeypatch):
+
+    # three parts of an earlier, larger definition
+    part_ids = [create_owned_policy(aws, f"P-part{index:02d}", load_example_policy(), ['111111111111', '222222222222']) for index in (1, 2, 3)]
+    new_parts = get_policy_parts('P', large_policy())
+    plan = [new_plan_entry(part_name, part_id, 'update', part_content, ['111111111111', '222222222222'], ['111111111111', '222222222222']) for (part_name, part_content), part_id in zip(new_parts.items(), part_ids)]
+    plan.append(new_plan_entry('P-part03', part_ids[2], 'delete', None, [], ['111111111111', '222222222222']))
+
+    update_policy = aws.organizations.update_policy
+    def fail_part01(PolicyId, **kwargs):
+        if PolicyId == part_ids[0]:
+            raise FakeClientError('AccessDeniedException', 'UpdatePolicy')
+        return update_policy(PolicyId=PolicyId, **kwargs)
+    monkeypatch.setattr(aws.organizations, 'update_policy', fail_part01)
+
+    failed_policies, remaining_plan = apply_policy_plan(ProcessingContext(), plan)
+
+    assert failed_policies == ['P-part01', 'P-part03']
+    assert remaining_plan == []
+    assert aws.organizations.attachment_summary()['P-part03'] == ['111111111111', '222222222222']
+
+##################################################
+# Once every new part is in place, a leftover part
+# is detached everywhere before it is deleted; a
+# detach left for a continuation holds back the
+# delete and only the detach still to be made is
+# carried.
+##################################################
+def test_leftover_part_is_deleted_only_after_every_detach(aws, monkeypatch):
+
+    plan = plan_split(aws)
+    plan[-1] = new_plan_entry('P', plan[-1]['policy_id'], 'delete', None, [], ['111111111111', '222222222222'])
+    aws.organizations.attachments[plan[-1]['policy_id']].add('222222222222')
+
+    detach_backup_policy = OrgBackupPolicyManager.detach_backup_policy
+    def defer_second_account(processing_context, target_id, policy_id):
+        if target_id == '222222222222':
+            return 'deferred'
+        return detach_backup_policy(processing_context, target_id, policy_id)
+    monkeypatch.setattr(OrgBackupPolicyManager, 'detach_backup_policy', defer_second_account)
+
+    failed_policies, remaining_plan = apply_policy_plan(ProcessingContext(), plan)
+
+    assert failed_policies == []
+    assert remaining_by_name(remaining_plan) == {'P': ('delete', [], ['222222222222'])}
+    assert aws.organizations.attachment_summary()['P'] == ['222222222222']
+
+    monkeypatch.setattr(OrgBackupPolicyManager, 'detach_backup_policy', detach_backup_policy)
+    failed_policies, remaining_plan = apply_policy_plan(ProcessingContext(), remaining_plan)
+
+    assert (failed_policies, remaining_plan) == ([], [])
+    assert 'P' not in aws.organizations.attachment_summary()
+    assert get_policy_id(aws, 'P-part01') is not None
@@ -0,0 +1,60 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains the tests of send_continuations: a checkpoint is carried in the
+# continuation only while the whole message, attributes included, fits in SQS
+
+import json # message bodies
+from OrgBackupPolicyManager import ProcessingContext, send_continuations, max_message_size # continuation helpers
+from run_benchmark import bucket_name # test input
+
+# the Bucket, UpdatedObject and Action attributes of a continuation for policy P
+attribute_size = len('Bucket' + 'String' + bucket_name) + len('UpdatedObject' + 'String' + 'P') + len('Action' + 'String' + 'Continue')
+
+# a checkpoint whose continuation is exactly the given number of bytes, attributes included
+def checkpoint_of_size(message_size):
+
+    empty_body = json.dumps({'Fingerprint': 'f', 'Plan': ['']})
+    return ['x' * (message_size - attribute_size - len(empty_body))]
+
+def send_checkpoint(checkpoint):
+
+    assert send_continuations(ProcessingContext(), {'P': checkpoint}, {'P': {'s3_bucket': bucket_name, 'fingerprint': 'f'}}) == []
+
+##################################################
+# A continuation at the SQS limit still carries
+# its checkpoint.
+##################################################
+def test_checkpoint_at_the_limit_is_carried(aws):
+
+    checkpoint = checkpoint_of_size(max_message_size)
+    send_checkpoint(checkpoint)
+
+    assert [json.loads(message['body'])['Plan'] for message in aws.sqs.messages] == [checkpoint]
+
+##################################################
+# One byte over the limit, counting the message
+# attributes, the checkpoint is dropped and the
+# continuation plans the policy again, although
+# the body alone would fit.
+##################################################
+def test_checkpoint_over_the_limit_is_dropped(aws):
+
+    checkpoint = checkpoint_of_size(max_message_size + 1)
+    assert len(json.dumps({'Fingerprint': 'f', 'Plan': checkpoint}).encode('utf-8')) < max_message_size
+    send_checkpoint(checkpoint)
+
+    assert [json.loads(message['body']) for message in aws.sqs.messages] == [{'Fingerprint': None, 'Plan': None}]
+    assert aws.calls['sqs:SendMessage'] == 1
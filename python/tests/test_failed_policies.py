@@ -0,0 +1,115 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains the tests of how the records of a failed policy are handled: only
+# failures that a retry can fix are returned to the queue
+
+import json # metric records
+import pytest # parametrized tests
+import OrgBackupPolicyManager # Lambda handling Organizations
+from run_benchmark import put_policy_files, upload_record, load_example_policy, bucket_name # test input
+from fake_aws import FakeClientError, FakeLambdaContext # in-process AWS stand-in
+
+def run_upload(policy_name):
+
+    return OrgBackupPolicyManager.lambda_handler({'Records': [upload_record(policy_name)]}, FakeLambdaContext(900))
+
+# the counters of the EMF record the handler printed last
+def emitted_metrics(capsys):
+
+    return json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+
+def fail_attach(aws, monkeypatch, error_code):
+
+    def attach_policy(PolicyId, TargetId):
+        aws.organizations.call('AttachPolicy')
+        raise FakeClientError(error_code, 'AttachPolicy')
+    monkeypatch.setattr(aws.organizations, 'attach_policy', attach_policy)
+
+##################################################
+# A call that is throttled or fails on the service
+# side returns the record to the queue.
+##################################################
+@pytest.mark.parametrize('error_code', ['TooManyRequestsException', 'ServiceException'])
+def test_transient_failure_is_retried(aws, monkeypatch, error_code):
+
+    fail_attach(aws, monkeypatch, error_code)
+    put_policy_files(aws, 'P', load_example_policy(), ['111111111111'])
+
+    assert run_upload('P') == {'batchItemFailures': [{'itemIdentifier': 'P-Upload'}]}
+    assert aws.calls['sqs:DeleteMessageBatch'] == 0
+
+##################################################
+# A call that no retry can fix drops the record
+# instead of returning it to the queue.
+##################################################
+@pytest.mark.parametrize('error_code', ['AccessDeniedException', 'TargetNotFoundException'])
+def test_permanent_failure_is_dropped(aws, monkeypatch, error_code):
+
+    fail_attach(aws, monkeypatch, error_code)
+    put_policy_files(aws, 'P', load_example_policy(), ['111111111111'])
+
+    assert run_upload('P') == {'batchItemFailures': []}
+    assert aws.calls['sqs:DeleteMessageBatch'] == 1
+    # no retry was attempted on the call either
+    assert aws.calls['organizations:AttachPolicy'] == 1
+
+##################################################
+# The same split applies to a failure while the
+# policy is planned.
+##################################################
+def test_permanent_planning_failure_is_dropped(aws, monkeypatch):
+
+    put_policy_files(aws, 'P', load_example_policy(), ['111111111111'])
+    def list_policies(**kwargs):
+        raise FakeClientError('AccessDeniedException', 'ListPolicies')
+    monkeypatch.setattr(aws.organizations, 'list_policies', list_policies)
+
+    assert run_upload('P') == {'batchItemFailures': []}
+
+def test_transient_planning_failure_is_retried(aws, monkeypatch):
+
+    put_policy_files(aws, 'P', load_example_policy(), ['111111111111'])
+    def list_policies(**kwargs):
+        raise FakeClientError('ServiceException', 'ListPolicies')
+    monkeypatch.setattr(aws.organizations, 'list_policies', list_policies)
+
+    assert run_upload('P') == {'batchItemFailures': [{'itemIdentifier': 'P-Upload'}]}
+
+##################################################
+# A policy file that is empty or cannot be parsed
+# is rejected like one that fails validation: the
+# record is deleted and the policy left as it is.
+##################################################
+@pytest.mark.parametrize('file_name, content', [
+    (OrgBackupPolicyManager.target_list_file_name, b''),
+    (OrgBackupPolicyManager.target_list_file_name, b'{"targets": ['),
+    (OrgBackupPolicyManager.policy_definition_file_name, b''),
+    (OrgBackupPolicyManager.policy_definition_file_name, b'{"plans": '),
+])
+def test_unparseable_policy_file_is_rejected(aws, capsys, file_name, content):
+
+    put_policy_files(aws, 'P', load_example_policy(), ['111111111111'])
+    assert run_upload('P') == {'batchItemFailures': []}
+    capsys.readouterr()
+
+    aws.s3.put(bucket_name, f"P/{file_name}", content)
+
+    assert run_upload('P') == {'batchItemFailures': []}
+    assert aws.calls['sqs:DeleteMessageBatch'] == 2
+    assert aws.organizations.attachment_summary() == {'P': ['111111111111']}
+    metrics = emitted_metrics(capsys)
+    assert metrics['PoliciesRejected'] == 1
+    assert 'PoliciesFailedPermanently' not in metrics
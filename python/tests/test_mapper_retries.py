@@ -0,0 +1,85 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains the tests of the S3PolicyMapper retries: every download of an
+# archive and every send of rejected messages that is tried again is in the metrics
+
+import json # target list content
+import S3PolicyMapper # Lambda handling S3 uploads
+from run_benchmark import load_example_policy, bucket_name, build_archive, s3_event # test input
+from fake_aws import FakeClientError, FakeLambdaContext # in-process AWS stand-in
+
+archive_key = "policies.zip"
+
+def upload_archive(aws):
+
+    files = {f"P/{S3PolicyMapper.policy_definition_file_name}": json.dumps(load_example_policy()), f"P/{S3PolicyMapper.target_list_file_name}": json.dumps({'targets': ['111111111111']})}
+    aws.s3.put(bucket_name, archive_key, build_archive(files))
+
+def run_mapper():
+
+    S3PolicyMapper.lambda_handler(s3_event(archive_key), FakeLambdaContext())
+    return S3PolicyMapper.invocation_metrics
+
+##################################################
+# A download that fails once is retried, and the
+# retry and its wait are recorded.
+##################################################
+def test_download_retry_is_recorded(aws, monkeypatch):
+
+    upload_archive(aws)
+    monkeypatch.setattr(S3PolicyMapper, 'sleep_time_seconds', 0.01)
+    download_fileobj = aws.s3.download_fileobj
+    attempts = []
+    def fail_first_download(**kwargs):
+        attempts.append(kwargs['Key'])
+        if len(attempts) == 1:
+            raise FakeClientError('InternalError', 'GetObject')
+        return download_fileobj(**kwargs)
+    fail_first_download.__name__ = 'download_fileobj'
+    monkeypatch.setattr(aws.s3, 'download_fileobj', fail_first_download)
+
+    metrics = run_mapper()
+
+    assert len(attempts) == 2
+    assert metrics.retries == {'s3.download_fileobj': 1}
+    assert metrics.sleep_seconds == 0.01
+    assert len(aws.sqs.messages) == 1
+
+##################################################
+# Messages the queue rejects are sent again, and
+# the retry and its wait are recorded.
+##################################################
+def test_send_retry_is_recorded(aws, monkeypatch):
+
+    upload_archive(aws)
+    monkeypatch.setattr(S3PolicyMapper, 'sleep_time_seconds', 0.01)
+    send_message_batch = aws.sqs.send_message_batch
+    attempts = []
+    def reject_first_send(QueueUrl, Entries):
+        attempts.append(len(Entries))
+        if len(attempts) == 1:
+            aws.sqs.call('SendMessageBatch')
+            return {'Successful': [], 'Failed': [{'Id': entry['Id'], 'Message': 'Service unavailable'} for entry in Entries]}
+        return send_message_batch(QueueUrl=QueueUrl, Entries=Entries)
+    reject_first_send.__name__ = 'send_message_batch'
+    monkeypatch.setattr(aws.sqs, 'send_message_batch', reject_first_send)
+
+    metrics = run_mapper()
+
+    assert attempts == [1, 1]
+    assert metrics.retries == {'sqs.send_message_batch': 1}
+    assert metrics.sleep_seconds == 0.01
+    assert len(aws.sqs.messages) == 1
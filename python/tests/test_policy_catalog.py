@@ -0,0 +1,98 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains the tests of the policy catalog kept warm across invocations: a
+# policy deleted outside the pipeline is dropped from it and planned again on the retry
+
+import pytest # parametrized tests
+import OrgBackupPolicyManager # Lambda handling Organizations
+from run_benchmark import put_policy_files, upload_record, load_example_policy # test input
+from fake_aws import FakeLambdaContext # in-process AWS stand-in
+
+def run_upload(policy_name):
+
+    return OrgBackupPolicyManager.lambda_handler({'Records': [upload_record(policy_name)]}, FakeLambdaContext(900))
+
+def delete_outside_pipeline(aws, policy_name):
+
+    policy_id = next(policy_id for policy_id, policy in aws.organizations.policies.items() if policy['PolicySummary']['Name'] == policy_name)
+    aws.organizations.attachments[policy_id].clear()
+    aws.organizations.delete_policy(PolicyId=policy_id)
+
+def other_region_policy():
+
+    policy_content = load_example_policy()
+    policy_content['plans']['BackupPlan00']['regions']['@@assign'] = ['eu-west-1']
+    return policy_content
+
+@pytest.fixture
+def warm_catalog(aws, monkeypatch):
+
+    monkeypatch.setattr(OrgBackupPolicyManager, 'policy_catalog_ttl_seconds', 3600)
+    put_policy_files(aws, 'P', load_example_policy(), ['111111111111'])
+    assert run_upload('P') == {'batchItemFailures': []}
+    delete_outside_pipeline(aws, 'P')
+    return aws
+
+##################################################
+# A write to the deleted policy, planned from its
+# ledger, fails; the retry creates the policy
+# again instead of writing to the stale ID.
+##################################################
+@pytest.mark.parametrize('policy_content, targets', [
+    (load_example_policy(), ['111111111111', '222222222222']),
+    (other_region_policy(), ['111111111111']),
+])
+def test_write_to_deleted_policy_is_planned_again(warm_catalog, policy_content, targets):
+
+    aws = warm_catalog
+    put_policy_files(aws, 'P', policy_content, targets)
+
+    assert run_upload('P') == {'batchItemFailures': [{'itemIdentifier': 'P-Upload'}]}
+    assert 'P' not in OrgBackupPolicyManager.policy_catalog
+
+    assert run_upload('P') == {'batchItemFailures': []}
+    assert aws.organizations.attachment_summary() == {'P': targets}
+
+##################################################
+# Without a ledger the plan reads the targets of
+# the deleted policy from the catalog's stale ID;
+# the catalog is rebuilt for the retry.
+##################################################
+def test_planning_a_deleted_policy_rebuilds_the_catalog(warm_catalog, monkeypatch):
+
+    aws = warm_catalog
+    monkeypatch.setattr(OrgBackupPolicyManager, 'ledger_verify_seconds', 0)
+    put_policy_files(aws, 'P', load_example_policy(), ['111111111111', '222222222222'])
+
+    assert run_upload('P') == {'batchItemFailures': [{'itemIdentifier': 'P-Upload'}]}
+    assert OrgBackupPolicyManager.policy_catalog is None
+
+    assert run_upload('P') == {'batchItemFailures': []}
+    assert aws.organizations.attachment_summary() == {'P': ['111111111111', '222222222222']}
+
+##################################################
+# Deleting a policy that is already gone is done,
+# and the catalog no longer lists it.
+##################################################
+def test_deleting_a_deleted_policy_succeeds(warm_catalog):
+
+    aws = warm_catalog
+    # the ledger is kept, so the plan still has the ID of the policy
+    for key in [key for key in aws.s3.objects if key[1].startswith('P/')]:
+        del aws.s3.objects[key]
+
+    assert run_upload('P') == {'batchItemFailures': []}
+    assert 'P' not in OrgBackupPolicyManager.policy_catalog
@@ -0,0 +1,74 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains the tests of policies split into parts: which policies count as
+# parts of a policy folder, and when parts that are no longer needed are removed
+
+import json # policy content
+import OrgBackupPolicyManager # Lambda handling Organizations
+from run_benchmark import put_policy_files, upload_record, load_example_policy, bucket_name # test input
+from fake_aws import FakeClientError, FakeLambdaContext # in-process AWS stand-in
+
+# a definition with this many copies of the example plan is split into two parts
+large_plan_count = 40
+
+def large_policy():
+
+    example_plan = next(iter(load_example_policy()['plans'].values()))
+    return {'plans': {f"Plan{index:02d}": example_plan for index in range(large_plan_count)}}
+
+def run_upload(policy_name):
+
+    return OrgBackupPolicyManager.lambda_handler({'Records': [upload_record(policy_name)]}, FakeLambdaContext(900))
+
+def run_full_sync():
+
+    return OrgBackupPolicyManager.lambda_handler({'Action': 'FullSync', 'Bucket': bucket_name}, FakeLambdaContext(900))
+
+def create_foreign_policy(aws, policy_name, target_id):
+
+    response = aws.organizations.create_policy(Content=json.dumps(load_example_policy()), Description="Created by hand", Name=policy_name, Type='BACKUP_POLICY')
+    aws.organizations.attachments[response['Policy']['PolicySummary']['Id']].add(target_id)
+
+##################################################
+# A policy created outside the pipeline with a
+# -partNN name is not a part of the folder it
+# seems to belong to.
+##################################################
+def test_foreign_part_survives_upload_and_full_sync(aws):
+
+    create_foreign_policy(aws, 'Y-part01', '222222222222')
+    put_policy_files(aws, 'Y', load_example_policy(), ['111111111111'])
+
+    assert run_upload('Y') == {'batchItemFailures': []}
+    assert aws.organizations.attachment_summary() == {'Y-part01': ['222222222222'], 'Y': ['111111111111']}
+
+    result = run_full_sync()
+    assert result['Failed'] == []
+    assert aws.organizations.attachment_summary() == {'Y-part01': ['222222222222'], 'Y': ['111111111111']}
+
+##################################################
+# Parts written by the pipeline are still removed
+# once the definition no longer needs them.
+##################################################
+def test_own_parts_are_removed_when_the_definition_shrinks(aws):
+
+    put_policy_files(aws, 'P', large_policy(), ['111111111111'])
+    assert run_upload('P') == {'batchItemFailures': []}
+    assert aws.organizations.attachment_summary() == {'P-part01': ['111111111111'], 'P-part02': ['111111111111']}
+
+    put_policy_files(aws, 'P', load_example_policy(), ['111111111111'])
+    assert run_upload('P') == {'batchItemFailures': []}
+    assert aws.organizations.attachment_summary() == {'P': ['111111111111']}
@@ -0,0 +1,180 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This file contains the tests of the streaming reads of target lists: JSON and gzip
+# input split at any byte, the shape of the JSON object, and the reporting of bad IDs
+
+import gzip # compressed target lists
+import io # in-memory streams
+import pytest # parametrized tests
+import TargetLists # target list reading
+from TargetLists import JsonTextStream, TargetListError, iter_json_targets, iter_text_chunks, read_target_list # streaming readers
+
+# every value of this list is split at some boundary by the chunk sizes below, including the escapes and the BOM
+json_target_list = '﻿{"name": "caf\\u00e9 \\"prod\\"", "count": 1234, "targets": ["111111111111", "ou-abcd-12345678", "r-ab12", "111111111111"], "nested": {"targets": ["999"]}}'
+chunk_sizes = [1, 2, 3, 5, 7, 65536]
+
+def read_text(content, chunk_size, monkeypatch):
+
+    monkeypatch.setattr(TargetLists, 'chunk_size', chunk_size)
+    return read_target_list(io.BytesIO(content))
+
+def json_targets(text_chunks):
+
+    return list(iter_json_targets(JsonTextStream(text_chunks)))
+
+##################################################
+# A value split across chunks, whether a key, a
+# string with escapes or a number, is read whole.
+##################################################
+@pytest.mark.parametrize('chunk_size', chunk_sizes)
+def test_values_split_across_chunks(chunk_size, monkeypatch):
+
+    targets = read_text(json_target_list.encode('utf-8'), chunk_size, monkeypatch)
+
+    assert list(targets) == ['ou-abcd-12345678', 'r-ab12', '111111111111']
+    assert targets.errors == []
+
+def test_escape_and_number_split_across_text_chunks():
+
+    assert json_targets(['{"co', 'unt": 12', '34, "targets": ["11111111111', '\\', 'u0031", "r-', 'ab12"', ']', '}']) == ['111111111111', 'r-ab12']
+
+##################################################
+# The BOM and a multi-byte character split across
+# chunks decode to the same text as in one chunk.
+##################################################
+@pytest.mark.parametrize('chunk_size', [1, 2])
+def test_bom_split_across_chunks(chunk_size, monkeypatch):
+
+    monkeypatch.setattr(TargetLists, 'chunk_size', chunk_size)
+
+    assert ''.join(iter_text_chunks(io.BytesIO('﻿{"é": []}'.encode('utf-8')))) == '{"é": []}'
+
+##################################################
+# Keys before and after targets are read and
+# ignored. A targets key that is not a list does
+# not count as the targets list.
+##################################################
+def test_extra_keys_before_and_after_targets():
+
+    assert json_targets(['{"a": [1, {"targets": ["x"]}], "targets": ["111111111111"], "b": null, "c": "}"}']) == ['111111111111']
+
+def test_targets_that_is_not_a_list_is_reported(monkeypatch):
+
+    targets = read_text(b'{"targets": "111111111111"}', 65536, monkeypatch)
+
+    assert len(targets) == 0
+    assert targets.errors == ["the target list must be a JSON object with a targets list"]
+
+##################################################
+# Anything but whitespace after the object makes
+# the file unparseable.
+##################################################
+@pytest.mark.parametrize('trailing', ['x', '{}', '"targets"', ']'])
+def test_trailing_data_is_rejected(trailing, monkeypatch):
+
+    with pytest.raises(ValueError, match="unexpected data after the target list object"):
+        read_text(f'{{"targets": ["111111111111"]}} {trailing}'.encode('utf-8'), 3, monkeypatch)
+
+def test_trailing_whitespace_is_accepted(monkeypatch):
+
+    assert list(read_text(b'{"targets": ["111111111111"]}\n\n  ', 3, monkeypatch)) == ['111111111111']
+
+##################################################
+# An empty file, or one that only holds whitespace
+# or a BOM, is an error rather than an empty list.
+##################################################
+@pytest.mark.parametrize('content', [b'', b' \n\t', '﻿'.encode('utf-8'), gzip.compress(b'')])
+def test_empty_input_is_rejected(content, monkeypatch):
+
+    with pytest.raises(ValueError, match="the target list is empty"):
+        read_text(content, 2, monkeypatch)
+
+##################################################
+# An empty targets list is a valid list with no
+# targets; an object without one is reported.
+##################################################
+def test_empty_targets_list(monkeypatch):
+
+    targets = read_text(b'{"targets": []}', 1, monkeypatch)
+
+    assert len(targets) == 0
+    assert targets.errors == []
+
+def test_object_without_targets_is_reported(monkeypatch):
+
+    targets = read_text(b'{}', 1, monkeypatch)
+
+    assert len(targets) == 0
+    assert targets.errors == ["the target list must be a JSON object with a targets list"]
+
+def test_document_cut_short_is_rejected():
+
+    with pytest.raises(ValueError):
+        json_targets(['{"targets": ["111111111111"'])
+    with pytest.raises(ValueError):
+        json_targets(['{"targets": ["1111'])
+
+##################################################
+# Concatenated gzip members are read one after the
+# other, whatever the chunk size; a stream cut off
+# before the end of its last member is rejected.
+##################################################
+@pytest.mark.parametrize('chunk_size', chunk_sizes)
+def test_concatenated_gzip_members(chunk_size, monkeypatch):
+
+    content = gzip.compress(b'{"targets": ["111111111111", ') + gzip.compress(b'"222222222222"]}')
+
+    assert list(read_text(content, chunk_size, monkeypatch)) == ['111111111111', '222222222222']
+
+@pytest.mark.parametrize('chunk_size', [1, 65536])
+def test_truncated_gzip_is_rejected(chunk_size, monkeypatch):
+
+    # only the trailer is missing, so every byte of the text itself is there
+    content = gzip.compress(b'{"targets": ["111111111111"]}')[:-8]
+
+    with pytest.raises(ValueError, match="the gzip stream ends before its last block"):
+        read_text(content, chunk_size, monkeypatch)
+
+def test_gzip_line_list(monkeypatch):
+
+    content = gzip.compress(b'# accounts\n111111111111\n\nou-abcd-12345678\r\n222222222222')
+
+    assert list(read_text(content, 3, monkeypatch)) == ['ou-abcd-12345678', '111111111111', '222222222222']
+
+##################################################
+# Only the first max_reported_errors invalid IDs
+# are listed; the rest are counted in one error.
+##################################################
+@pytest.mark.parametrize('list_format', ['json', 'lines'])
+def test_invalid_ids_beyond_the_reported_limit_are_counted(list_format, monkeypatch):
+
+    invalid_ids = [f"bad-{index}" for index in range(TargetLists.max_reported_errors + 5)]
+    if list_format == 'json':
+        content = ('{"targets": ["111111111111", ' + ", ".join(f'"{target_id}"' for target_id in invalid_ids) + ']}').encode('utf-8')
+    else:
+        content = "\n".join(['111111111111'] + invalid_ids).encode('utf-8')
+
+    targets = read_text(content, 7, monkeypatch)
+
+    assert list(targets) == ['111111111111']
+    assert targets.errors == [f"target {target_id} is not an account ID, OU ID or root ID" for target_id in invalid_ids[:TargetLists.max_reported_errors]] + ["5 more target(s) are not an account ID, OU ID or root ID"]
+
+def test_non_string_ids_are_reported(monkeypatch):
+
+    targets = read_text(b'{"targets": [111111111111, null, "111111111111"]}', 65536, monkeypatch)
+
+    assert list(targets) == ['111111111111']
+    assert targets.errors == ["target 111111111111 is not an account ID, OU ID or root ID", "target None is not an account ID, OU ID or root ID"]